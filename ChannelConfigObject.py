@@ -1,4 +1,17 @@
 class ChannelConfigObject:
+    __slots__ = (
+        "channel_id",
+        "guild_id",
+        "slowmode_min",
+        "slowmode_max",
+        "cache_size",
+        "sensitivity",
+        "monitoring",
+        "edit_interval",
+        "hysteresis",
+        "estimator",
+    )
+
     def __init__(
         self,
         channel_id,
@@ -8,6 +21,9 @@ class ChannelConfigObject:
         cache_size,
         sensitivity,
         monitoring,
+        edit_interval=5,
+        hysteresis=1,
+        estimator="count",
     ):
         self.channel_id = channel_id
         self.guild_id = guild_id
@@ -16,14 +32,30 @@ class ChannelConfigObject:
         self.cache_size = cache_size
         self.sensitivity = sensitivity
         self.monitoring = monitoring
+        self.edit_interval = edit_interval
+        self.hysteresis = hysteresis
+        self.estimator = estimator
 
     @classmethod
     def from_db(cls, row):
-        return cls(row[0], row[1], row[2], row[3], row[4], row[5], bool(row[6]))
+        return cls(
+            row[0],
+            row[1],
+            row[2],
+            row[3],
+            row[4],
+            row[5],
+            bool(row[6]),
+            row[7],
+            row[8],
+            row[9],
+        )
 
     @classmethod
     def default(cls, channel, monitoring=True):
-        return cls(channel.id, channel.guild.id, 0, 30, 15, 1.0, monitoring)
+        return cls(
+            channel.id, channel.guild.id, 0, 30, 15, 1.0, monitoring, 5, 1, "count"
+        )
 
     def to_db(self):
         return (
@@ -34,6 +66,9 @@ class ChannelConfigObject:
             self.cache_size,
             self.sensitivity,
             int(self.monitoring),
+            self.edit_interval,
+            self.hysteresis,
+            self.estimator,
         )
 
     def as_monitor(self):
@@ -43,4 +78,7 @@ class ChannelConfigObject:
             self.slowmode_max,
             self.cache_size,
             self.sensitivity,
+            self.edit_interval,
+            self.hysteresis,
+            self.estimator,
         )
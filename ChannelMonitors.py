@@ -1,31 +1,176 @@
+import asyncio
+import logging
+import time
+from array import array
+from collections import OrderedDict
+from itertools import islice
+
 from MessageQueue import MessageQueue, ChannelConfigObject
 from DBInterface import DBInterface
+from EditCoalescer import EditCoalescer
+from HistoryPrefill import last_activity
+from TimerWheel import TimerWheel
+from Metrics import process_latency
+
+log = logging.getLogger(__name__)
 
 
 class ChannelMonitors:
-    def __init__(self, db_fp, get_discord_channel):
-        self.db = DBInterface(db_fp)
+    def __init__(
+        self,
+        db_fp,
+        get_discord_channel,
+        clock=time.monotonic,
+        engine=None,
+        tick_interval=1.0,
+        snapshot_interval=0,
+        snapshot_max_age=600,
+        max_hot_queues=0,
+        idle_timeout=0,
+        decay_interval=0,
+        wall_clock=time.time,
+        editor=None,
+        recorder=None,
+        guild_filter=None,
+        flush_interval=0,
+        flush_threshold=100,
+        purge_departed=False,
+        get_guild=None,
+    ):
+        self.db = DBInterface(
+            db_fp, flush_interval=flush_interval, flush_threshold=flush_threshold
+        )
         self.get_discord_channel = get_discord_channel
-        self.channels = {}
+        self.get_guild = get_guild
+        self.clock = clock
 
-    async def initialize(self):
-        channel_data = await self.db.initialize_database()
+        # Message timestamps are epoch seconds, so anything compared against
+        # them reads wall_clock rather than clock
+        self.wall_clock = wall_clock
 
-        channels_initialized = 0
-        for c in channel_data:
-            if not self.get_discord_channel(c.channel_id):
-                continue
+        # Optional EditDispatcher that every coalescer sends its edits through
+        self.editor = editor
 
-            self.add_channel(
-                c.channel_id,
-                c.slowmode_min,
-                c.slowmode_max,
-                c.cache_size,
-                c.sensitivity,
-            )
-            channels_initialized += 1
+        # Optional Recorder that every slowmode decision is appended to
+        self.recorder = recorder
+
+        # When sharded across processes, only rows for guilds this one owns are loaded
+        self.guild_filter = guild_filter
+
+        # Delete the rows of guilds the bot is no longer in when initialized
+        # with the list of guilds it is in
+        self.purge_departed = purge_departed
+
+        # Monitored channel ids; their MessageQueues are only built on first use
+        self.monitored = set()
+        self.channels = OrderedDict()
+        self.coalescers = {}
+
+        # Hot queues are kept in least recently active order. Ones idle for
+        # idle_timeout seconds, or beyond max_hot_queues (0 disables either),
+        # are evicted down to their last message timestamp and rebuilt from
+        # the cached config on the next message.
+        self.max_hot_queues = max_hot_queues
+        self.idle_timeout = idle_timeout
+        self.last_active = {}
+        self.cold = {}
+        self.eviction_task = None
+
+        # Optional TickEngine; count-estimator channels are then recalculated
+        # in one batch every tick_interval seconds instead of per message
+        self.engine = engine
+        self.tick_interval = tick_interval
+        self.tick_task = None
+
+        # Queue state is periodically saved so a restart doesn't start from empty.
+        # Snapshots older than snapshot_max_age seconds are not restored.
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_max_age = snapshot_max_age
+        self.snapshot_task = None
+        self.snapshot_dirty = set()
+
+        # Snapshot state read at startup, channel_id -> (estimator, values).
+        # It is kept until the channel's queue is first built, so restoring
+        # doesn't build every queue up front and run into max_hot_queues.
+        self.restored = {}
+
+        # A channel that goes quiet for decay_interval seconds has its slowmode
+        # recalculated as of now, and again every decay_interval seconds until
+        # it is back at the minimum. Channels in the tick engine are decayed by
+        # every tick instead.
+        self.decay_interval = decay_interval
+        self.decay_timers = TimerWheel(start=wall_clock())
+        self.decay_task = None
+
+    async def initialize(self, guilds=None):
+        guild_ids = None
+        if guilds is not None and self.purge_departed:
+            # Guilds that haven't come in yet are listed as unavailable. The
+            # list has to be complete, or guilds the bot is still in would go.
+            if guilds and not any(guild.unavailable for guild in guilds):
+                guild_ids = [guild.id for guild in guilds]
+            else:
+                log.warning(
+                    "Not purging departed guilds with the guild list incomplete, "
+                    "%d of %d unavailable",
+                    sum(guild.unavailable for guild in guilds),
+                    len(guilds),
+                )
+
+        channel_data = await self.db.initialize_database(self.guild_filter, guild_ids)
+
+        if guilds is not None:
+            await self.resync(guilds)
+        else:
+            for c in channel_data:
+                if self.get_channel(c.channel_id):
+                    self.monitored.add(c.channel_id)
+
+        restored = await self.restore_snapshots()
+
+        if self.decay_interval:
+            self.schedule_startup_decay()
 
-        print(f"Successfully initialized {channels_initialized} channels.")
+        log.info(
+            "Successfully initialized %d channels (%d restored from snapshot).",
+            len(self.monitored),
+            restored,
+        )
+
+        if self.engine and not self.tick_task:
+            self.tick_task = asyncio.create_task(self.run_ticks())
+
+        if self.snapshot_interval and not self.snapshot_task:
+            self.snapshot_task = asyncio.create_task(self.run_snapshots())
+
+        if self.idle_timeout and not self.eviction_task:
+            self.eviction_task = asyncio.create_task(self.run_evictions())
+
+        if self.decay_interval and not self.decay_task:
+            self.decay_task = asyncio.create_task(self.run_decay())
+
+    async def close(self):
+        if self.tick_task:
+            self.tick_task.cancel()
+            self.tick_task = None
+
+        if self.snapshot_task:
+            self.snapshot_task.cancel()
+            self.snapshot_task = None
+            await self.save_snapshots()
+
+        if self.eviction_task:
+            self.eviction_task.cancel()
+            self.eviction_task = None
+
+        if self.decay_task:
+            self.decay_task.cancel()
+            self.decay_task = None
+
+        for coalescer in self.coalescers.values():
+            coalescer.cancel()
+
+        await self.db.close()
 
     async def get_channel_config(self, channel_id):
         ret = await self.db.get_channel_monitor(channel_id)
@@ -34,8 +179,31 @@ class ChannelMonitors:
 
         return ret
 
+    async def resync(self, guilds):
+        # Reconcile whole guilds against the stored monitors in one pass. Rows
+        # for channels that no longer exist are switched off in one transaction.
+        stale = []
+
+        for guild in guilds:
+            if getattr(guild, "unavailable", False):
+                continue
+
+            for channel_id in self.db.cache.guild_monitors(guild.id):
+                if guild.get_channel(channel_id):
+                    self.monitored.add(channel_id)
+                else:
+                    stale.append(channel_id)
+
+        for channel_id in stale:
+            self.remove_channel(channel_id)
+
+        if stale:
+            await self.db.update_channel_monitoring_many(stale, False)
+
+        return stale
+
     async def start_monitoring(self, channel):
-        if channel.id in self.channels:
+        if channel.id in self.monitored:
             raise ValueError("Already monitoring this channel.")
 
         new_channel_config = await self.get_channel_config(channel.id)
@@ -50,8 +218,34 @@ class ChannelMonitors:
 
         return new_channel_config
 
+    async def start_monitoring_many(self, channels):
+        # start_monitoring for every channel given, written in one transaction.
+        # Returns the channels added and the ones that were already monitored.
+        added, skipped = [], []
+        configs = await self.db.lookup_many(
+            [channel.id for channel in channels if channel.id not in self.monitored]
+        )
+
+        for channel in channels:
+            if channel.id in self.monitored:
+                skipped.append(channel)
+                continue
+
+            config = configs.get(channel.id)
+            if config:
+                config.monitoring = True
+            else:
+                config = ChannelConfigObject.default(channel)
+
+            self.db.queue_write(config)
+            self.add_channel(*config.as_monitor())
+            added.append(channel)
+
+        await self.db.schedule_flush(now=True)
+        return added, skipped
+
     async def stop_monitoring(self, channel):
-        if not channel.id in self.channels:
+        if not channel.id in self.monitored:
             raise ValueError("Not currently monitoring this channel.")
 
         self.remove_channel(channel.id)
@@ -59,14 +253,136 @@ class ChannelMonitors:
 
         return True
 
+    def get_channel(self, channel_id):
+        # Client.get_channel looks through every guild in turn. The guild of a
+        # monitored channel is in its cached config, so get_guild makes this
+        # two dict lookups.
+        config = self.db.cache.peek(channel_id)
+        if not self.get_guild or not config:
+            return self.get_discord_channel(channel_id)
+
+        guild = self.get_guild(config.guild_id)
+        return guild.get_channel(channel_id) if guild else None
+
+    def is_monitored(self, channel_id):
+        return channel_id in self.monitored
+
+    def get_queue(self, channel_id):
+        q = self.channels.get(channel_id)
+
+        if q is None and channel_id in self.monitored:
+            config = self.db.cache.peek(channel_id)
+            if config and config.monitoring:
+                self.add_channel(*config.as_monitor())
+                q = self.channels.get(channel_id)
+
+        return q
+
     def add_channel(
-        self, channel_id, slowmode_min, slowmode_max, cache_size, sensitivity
+        self,
+        channel_id,
+        slowmode_min,
+        slowmode_max,
+        cache_size,
+        sensitivity,
+        edit_interval=5,
+        hysteresis=1,
+        estimator="count",
     ):
+        self.monitored.add(channel_id)
+
         if not channel_id in self.channels:
-            self.channels[channel_id] = MessageQueue(
-                slowmode_min, slowmode_max, cache_size, sensitivity
+            q = MessageQueue(
+                slowmode_min,
+                slowmode_max,
+                cache_size,
+                sensitivity,
+                edit_interval,
+                hysteresis,
+                estimator,
             )
 
+            # An evicted queue picks up from its last message so the first gap counts
+            last_timestamp = self.cold.pop(channel_id, None)
+            if channel_id in self.restored:
+                self.load_snapshot(channel_id, q)
+            elif last_timestamp is not None:
+                q.add_message(last_timestamp)
+
+            self.channels[channel_id] = q
+            self.coalescers[channel_id] = EditCoalescer(q, self.clock, self.editor)
+            self.last_active[channel_id] = self.clock()
+            self.sync_engine(channel_id, q)
+            self.enforce_hot_limit()
+
+    def touch(self, channel_id):
+        self.channels.move_to_end(channel_id)
+        self.last_active[channel_id] = self.clock()
+
+    def evict_channel(self, channel_id):
+        # Drop a hot queue down to its cold record. Channels with an edit still
+        # pending are left alone so it isn't lost.
+        coalescer = self.coalescers.get(channel_id)
+        if coalescer and (coalescer.pending is not None or coalescer.flush_task):
+            return False
+
+        if self.engine and self.engine.has_channel(channel_id):
+            timestamps = self.engine.get_timestamps(channel_id)
+            self.engine.remove_channel(channel_id)
+        else:
+            timestamps = self.channels[channel_id].get_timestamps()
+
+        if timestamps:
+            self.cold[channel_id] = timestamps[-1]
+
+        del self.channels[channel_id]
+        self.coalescers.pop(channel_id, None)
+        self.last_active.pop(channel_id, None)
+
+        return True
+
+    def enforce_hot_limit(self):
+        # A soft cap, channels with a pending edit can keep it exceeded briefly
+        excess = len(self.channels) - self.max_hot_queues
+        if not self.max_hot_queues or excess <= 0:
+            return
+
+        for channel_id in list(islice(self.channels, excess)):
+            self.evict_channel(channel_id)
+
+    def evict_idle(self):
+        cutoff = self.clock() - self.idle_timeout
+        evicted = 0
+
+        for channel_id in list(self.channels):
+            if self.last_active[channel_id] > cutoff:
+                break
+
+            if self.evict_channel(channel_id):
+                evicted += 1
+
+        return evicted
+
+    def pull_engine_timestamps(self, channel_id, q):
+        # In tick mode a channel's messages only go to the engine. They are
+        # copied into the queue before a settings change rebuilds its
+        # estimator, or takes the channel out of the engine altogether.
+        if self.engine and self.engine.has_channel(channel_id):
+            q.prefill((), self.engine.get_timestamps(channel_id))
+
+    def sync_engine(self, channel_id, q):
+        if not self.engine:
+            return
+
+        if q.estimator.name != "count":
+            self.engine.remove_channel(channel_id)
+        elif self.engine.has_channel(channel_id):
+            self.engine.configure(channel_id, q)
+        else:
+            self.engine.add_channel(channel_id, q)
+            for timestamp in q.get_timestamps():
+                self.engine.add_message(channel_id, timestamp)
+
     async def update_channel(
         self,
         channel,
@@ -74,45 +390,340 @@ class ChannelMonitors:
         slowmode_max=None,
         cache_size=None,
         sensitivity=None,
+        edit_interval=None,
+        hysteresis=None,
+        estimator=None,
     ):
-        q = self.channels.get(channel.id)
+        q = self.get_queue(channel.id)
         monitoring = True
 
         if not q:
             q = MessageQueue.from_config(ChannelConfigObject.default(channel, False))
             monitoring = False
+        else:
+            self.pull_engine_timestamps(channel.id, q)
+
+        self.apply_settings(
+            q,
+            slowmode_min,
+            slowmode_max,
+            cache_size,
+            sensitivity,
+            edit_interval,
+            hysteresis,
+            estimator,
+        )
+
+        if monitoring:
+            self.sync_engine(channel.id, q)
+
+        await self.db.update_channel_config(q.to_config(channel, monitoring))
+        return True
 
+    async def update_channels(self, channels, **settings):
+        # update_channel for every monitored channel given, written in one
+        # transaction. Returns the channels updated and the ones skipped for
+        # not being monitored.
+        updated, skipped = [], []
+
+        for channel in channels:
+            q = self.get_queue(channel.id)
+            if not q:
+                skipped.append(channel)
+                continue
+
+            self.pull_engine_timestamps(channel.id, q)
+            self.apply_settings(q, **settings)
+            self.sync_engine(channel.id, q)
+
+            # Cached right away, the hot queue limit may evict q before the end
+            self.db.queue_write(q.to_config(channel, True))
+            updated.append(channel)
+
+        await self.db.schedule_flush(now=True)
+        return updated, skipped
+
+    def apply_settings(
+        self,
+        q,
+        slowmode_min=None,
+        slowmode_max=None,
+        cache_size=None,
+        sensitivity=None,
+        edit_interval=None,
+        hysteresis=None,
+        estimator=None,
+    ):
         if slowmode_min != None and slowmode_max != None:
             q.set_bounds(slowmode_min, slowmode_max)
         if cache_size != None:
             q.set_cache_size(cache_size)
         if sensitivity != None:
             q.set_sensitivity(sensitivity)
-
-        await self.db.update_channel_config(q.to_config(channel, monitoring))
-        return True
+        if edit_interval != None and hysteresis != None:
+            q.set_edit_settings(edit_interval, hysteresis)
+        if estimator != None:
+            q.set_estimator(estimator)
 
     def remove_channel(self, channel_id):
+        self.monitored.discard(channel_id)
         self.channels.pop(channel_id, None)
+        self.last_active.pop(channel_id, None)
+        self.cold.pop(channel_id, None)
+        self.restored.pop(channel_id, None)
+        self.decay_timers.cancel(channel_id)
+
+        if self.engine:
+            self.engine.remove_channel(channel_id)
+
+        coalescer = self.coalescers.pop(channel_id, None)
+        if coalescer:
+            coalescer.cancel()
 
     async def get_guild_monitors(self, guild_id):
         rows = await self.db.get_guild_monitors(guild_id)
         return rows
 
     async def process_message(self, channel, timestamp):
-        q = self.channels.get(channel.id)
+        await self.process_messages(channel, (timestamp,))
+
+    async def process_messages(self, channel, timestamps):
+        # A burst of timestamps only needs one recalculation
+        q = self.get_queue(channel.id)
 
         if not q:
             return
 
-        q.add_message(timestamp)
+        self.snapshot_dirty.add(channel.id)
+        self.touch(channel.id)
+
+        if self.engine and self.engine.has_channel(channel.id):
+            # The next tick recalculates this channel along with every other one
+            for timestamp in timestamps:
+                self.engine.add_message(channel.id, timestamp)
+            return
+
+        with process_latency.time(mode="message"):
+            for timestamp in timestamps:
+                q.add_message(timestamp)
+
+            new_slowmode = q.calculate_optimal_slowmode()
+
+            # Edits are coalesced per channel to avoid flapping between two values
+            edited = await self.coalescers[channel.id].submit(channel, new_slowmode)
+
+            if self.recorder:
+                self.recorder.record(
+                    channel.id,
+                    self.wall_clock(),
+                    q.estimator.seconds_per_message(),
+                    new_slowmode,
+                    edited,
+                )
+
+        if self.decay_interval:
+            self.decay_timers.schedule(
+                channel.id, self.wall_clock() + self.decay_interval
+            )
+
+    async def run_ticks(self):
+        while True:
+            await asyncio.sleep(self.tick_interval)
+
+            try:
+                await self.tick()
+            except Exception as e:
+                log.error("Slowmode tick failed", exc_info=e)
+
+    async def tick(self):
+        submissions = []
+        decisions = []
+
+        with process_latency.time(mode="tick"):
+            now = self.wall_clock()
+
+            for channel_id, new_slowmode in self.engine.compute(
+                now if self.decay_interval else None, self.decay_interval
+            ):
+                channel = self.get_channel(channel_id)
+                coalescer = self.coalescers.get(channel_id)
+
+                if channel and coalescer:
+                    submissions.append(coalescer.submit(channel, new_slowmode))
+                    decisions.append((channel_id, new_slowmode))
+
+        results = await asyncio.gather(*submissions, return_exceptions=True)
+
+        for (channel_id, new_slowmode), result in zip(decisions, results):
+            if isinstance(result, Exception):
+                log.error("Slowmode edit failed during tick", exc_info=result)
+            elif self.recorder:
+                # The engine doesn't keep a per-channel rate to record
+                self.recorder.record(channel_id, now, None, new_slowmode, result)
+
+    async def run_decay(self):
+        while True:
+            await asyncio.sleep(self.decay_timers.resolution)
+
+            try:
+                await self.check_decay()
+            except Exception as e:
+                log.error("Decay check failed", exc_info=e)
+
+    async def check_decay(self):
+        now = self.wall_clock()
+
+        results = await asyncio.gather(
+            *(
+                self.decay_channel(channel_id, now)
+                for channel_id in self.decay_timers.advance(now)
+            ),
+            return_exceptions=True,
+        )
+
+        for result in results:
+            if isinstance(result, Exception):
+                log.error("Slowmode edit failed during decay", exc_info=result)
+
+    def schedule_startup_decay(self):
+        # Decay is otherwise only scheduled by messages, so a channel left
+        # raised across a restart would stay that way until its next one.
+        # Queues without a snapshot start from the channel's last message.
+        due = self.wall_clock() + self.decay_interval
+
+        for channel_id in self.monitored:
+            channel = self.get_channel(channel_id)
+            config = self.db.cache.peek(channel_id)
+            if not channel or not config:
+                continue
+            if channel.slowmode_delay <= (config.slowmode_min or 0):
+                continue
+
+            if channel_id not in self.restored and channel_id not in self.channels:
+                timestamp = last_activity(channel)
+                if timestamp:
+                    self.cold.setdefault(channel_id, timestamp)
+
+            self.decay_timers.schedule(channel_id, due)
+
+    async def decay_channel(self, channel_id, now):
+        channel = self.get_channel(channel_id)
+        if not channel or channel_id not in self.monitored:
+            return
+
+        # Evicted channels are only rebuilt when there is still something to undo
+        config = self.channels.get(channel_id) or self.db.cache.peek(channel_id)
+        if not config or channel.slowmode_delay <= (config.slowmode_min or 0):
+            return
+
+        # Building the queue can put it in the tick engine, which decays it from then on
+        q = self.get_queue(channel_id)
+        if not q or self.engine and self.engine.has_channel(channel_id):
+            return
 
-        old_slowmode = channel.slowmode_delay
-        new_slowmode = q.calculate_optimal_slowmode()
+        new_slowmode = q.calculate_optimal_slowmode(now)
+        edited = False
 
-        if new_slowmode != None and old_slowmode != new_slowmode:
-            await channel.edit(slowmode_delay=new_slowmode)
+        if new_slowmode is not None and new_slowmode < channel.slowmode_delay:
+            edited = await self.coalescers[channel_id].submit(channel, new_slowmode)
 
-            print(
-                f"Updated {channel.guild.name}#{channel.name} slowmode: {old_slowmode} to {new_slowmode}"
+        if self.recorder:
+            self.recorder.record(
+                channel_id,
+                now,
+                q.estimator.idle_seconds_per_message(now),
+                new_slowmode,
+                edited,
             )
+
+        self.decay_timers.schedule(channel_id, now + self.decay_interval)
+
+    async def run_evictions(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, 60))
+
+            try:
+                self.evict_idle()
+            except Exception as e:
+                log.error("Idle eviction failed", exc_info=e)
+
+    async def run_snapshots(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+
+            try:
+                await self.save_snapshots()
+            except Exception as e:
+                log.error("Saving queue snapshots failed", exc_info=e)
+
+    async def save_snapshots(self):
+        # Only queues that saw messages since the last snapshot are rewritten
+        dirty, self.snapshot_dirty = self.snapshot_dirty, set()
+        now = self.wall_clock()
+        rows = []
+
+        for channel_id in dirty:
+            q = self.channels.get(channel_id)
+            if not q:
+                continue
+
+            if self.engine and self.engine.has_channel(channel_id):
+                estimator, values = "count", self.engine.get_timestamps(channel_id)
+            else:
+                estimator, values = q.estimator.name, q.estimator.dump()
+
+            rows.append((channel_id, estimator, now, array("d", values).tobytes()))
+
+        await self.db.save_snapshots(rows, now - self.snapshot_max_age)
+
+    async def restore_snapshots(self):
+        cutoff = self.wall_clock() - self.snapshot_max_age
+
+        for channel_id, estimator, state in await self.db.load_snapshots(cutoff):
+            # Skip channels we no longer monitor or whose estimator has changed,
+            # and ones a message has already built a queue for
+            config = self.db.cache.peek(channel_id)
+            if channel_id not in self.monitored or not config:
+                continue
+            if config.estimator != estimator or channel_id in self.channels:
+                continue
+
+            values = array("d")
+            values.frombytes(state)
+            self.restored[channel_id] = (estimator, values)
+
+        return len(self.restored)
+
+    def load_snapshot(self, channel_id, q):
+        estimator, values = self.restored.pop(channel_id)
+
+        # Timestamps are aged against the time the queue is built, not startup
+        if q.estimator.name == estimator:
+            q.estimator.load(values, self.wall_clock() - self.snapshot_max_age)
+
+    def live_timestamps(self, channel_id, q):
+        if self.engine and self.engine.has_channel(channel_id):
+            return self.engine.get_timestamps(channel_id)
+
+        return q.get_timestamps()
+
+    def needs_prefill(self, channel_id):
+        # Queues restored from a snapshot may already be full
+        q = self.get_queue(channel_id)
+        return bool(q) and len(self.live_timestamps(channel_id, q)) < q.cache_size
+
+    def prefill_channel(self, channel_id, timestamps):
+        # Fills a queue with history fetched after startup, under whatever
+        # arrived live since. Returns whether the queue still needed it.
+        if not self.needs_prefill(channel_id):
+            return False
+
+        q = self.channels[channel_id]
+        q.prefill(timestamps, self.live_timestamps(channel_id, q))
+        self.snapshot_dirty.add(channel_id)
+
+        if self.engine and self.engine.has_channel(channel_id):
+            self.engine.remove_channel(channel_id)
+            self.sync_engine(channel_id, q)
+
+        return True
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+
+# Returned by ConfigCache.get when nothing is known about a channel, as
+# opposed to None which means "known to have no row"
+MISSING = object()
+
+
+class ConfigCache:
+    def __init__(self, max_unmonitored=4096):
+        self.max_unmonitored = max_unmonitored
+
+        # Monitored rows are always resident, the rest are kept in LRU order
+        self.monitored = {}
+        self.unmonitored = OrderedDict()
+
+        # guild_id -> set of monitored channel_ids
+        self.guilds = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, configs):
+        for config in configs:
+            self.put(config)
+
+    def get(self, channel_id):
+        config = self.monitored.get(channel_id, MISSING)
+
+        if config is MISSING and channel_id in self.unmonitored:
+            config = self.unmonitored[channel_id]
+            self.unmonitored.move_to_end(channel_id)
+
+        if config is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return config
+
+    def peek(self, channel_id):
+        # Internal lookup that doesn't count towards the hit/miss statistics
+        config = self.monitored.get(channel_id)
+        if config is None:
+            config = self.unmonitored.get(channel_id)
+
+        return config
+
+    def put(self, config):
+        self.discard(config.channel_id)
+
+        if config.monitoring:
+            self.monitored[config.channel_id] = config
+            self.guilds.setdefault(config.guild_id, set()).add(config.channel_id)
+        else:
+            self.put_unmonitored(config.channel_id, config)
+
+    def put_missing(self, channel_id):
+        # Remember that a channel has no row so repeated lookups skip the database
+        self.discard(channel_id)
+        self.put_unmonitored(channel_id, None)
+
+    def put_unmonitored(self, channel_id, config):
+        self.unmonitored[channel_id] = config
+
+        while len(self.unmonitored) > self.max_unmonitored:
+            self.unmonitored.popitem(last=False)
+
+    def discard(self, channel_id):
+        config = self.monitored.pop(channel_id, None)
+
+        if config:
+            guild_channels = self.guilds.get(config.guild_id)
+            if guild_channels is not None:
+                guild_channels.discard(channel_id)
+                if not guild_channels:
+                    del self.guilds[config.guild_id]
+
+        self.unmonitored.pop(channel_id, None)
+
+    def discard_guilds(self, guild_ids):
+        for guild_id in guild_ids:
+            for channel_id in self.guild_monitors(guild_id):
+                self.discard(channel_id)
+
+        for channel_id, config in list(self.unmonitored.items()):
+            if config and config.guild_id in guild_ids:
+                del self.unmonitored[channel_id]
+
+    def guild_monitors(self, guild_id):
+        return list(self.guilds.get(guild_id, ()))
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "monitored": len(self.monitored),
+            "unmonitored": len(self.unmonitored),
+        }
@@ -1,102 +1,514 @@
+import asyncio
+import functools
+import logging
+import sqlite3
+
 import aiosqlite
 
 from ChannelConfigObject import ChannelConfigObject
+from ConfigCache import ConfigCache, MISSING
+from Metrics import db_latency, timed
 
+log = logging.getLogger(__name__)
+
+# Seconds before a failed write-through flush is tried again
+FLUSH_RETRY_DELAY = 1.0
+
+# Channel ids per SELECT ... IN, well under SQLite's variable limit
+FETCH_BATCH = 500
+
+
+def retry_busy(func):
+    # Several processes can share the database file. busy_timeout makes SQLite
+    # wait on a held lock, and writes that still come back locked are rolled
+    # back and retried with a growing delay. Every coroutine shares the one
+    # connection and so the one transaction; holding write_lock makes sure a
+    # rollback only ever undoes the statements of the write that failed.
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        for attempt in range(self.busy_retries + 1):
+            async with self.write_lock:
+                try:
+                    return await func(self, *args, **kwargs)
+                except Exception as e:
+                    # Left open, the next write's commit would take these along
+                    if self.db is not None and self.db.in_transaction:
+                        await self.db.rollback()
+
+                    message = str(e).lower()
+                    if (
+                        attempt == self.busy_retries
+                        or not isinstance(e, sqlite3.OperationalError)
+                        or not ("locked" in message or "busy" in message)
+                    ):
+                        raise
+
+            # Outside the lock, so other writes can go ahead in the meantime
+            await asyncio.sleep(0.05 * 2**attempt)
+
+    return wrapper
+
+
+async def create_channel_monitors(db):
+    # The table as it was first created. Older databases already have it.
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS channel_monitors(
+            channel_id INTEGER PRIMARY KEY,
+            guild_id INTEGER,
+            min INTEGER DEFAULT 0,
+            max INTEGER DEFAULT 30,
+            cache_size INTEGER DEFAULT 15,
+            sensitivity DECIMAL DEFAULT 1.0,
+            monitoring INTEGER DEFAULT 1
+        );
+        """
+    )
 
-class DBInterface:
-    def __init__(self, db_fp):
-        self.conn = lambda: aiosqlite.connect(db_fp)
 
-    async def initialize_database(self):
-        # Create tables if first start and return all channels to monitor
-        async with self.conn() as db:
+async def add_edit_columns(db):
+    # These were added on startup before the schema was versioned, so
+    # databases at version 0 can have any of them already
+    async with db.execute("PRAGMA table_info(channel_monitors);") as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+
+    for column, definition in (
+        ("edit_interval", "INTEGER DEFAULT 5"),
+        ("hysteresis", "INTEGER DEFAULT 1"),
+        ("estimator", "TEXT DEFAULT 'count'"),
+    ):
+        if column not in columns:
             await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS channel_monitors(
-                    channel_id INTEGER PRIMARY KEY,
-                    guild_id INTEGER,
-                    min INTEGER DEFAULT 0,
-                    max INTEGER DEFAULT 30,
-                    cache_size INTEGER DEFAULT 15,
-                    sensitivity DECIMAL DEFAULT 1.0,
-                    monitoring INTEGER DEFAULT 1
-                );
-                """
+                f"ALTER TABLE channel_monitors ADD COLUMN {column} {definition};"
             )
-            await db.commit()
 
-            async with db.execute(
-                "SELECT * FROM channel_monitors WHERE monitoring = 1;"
-            ) as cursor:
-                rows = await cursor.fetchall()
 
-        return [ChannelConfigObject(*row) for row in rows]
+async def create_queue_snapshots(db):
+    # Warm-start state of in-flight message queues, see ChannelMonitors
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS queue_snapshots(
+            channel_id INTEGER PRIMARY KEY,
+            estimator TEXT,
+            saved_at REAL,
+            state BLOB
+        );
+        """
+    )
 
-    async def get_guild_monitors(self, guild_id):
-        async with self.conn() as db:
-            cur = await db.execute(
-                "SELECT channel_id FROM channel_monitors WHERE monitoring = 1 AND guild_id = ?;",
-                (guild_id,),
+
+async def add_guild_indexes(db):
+    # Per guild lookups and the departed guild purge use the first, loading
+    # the monitored channels at startup the second
+    await db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS channel_monitors_guild
+        ON channel_monitors(guild_id, monitoring);
+        """
+    )
+    await db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS channel_monitors_monitored
+        ON channel_monitors(guild_id) WHERE monitoring = 1;
+        """
+    )
+
+
+# Applied in order, PRAGMA user_version counting how many a database has had.
+# Only ever append to this; a released migration must not change.
+MIGRATIONS = (
+    create_channel_monitors,
+    add_edit_columns,
+    create_queue_snapshots,
+    add_guild_indexes,
+)
+
+
+class DBInterface:
+    # Config and monitoring writes are applied to the cache straight away and
+    # written behind. Repeated writes to a channel are merged, and everything
+    # pending goes out in one transaction flush_interval seconds after the
+    # first write, or as soon as flush_threshold channels are waiting.
+    # flush_interval is the most that can be lost on a crash; 0 writes through.
+    def __init__(
+        self,
+        db_fp,
+        busy_timeout=5000,
+        busy_retries=5,
+        flush_interval=0,
+        flush_threshold=100,
+    ):
+        self.db_fp = db_fp
+        self.db = None
+
+        self.busy_timeout = busy_timeout
+        self.busy_retries = busy_retries
+
+        # Every write goes through this class, so the cache never goes stale
+        self.cache = ConfigCache()
+
+        # channel_id -> full channel_monitors row waiting to be written
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.pending = {}
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+
+        # Held by every write transaction, see retry_busy. flush_lock can't be
+        # used, flush holds it while write_rows runs.
+        self.write_lock = asyncio.Lock()
+
+    async def connect(self):
+        # One long-lived connection; sqlite3 caches compiled statements per
+        # connection, so each fixed query string below is only prepared once
+        if self.db is None:
+            self.db = await aiosqlite.connect(self.db_fp, cached_statements=64)
+            # First, so switching to WAL waits out other processes too
+            await self.db.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)};")
+            await self.db.execute("PRAGMA journal_mode = WAL;")
+            await self.db.execute("PRAGMA synchronous = NORMAL;")
+
+        return self.db
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+
+        if self.db is not None:
+            # Nothing comes after the last flush to sync it, so wait for the disk
+            await self.db.execute("PRAGMA synchronous = FULL;")
+            await self.flush()
+
+            async with self.write_lock:
+                await self.db.commit()
+                await self.db.close()
+            self.db = None
+
+    @timed(db_latency, method="initialize_database")
+    async def initialize_database(self, guild_filter=None, guild_ids=None):
+        # Bring the schema up to date and return all channels to monitor,
+        # limited to the guilds guild_filter accepts when given. With
+        # guild_ids, the guilds the bot is in, rows of guilds it has left go.
+        db = await self.connect()
+        await self.migrate()
+
+        if guild_ids is not None:
+            await self.purge_departed_guilds(guild_ids, guild_filter)
+
+        async with db.execute(
+            "SELECT * FROM channel_monitors WHERE monitoring = 1;"
+        ) as cursor:
+            rows = await cursor.fetchall()
+
+        configs = [
+            ChannelConfigObject.from_db(row)
+            for row in rows
+            if guild_filter is None or guild_filter(row[1])
+        ]
+        self.cache.load(configs)
+
+        return configs
+
+    @retry_busy
+    async def migrate(self):
+        # Each migration runs in its own transaction together with the bump of
+        # user_version. The version is read again under the write lock, so
+        # workers starting together don't both apply the same migration.
+        while True:
+            await self.db.execute("BEGIN IMMEDIATE;")
+
+            try:
+                async with self.db.execute("PRAGMA user_version;") as cur:
+                    version = (await cur.fetchone())[0]
+
+                if version > len(MIGRATIONS):
+                    raise RuntimeError(
+                        f"Database schema version {version} is newer than this "
+                        f"bot knows about ({len(MIGRATIONS)})"
+                    )
+                if version == len(MIGRATIONS):
+                    await self.db.commit()
+                    return
+
+                migration = MIGRATIONS[version]
+                await migration(self.db)
+                await self.db.execute(f"PRAGMA user_version = {version + 1};")
+                await self.db.commit()
+            except BaseException:
+                await self.db.rollback()
+                raise
+
+            log.info(
+                "Migrated database to version %d: %s", version + 1, migration.__name__
             )
-            row = await cur.fetchall()
 
-        return [r[0] for r in row]
+    @timed(db_latency, method="purge_departed_guilds")
+    async def purge_departed_guilds(self, guild_ids, guild_filter=None):
+        # Deletes the rows and snapshots of guilds not in guild_ids. Guilds
+        # guild_filter doesn't accept belong to another worker process, which
+        # is the one that knows whether they've been left.
+        guild_ids = set(guild_ids)
+        if not guild_ids:
+            # More likely a guild list that hasn't loaded than no guilds at all
+            log.warning("Not purging departed guilds without any current ones")
+            return 0
+
+        await self.flush()
+
+        async with self.db.execute(
+            "SELECT DISTINCT guild_id FROM channel_monitors;"
+        ) as cur:
+            departed = [
+                (row[0],)
+                for row in await cur.fetchall()
+                if row[0] not in guild_ids
+                and (guild_filter is None or guild_filter(row[0]))
+            ]
+
+        if not departed:
+            return 0
+
+        await self.delete_guilds(departed)
 
+        self.cache.discard_guilds({guild_id for guild_id, in departed})
+
+        log.info("Purged the rows of %d departed guilds", len(departed))
+        return len(departed)
+
+    @retry_busy
+    async def delete_guilds(self, guild_ids):
+        await self.db.executemany(
+            """
+            DELETE FROM queue_snapshots WHERE channel_id IN (
+                SELECT channel_id FROM channel_monitors WHERE guild_id = ?
+            );
+            """,
+            guild_ids,
+        )
+        await self.db.executemany(
+            "DELETE FROM channel_monitors WHERE guild_id = ?;", guild_ids
+        )
+        await self.db.commit()
+
+    @timed(db_latency, method="get_guild_monitors")
+    async def get_guild_monitors(self, guild_id):
+        # All monitored rows are loaded at startup, so this never misses
+        return self.cache.guild_monitors(guild_id)
+
+    @timed(db_latency, method="get_channel_monitor")
     async def get_channel_monitor(self, channel_id):
-        async with self.conn() as db:
-            cur = await db.execute(
+        config = await self.lookup(channel_id)
+        return config.to_db() if config else None
+
+    async def lookup(self, channel_id):
+        # The channel's config, or None without a row. MISSING is truthy and
+        # must never get past here to callers testing the result with if.
+        config = self.cache.get(channel_id)
+
+        if config is MISSING:
+            config = await self.fetch_channel_monitor(channel_id)
+
+        return config
+
+    async def lookup_many(self, channel_ids):
+        # lookup for every channel given as a dict, the cache misses fetched
+        # together instead of a query each
+        configs = {channel_id: self.cache.get(channel_id) for channel_id in channel_ids}
+        missing = [
+            channel_id for channel_id, config in configs.items() if config is MISSING
+        ]
+
+        if missing:
+            configs.update(await self.fetch_channel_monitors(missing))
+
+        return configs
+
+    @timed(db_latency, method="fetch_channel_monitors")
+    async def fetch_channel_monitors(self, channel_ids):
+        # fetch_channel_monitor for many channels, in batches of FETCH_BATCH
+        rows = {
+            channel_id: self.pending[channel_id]
+            for channel_id in channel_ids
+            if channel_id in self.pending
+        }
+        unwritten = [channel_id for channel_id in channel_ids if channel_id not in rows]
+
+        for i in range(0, len(unwritten), FETCH_BATCH):
+            batch = unwritten[i : i + FETCH_BATCH]
+            async with self.db.execute(
+                "SELECT * FROM channel_monitors WHERE channel_id IN (%s);"
+                % ", ".join("?" * len(batch)),
+                batch,
+            ) as cur:
+                for row in await cur.fetchall():
+                    rows[row[0]] = row
+
+        configs = {}
+        for channel_id in channel_ids:
+            row = rows.get(channel_id)
+            if row:
+                configs[channel_id] = ChannelConfigObject.from_db(row)
+                self.cache.put(configs[channel_id])
+            else:
+                configs[channel_id] = None
+                self.cache.put_missing(channel_id)
+
+        return configs
+
+    @timed(db_latency, method="fetch_channel_monitor")
+    async def fetch_channel_monitor(self, channel_id):
+        # Read-through on a cache miss, remembering rows that don't exist too.
+        # A row the cache has let go of may not have been written yet.
+        row = self.pending.get(channel_id)
+
+        if row is None:
+            async with self.db.execute(
                 "SELECT * FROM channel_monitors WHERE channel_id = ?;",
                 (channel_id,),
-            )
-            row = await cur.fetchone()
+            ) as cur:
+                row = await cur.fetchone()
+
+        if row:
+            config = ChannelConfigObject.from_db(row)
+            self.cache.put(config)
+        else:
+            config = None
+            self.cache.put_missing(channel_id)
 
-        return row
+        return config
 
+    @timed(db_latency, method="insert_channel_monitor")
     async def insert_channel_monitor(self, row):
-        async with self.conn() as db:
-            await db.execute(
-                """
-                INSERT INTO channel_monitors(channel_id, guild_id, min, max, cache_size, sensitivity, monitoring) VALUES (?, ?, ?, ?, ?, ?, ?);
-                """,
-                row,
-            )
-            await db.commit()
+        self.queue_write(ChannelConfigObject.from_db(row))
+        await self.schedule_flush()
 
+    @timed(db_latency, method="update_channel_monitoring")
     async def update_channel_monitoring(self, channel_id, monitoring):
-        async with self.conn() as db:
-            await db.execute(
-                """
-                UPDATE
-                    channel_monitors
-                SET
-                    monitoring = ?
-                WHERE
-                    channel_id = ?;
-                """,
-                (int(monitoring), channel_id),
-            )
-            await db.commit()
+        config = await self.lookup(channel_id)
+
+        # Channels without a row are left alone, as an UPDATE would
+        if config:
+            config.monitoring = bool(monitoring)
+            self.queue_write(config)
+            await self.schedule_flush()
+
+    @timed(db_latency, method="update_channel_monitoring_many")
+    async def update_channel_monitoring_many(self, channel_ids, monitoring):
+        configs = await self.lookup_many(channel_ids)
+
+        for config in configs.values():
+            if config:
+                config.monitoring = bool(monitoring)
+                self.queue_write(config)
 
+        await self.schedule_flush()
+
+    @timed(db_latency, method="save_snapshots")
+    @retry_busy
+    async def save_snapshots(self, rows, cutoff):
+        await self.db.executemany(
+            """
+            INSERT OR REPLACE INTO queue_snapshots(channel_id, estimator, saved_at, state) VALUES (?, ?, ?, ?);
+            """,
+            rows,
+        )
+        await self.db.execute(
+            "DELETE FROM queue_snapshots WHERE saved_at < ?;",
+            (cutoff,),
+        )
+        await self.db.commit()
+
+    @timed(db_latency, method="load_snapshots")
+    async def load_snapshots(self, cutoff):
+        async with self.db.execute(
+            "SELECT channel_id, estimator, state FROM queue_snapshots WHERE saved_at >= ?;",
+            (cutoff,),
+        ) as cur:
+            rows = await cur.fetchall()
+
+        return rows
+
+    @timed(db_latency, method="update_channel_config")
     async def update_channel_config(self, config):
-        async with self.conn() as db:
-            await db.execute(
-                """
-                UPDATE
-                    channel_monitors
-                SET
-                    min = ?,
-                    max = ?,
-                    cache_size = ?,
-                    sensitivity = ?
-                WHERE
-                    channel_id = ?;
-                """,
-                (
-                    config.slowmode_min,
-                    config.slowmode_max,
-                    config.cache_size,
-                    config.sensitivity,
-                    config.channel_id,
-                ),
+        cached = await self.lookup(config.channel_id)
+        if cached:
+            # The monitoring flag isn't part of this update, keep the stored one
+            row = list(config.to_db())
+            row[6] = int(cached.monitoring)
+            self.queue_write(ChannelConfigObject.from_db(row))
+            await self.schedule_flush()
+
+    def queue_write(self, config):
+        # A later write to the same channel replaces the earlier one. Bulk
+        # changes queue every row and then flush them in one transaction.
+        self.cache.put(config)
+        self.pending[config.channel_id] = config.to_db()
+
+    async def schedule_flush(self, now=False):
+        if now or not self.flush_interval or len(self.pending) >= self.flush_threshold:
+            try:
+                await self.flush()
+            except Exception:
+                # The cache already shows the change, so it can't just wait
+                # for some later write to flush it
+                self.start_flush_timer()
+                raise
+        else:
+            self.start_flush_timer()
+
+    def start_flush_timer(self):
+        if not self.flush_task:
+            self.flush_task = asyncio.create_task(self.delayed_flush())
+
+    async def delayed_flush(self):
+        try:
+            await asyncio.sleep(self.flush_interval or FLUSH_RETRY_DELAY)
+        finally:
+            self.flush_task = None
+
+        try:
+            await self.flush()
+        except Exception as e:
+            log.error(
+                "Flushing %d pending writes failed", len(self.pending), exc_info=e
             )
-            await db.commit()
+
+            # Try again next interval, the writes are still pending
+            self.start_flush_timer()
+
+    @timed(db_latency, method="flush")
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return
+
+            rows, self.pending = self.pending, {}
+
+            try:
+                await self.write_rows(list(rows.values()))
+            except Exception:
+                # Anything written over in the meantime is newer than what failed
+                for channel_id, row in rows.items():
+                    self.pending.setdefault(channel_id, row)
+                raise
+
+    @retry_busy
+    async def write_rows(self, rows):
+        await self.db.executemany(
+            """
+            INSERT INTO channel_monitors(channel_id, guild_id, min, max, cache_size, sensitivity, monitoring, edit_interval, hysteresis, estimator) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(channel_id) DO UPDATE SET
+                guild_id = excluded.guild_id,
+                min = excluded.min,
+                max = excluded.max,
+                cache_size = excluded.cache_size,
+                sensitivity = excluded.sensitivity,
+                monitoring = excluded.monitoring,
+                edit_interval = excluded.edit_interval,
+                hysteresis = excluded.hysteresis,
+                estimator = excluded.estimator;
+            """,
+            rows,
+        )
+        await self.db.commit()
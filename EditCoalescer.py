@@ -0,0 +1,140 @@
+import asyncio
+import time
+
+from LogSetup import log_slowmode_change
+from Metrics import edit_latency, edit_results, edit_retries
+
+
+def get_retry_after(error, default):
+    # disnake's HTTPException keeps the aiohttp response around
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+
+    try:
+        return float(headers.get("Retry-After", default))
+    except (TypeError, ValueError):
+        return default
+
+
+class EditCoalescer:
+    # Sits between a channel's MessageQueue and channel.edit, holding back
+    # edits that are too small (hysteresis) or too soon (edit_interval). With an
+    # EditDispatcher as the editor, edits are handed to it instead of being sent.
+    __slots__ = (
+        "queue",
+        "clock",
+        "editor",
+        "channel",
+        "pending",
+        "last_edit",
+        "flush_task",
+    )
+
+    def __init__(self, queue, clock=time.monotonic, editor=None):
+        self.queue = queue
+        self.clock = clock
+        self.editor = editor
+
+        self.channel = None
+        self.pending = None
+        self.last_edit = None
+        self.flush_task = None
+
+    def is_significant(self, current, desired):
+        if desired == current:
+            return False
+
+        # Always allow settling on a bound so the band can't strand us above the minimum
+        if desired in (self.queue.slowmode_min, self.queue.slowmode_max):
+            return True
+
+        return abs(desired - current) > self.queue.hysteresis
+
+    def time_until_next_edit(self):
+        if self.last_edit is None:
+            return 0
+
+        return self.last_edit + self.queue.edit_interval - self.clock()
+
+    async def submit(self, channel, desired):
+        # Only the latest desired value is kept, older pending values are replaced.
+        # Returns whether an edit to desired was made or is now pending.
+        self.channel = channel
+
+        if desired is None or not self.is_significant(channel.slowmode_delay, desired):
+            self.pending = None
+            return False
+
+        self.pending = desired
+
+        if self.flush_task:
+            return True
+
+        delay = self.time_until_next_edit()
+        if delay <= 0:
+            await self.flush()
+        else:
+            self.flush_task = asyncio.create_task(self.delayed_flush(delay))
+
+        return True
+
+    async def delayed_flush(self, delay):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.flush_task = None
+
+        await self.flush()
+
+    async def flush(self):
+        desired = self.pending
+        self.pending = None
+
+        if desired is None or self.channel is None:
+            return
+
+        old_slowmode = self.channel.slowmode_delay
+        if old_slowmode == desired:
+            return
+
+        self.last_edit = self.clock()
+
+        rate = self.queue.estimator.seconds_per_message()
+
+        if self.editor:
+            self.editor.submit(self.channel, desired, rate)
+            return
+
+        try:
+            with edit_latency.time():
+                await self.channel.edit(slowmode_delay=desired)
+        except Exception as e:
+            if getattr(e, "status", None) != 429:
+                edit_results.inc(result="error")
+                raise
+
+            edit_results.inc(result="rate_limited")
+            self.retry(desired, get_retry_after(e, self.queue.edit_interval))
+            return
+
+        edit_results.inc(result="ok")
+
+        log_slowmode_change(self.channel, old_slowmode, desired, rate)
+
+    def retry(self, desired, delay):
+        # A newer value submitted since takes precedence over the one that failed
+        if self.pending is None:
+            self.pending = desired
+
+        edit_retries.inc()
+
+        if not self.flush_task:
+            self.flush_task = asyncio.create_task(self.delayed_flush(delay))
+
+    def cancel(self):
+        self.pending = None
+        if self.editor and self.channel:
+            self.editor.cancel(self.channel.id)
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
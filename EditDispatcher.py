@@ -0,0 +1,231 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from EditCoalescer import get_retry_after
+from LogSetup import log_slowmode_change
+from Metrics import edit_latency, edit_results, edit_retries
+
+log = logging.getLogger(__name__)
+
+
+def is_global_limit(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+
+    return (
+        str(headers.get("X-RateLimit-Global", "")).lower() == "true"
+        or headers.get("X-RateLimit-Scope") == "global"
+    )
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+
+        self.tokens = burst
+        self.updated = clock()
+        self.blocked_until = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        # Seconds until a token can be taken, 0 if one is available now
+        now = self.clock()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        # Used when a 429 tells us the real budget is exhausted
+        now = self.clock()
+        self.refill(now)
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class EditDispatcher:
+    # Single funnel for slowmode edits. Requests wait in a priority queue,
+    # increases before decreases and the largest increases first, and are sent
+    # as the per-guild and global token buckets allow. A channel only ever has
+    # its latest request queued; older ones are dropped when replaced.
+    def __init__(
+        self,
+        guild_rate=1.0,
+        guild_burst=5,
+        global_rate=40.0,
+        global_burst=40,
+        clock=time.monotonic,
+    ):
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.clock = clock
+
+        self.global_bucket = TokenBucket(global_rate, global_burst, clock)
+        self.guild_buckets = {}
+
+        # channel_id -> (channel, desired, rate, seq); heap entries whose seq no longer
+        # matches have been replaced and are skipped when popped
+        self.requests = {}
+        self.heap = []
+        self.seq = itertools.count()
+
+        # Channels with an edit on the wire aren't sent a second one concurrently
+        self.in_flight = set()
+        self.sends = set()
+
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+        await asyncio.gather(*self.sends, return_exceptions=True)
+
+    def queue_depth(self):
+        return len(self.requests)
+
+    def guild_bucket(self, guild_id):
+        bucket = self.guild_buckets.get(guild_id)
+
+        if bucket is None:
+            bucket = self.guild_buckets[guild_id] = TokenBucket(
+                self.guild_rate, self.guild_burst, self.clock
+            )
+
+        return bucket
+
+    def submit(self, channel, desired, rate=None):
+        # rate is the measured seconds per message, only used for logging
+        delta = desired - channel.slowmode_delay
+        seq = next(self.seq)
+
+        self.requests[channel.id] = (channel, desired, rate, seq)
+
+        # Increases by size, then decreases in the order they came in
+        priority = (0, -delta) if delta > 0 else (1, 0)
+        heapq.heappush(self.heap, (priority, seq, channel.id))
+
+        self.wakeup.set()
+
+    def cancel(self, channel_id):
+        self.requests.pop(channel_id, None)
+
+    async def run(self):
+        while True:
+            try:
+                wait = self.dispatch_ready()
+            except Exception as e:
+                log.error("Edit dispatcher failed", exc_info=e)
+                wait = 1.0
+
+            self.wakeup.clear()
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def dispatch_ready(self):
+        # Sends every request the buckets allow right now, highest priority
+        # first. Returns how long to wait before trying again, or None to wait
+        # for a new request or a finished send.
+        deferred = []
+        wait = None
+
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            _, seq, channel_id = entry
+
+            request = self.requests.get(channel_id)
+            if request is None or request[3] != seq:
+                continue
+
+            if channel_id in self.in_flight:
+                deferred.append(entry)
+                continue
+
+            channel, desired, rate, _ = request
+            global_delay = self.global_bucket.delay()
+            guild_bucket = self.guild_bucket(channel.guild.id)
+            delay = max(global_delay, guild_bucket.delay())
+
+            if delay > 0:
+                deferred.append(entry)
+                wait = delay if wait is None else min(wait, delay)
+
+                # Nothing else can go until the global bucket refills
+                if global_delay > 0:
+                    break
+                continue
+
+            self.global_bucket.take()
+            guild_bucket.take()
+
+            del self.requests[channel_id]
+            self.in_flight.add(channel_id)
+
+            task = asyncio.create_task(self.send(channel, desired, rate))
+            self.sends.add(task)
+            task.add_done_callback(self.sends.discard)
+
+        for entry in deferred:
+            heapq.heappush(self.heap, entry)
+
+        return wait
+
+    async def send(self, channel, desired, rate=None):
+        try:
+            old_slowmode = channel.slowmode_delay
+            if old_slowmode == desired:
+                return
+
+            with edit_latency.time():
+                await channel.edit(slowmode_delay=desired)
+        except Exception as e:
+            if getattr(e, "status", None) != 429:
+                edit_results.inc(result="error")
+                log.error("Slowmode edit failed", exc_info=e)
+                return
+
+            edit_results.inc(result="rate_limited")
+            edit_retries.inc()
+
+            retry_after = get_retry_after(e, 1.0)
+            if is_global_limit(e):
+                self.global_bucket.block(retry_after)
+            else:
+                self.guild_bucket(channel.guild.id).block(retry_after)
+
+            # A newer request submitted since takes precedence over the one that failed
+            if channel.id not in self.requests:
+                self.submit(channel, desired, rate)
+            return
+        finally:
+            self.in_flight.discard(channel.id)
+            self.wakeup.set()
+
+        edit_results.inc(result="ok")
+
+        log_slowmode_change(channel, old_slowmode, desired, rate)
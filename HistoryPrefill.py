@@ -0,0 +1,155 @@
+import asyncio
+import collections
+import logging
+import time
+
+from EditCoalescer import get_retry_after
+from EditDispatcher import TokenBucket
+from Metrics import registry
+
+log = logging.getLogger(__name__)
+
+# Discord's epoch in milliseconds, snowflakes count from it
+DISCORD_EPOCH = 1420070400000
+
+# Messages a single history request returns at most
+PAGE_SIZE = 100
+
+prefill_results = registry.counter(
+    "slowmode_prefill_total", "Channels considered for history prefill by outcome"
+)
+
+
+def last_activity(channel):
+    # Epoch seconds of the channel's last message, read from its snowflake
+    message_id = getattr(channel, "last_message_id", None)
+    if not message_id:
+        return 0.0
+
+    return ((message_id >> 22) + DISCORD_EPOCH) / 1000
+
+
+async def discord_history(channel, limit):
+    # Timestamps of the channel's recent messages. Bots are left out as
+    # on_message would; members bypassing slowmode can't be told apart here.
+    return [
+        message.created_at.timestamp()
+        async for message in channel.history(limit=limit)
+        if not message.author.bot
+    ]
+
+
+class HistoryPrefill:
+    # Fills the MessageQueues of monitored channels with their recent history
+    # at startup, so decisions can be made before cache_size new messages have
+    # come in. Runs in the background with at most concurrency requests in
+    # flight and a token bucket over all of them, the most recently active
+    # channels first. provider(channel, limit) returns message timestamps.
+    def __init__(
+        self,
+        monitors,
+        provider=discord_history,
+        concurrency=4,
+        rate=5.0,
+        burst=5,
+        max_age=3600,
+        clock=time.monotonic,
+        wall_clock=time.time,
+    ):
+        self.monitors = monitors
+        self.provider = provider
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.max_age = max_age
+        self.wall_clock = wall_clock
+
+        self.pending = collections.deque()
+        self.task = None
+
+    def order(self, channels):
+        # Busiest first by last message. Channels quiet for longer than
+        # max_age would be decayed straight back down, so they're skipped, as
+        # are the ones that wouldn't fit in the hot queue limit anyway.
+        cutoff = self.wall_clock() - self.max_age if self.max_age else 0.0
+        active = [
+            (last_activity(channel), channel)
+            for channel in channels
+            if self.monitors.is_monitored(channel.id)
+        ]
+        active = [item for item in active if item[0] >= cutoff]
+        active.sort(key=lambda item: item[0], reverse=True)
+
+        if self.monitors.max_hot_queues:
+            active = active[: self.monitors.max_hot_queues]
+
+        return [channel for _, channel in active]
+
+    def start(self, channels):
+        if self.task:
+            return
+
+        self.pending.extend(self.order(channels))
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.pending.clear()
+
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        started = time.perf_counter()
+        total = len(self.pending)
+
+        await asyncio.gather(*(self.worker() for _ in range(self.concurrency)))
+
+        log.info(
+            "History prefill went through %d channels in %.1fs",
+            total,
+            time.perf_counter() - started,
+        )
+
+    async def worker(self):
+        while self.pending:
+            channel = self.pending.popleft()
+
+            if not self.monitors.needs_prefill(channel.id):
+                prefill_results.inc(result="skipped")
+                continue
+
+            # Histories longer than a page take a request per page
+            limit = self.monitors.get_queue(channel.id).cache_size
+            for _ in range(-(-limit // PAGE_SIZE)):
+                await self.wait_for_token()
+
+            try:
+                timestamps = await self.provider(channel, limit)
+            except Exception as e:
+                if getattr(e, "status", None) == 429:
+                    self.bucket.block(get_retry_after(e, 1.0))
+                    self.pending.append(channel)
+                    continue
+
+                prefill_results.inc(result="error")
+                log.warning(
+                    "Couldn't fetch history for prefill: %s",
+                    e,
+                    extra={"guild": channel.guild.id, "channel": channel.id},
+                )
+                continue
+
+            if self.monitors.prefill_channel(channel.id, timestamps):
+                prefill_results.inc(result="filled")
+            else:
+                prefill_results.inc(result="skipped")
+
+    async def wait_for_token(self):
+        while True:
+            delay = self.bucket.delay()
+            if delay <= 0:
+                self.bucket.take()
+                return
+
+            await asyncio.sleep(delay)
@@ -0,0 +1,164 @@
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# Extra record attributes carried through to the output, in this order
+FIELDS = ("guild", "channel", "old_slowmode", "new_slowmode", "rate", "suppressed")
+
+change_log = logging.getLogger("changes")
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler copies and formats the whole record, traceback
+    # included, before queueing it. Only the message is resolved here and
+    # everything else is left for the listener thread. Records aren't copied
+    # since this is the only handler that sees them.
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+
+        fields = [
+            f"{name}={getattr(record, name)}"
+            for name in FIELDS
+            if getattr(record, name, None) is not None
+        ]
+        if not fields:
+            return line
+
+        # Keep any traceback below the fields rather than before them
+        message, sep, rest = line.partition("\n")
+        return f"{message} {' '.join(fields)}{sep}{rest}"
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        for name in FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry)
+
+
+class ChangeRateLimiter(logging.Filter):
+    # Lets through at most one change line per channel every interval seconds.
+    # The next line let through carries how many were suppressed in between.
+    def __init__(self, interval, clock=time.monotonic):
+        super().__init__()
+        self.interval = interval
+        self.clock = clock
+
+        # channel id -> [time of the last line let through, lines suppressed since]
+        self.channels = {}
+        self.last_prune = clock()
+
+    def filter(self, record):
+        channel_id = getattr(record, "channel", None)
+        if not self.interval or channel_id is None:
+            return True
+
+        now = self.clock()
+        state = self.channels.get(channel_id)
+
+        if state and now - state[0] < self.interval:
+            state[1] += 1
+            return False
+
+        if state and state[1]:
+            record.suppressed = state[1]
+
+        self.channels[channel_id] = [now, 0]
+
+        if now - self.last_prune >= self.interval:
+            self.prune(now)
+
+        return True
+
+    def prune(self, now):
+        # Channels quiet for a whole interval have nothing left to report
+        self.channels = {
+            channel_id: state
+            for channel_id, state in self.channels.items()
+            if now - state[0] < self.interval or state[1]
+        }
+        self.last_prune = now
+
+
+def log_slowmode_change(channel, old_slowmode, new_slowmode, rate=None):
+    change_log.info(
+        "Updated %s#%s slowmode: %s to %s",
+        channel.guild.name,
+        channel.name,
+        old_slowmode,
+        new_slowmode,
+        extra={
+            "guild": channel.guild.id,
+            "channel": channel.id,
+            "old_slowmode": old_slowmode,
+            "new_slowmode": new_slowmode,
+            "rate": round(rate, 3) if rate is not None else None,
+        },
+    )
+
+
+def setup_logging(level="INFO", json_output=False, change_interval=10):
+    # Route every log record through a queue to a background thread, so a slow
+    # stdout never blocks the event loop. Returns the running listener, which
+    # should be stopped on shutdown to flush what's left.
+    formatter = JsonFormatter() if json_output else TextFormatter()
+
+    stdout = logging.StreamHandler(sys.stdout)
+    stdout.addFilter(lambda record: record.levelno < logging.WARNING)
+    stdout.setFormatter(formatter)
+
+    stderr = logging.StreamHandler(sys.stderr)
+    stderr.setLevel(logging.WARNING)
+    stderr.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        records, stdout, stderr, respect_handler_level=True
+    )
+
+    # Record attributes neither formatter prints aren't worth collecting
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    root = logging.getLogger()
+    root.handlers = [StructuredQueueHandler(records)]
+    root.setLevel(level)
+
+    # disnake is chatty at INFO
+    logging.getLogger("disnake").setLevel(max(root.level, logging.WARNING))
+
+    change_log.filters = [ChangeRateLimiter(change_interval)]
+
+    listener.start()
+    return listener
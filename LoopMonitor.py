@@ -0,0 +1,275 @@
+import asyncio
+import collections
+import logging
+import os
+import signal
+import threading
+import time
+
+from Metrics import (
+    db_latency,
+    edit_latency,
+    on_message_latency,
+    process_latency,
+    registry,
+)
+
+log = logging.getLogger(__name__)
+
+loop_lag = registry.histogram(
+    "slowmode_loop_lag_seconds",
+    "How late the event loop woke up from a sleep",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+slow_callbacks = registry.counter(
+    "slowmode_slow_callbacks_total",
+    "Event loop callbacks that ran longer than the slow callback threshold",
+)
+
+
+def describe_callback(handle):
+    # Task steps and wakeups are bound to their Task, name them by coroutine
+    callback = handle._callback
+    owner = getattr(callback, "__self__", None)
+
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro()
+        return getattr(coro, "__qualname__", None) or repr(coro)
+
+    return getattr(callback, "__qualname__", None) or repr(callback)
+
+
+class LagMonitor:
+    # Sleeps interval seconds at a time and measures how much later than that
+    # the loop got back to it. Anything holding the loop shows up as lag.
+    # With slow_callback set, every callback the loop runs is also timed and
+    # the ones taking longer are logged by the coroutine they belong to. That
+    # wraps asyncio's Handle._run and costs every callback a little, so it is
+    # off unless asked for.
+    def __init__(self, interval=0.5, warn_after=0.25, slow_callback=0):
+        self.interval = interval
+        self.warn_after = warn_after
+        self.slow_callback = slow_callback
+
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.task = None
+        self.original_run = None
+
+    def start(self):
+        if self.interval and not self.task:
+            self.task = asyncio.create_task(self.run())
+
+        if self.slow_callback and not self.original_run:
+            self.install_callback_timer()
+
+    async def stop(self):
+        if self.original_run:
+            asyncio.events.Handle._run = self.original_run
+            self.original_run = None
+
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            loop_lag.observe(lag)
+
+            if self.warn_after and lag >= self.warn_after:
+                log.warning("Event loop lagged %.3fs", lag)
+
+    def install_callback_timer(self):
+        # asyncio only reports slow callbacks in debug mode, which costs far
+        # more than timing each Handle does
+        run = self.original_run = asyncio.events.Handle._run
+        threshold = self.slow_callback
+
+        def timed_run(handle):
+            started = time.perf_counter()
+            run(handle)
+            elapsed = time.perf_counter() - started
+
+            if elapsed >= threshold:
+                name = describe_callback(handle)
+                slow_callbacks.inc(callback=name)
+                log.warning("Slow callback %s took %.3fs", name, elapsed)
+
+        asyncio.events.Handle._run = timed_run
+
+
+def is_file(code, name):
+    return os.path.basename(code.co_filename) == name
+
+
+# Where samples are attributed. A sample counts towards every category with
+# a frame somewhere on its stack, so nested ones (on_message and the
+# permission checks it makes) overlap.
+CATEGORIES = (
+    ("on_message", lambda code: code.co_name == "on_message"),
+    (
+        "permission checks",
+        lambda code: code.co_name == "filter_message"
+        or is_file(code, "PermissionCache.py"),
+    ),
+    (
+        "process_messages",
+        lambda code: code.co_name == "process_messages"
+        and is_file(code, "ChannelMonitors.py"),
+    ),
+    ("DBInterface", lambda code: is_file(code, "DBInterface.py")),
+    (
+        "channel.edit",
+        lambda code: code.co_name in ("edit", "_edit")
+        and f"{os.sep}disnake{os.sep}" in code.co_filename
+        or code.co_name == "flush"
+        and is_file(code, "EditCoalescer.py")
+        or code.co_name == "send"
+        and is_file(code, "EditDispatcher.py"),
+    ),
+)
+
+
+def is_idle(code):
+    # The loop waiting on its selector for something to do
+    return is_file(code, "selectors.py") and code.co_name == "select"
+
+
+def function_name(code):
+    # co_qualname is only there from Python 3.11
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+# Wall clock time, awaits included, comes from the latency histograms
+TIMED = (
+    ("on_message", on_message_latency),
+    ("process_messages", process_latency),
+    ("DBInterface", db_latency),
+    ("channel.edit", edit_latency),
+)
+
+
+def histogram_totals(histogram):
+    # Labels -> (seconds, calls) observed so far
+    return {key: (data[1], data[2]) for key, data in histogram.values.items()}
+
+
+class SamplingProfiler:
+    # Samples the stack the event loop is running on a SIGALRM timer. The
+    # signal handler runs on the loop's own thread between bytecodes, so
+    # samples land wherever the loop really is; a sampling thread would only
+    # get the GIL, and so a look, when the loop is waiting on its selector.
+    # Nothing is installed outside of a profile being taken.
+    def __init__(self, interval=0.005, top=25):
+        self.interval = interval
+        self.top = top
+        self.running = False
+
+    async def profile(self, seconds):
+        # Samples for the given number of seconds and returns the report
+        if self.running:
+            raise RuntimeError("A profile is already being taken")
+        if not hasattr(signal, "setitimer"):
+            raise RuntimeError("Profiling needs signal.setitimer")
+        if threading.current_thread() is not threading.main_thread():
+            raise RuntimeError("Profiling needs the event loop on the main thread")
+
+        stats = {
+            "samples": 0,
+            "idle": 0,
+            "own": collections.Counter(),
+            "total": collections.Counter(),
+            "categories": collections.Counter(),
+        }
+        timed = [(name, histogram_totals(histogram)) for name, histogram in TIMED]
+
+        def sample(signum, frame):
+            self.sample(stats, frame)
+
+        self.running = True
+        previous = signal.signal(signal.SIGALRM, sample)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+            self.running = False
+
+        return self.report(stats, timed, seconds)
+
+    def sample(self, stats, frame):
+        stats["samples"] += 1
+
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+
+        if not stack or is_idle(stack[0]):
+            stats["idle"] += 1
+            return
+
+        stats["own"][stack[0]] += 1
+        stats["total"].update(set(stack))
+        for name, matches in CATEGORIES:
+            if any(matches(code) for code in stack):
+                stats["categories"][name] += 1
+
+    def report(self, stats, timed, seconds):
+        samples = max(stats["samples"], 1)
+
+        def line(count, name):
+            return f"{count:>7} {100 * count / samples:6.1f}%  {name}"
+
+        lines = [
+            f"Sampled the event loop {stats['samples']} times over {seconds}s",
+            line(stats["samples"] - stats["idle"], "busy"),
+            line(stats["idle"], "idle"),
+            "",
+            "Event loop time by category:",
+        ]
+        lines += [line(stats["categories"][name], name) for name, _ in CATEGORIES]
+
+        lines += ["", "Wall clock time over the profile, awaits included:"]
+        for (name, before), (_, histogram) in zip(timed, TIMED):
+            for key, (total, count) in histogram_totals(histogram).items():
+                total_before, count_before = before.get(key, (0.0, 0))
+                if count > count_before:
+                    labels = "".join(f" {value}" for _, value in key)
+                    lines.append(
+                        f"{total - total_before:>9.3f}s {count - count_before:>7} calls  {name}{labels}"
+                    )
+
+        for title, counter in (
+            ("Event loop time by function, own:", stats["own"]),
+            ("Event loop time by function, total:", stats["total"]),
+        ):
+            lines += ["", title]
+            lines += [
+                line(count, function_name(code))
+                for code, count in counter.most_common(self.top)
+            ]
+
+        return "\n".join(lines) + "\n"
+
+    async def profile_to_file(self, seconds, directory):
+        # For the signal handler, which has nowhere else to put the report
+        report = await self.profile(seconds)
+
+        os.makedirs(directory, exist_ok=True)
+        fp = os.path.join(directory, f"profile-{int(time.time())}.txt")
+        with open(fp, "w") as o:
+            o.write(report)
+
+        log.info("Wrote a %ss profile to %s", seconds, fp)
+        return fp
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+def spread(first, last, count):
+    # count timestamps evenly over first to last, standing in for ones folded away
+    if count == 1:
+        return [first]
+
+    step = (last - first) / (count - 1)
+    return [first + i * step for i in range(count)]
+
+
+class MessageDispatcher:
+    # Decouples on_message from slowmode processing. Timestamps are queued per
+    # channel and a fixed pool of workers drains each channel's queue as one batch,
+    # so a slow channel.edit only holds up its own channel. A full queue either
+    # drops its oldest timestamps or, with "merge", folds them into a count and
+    # the span they covered, which are spread back out when the batch is
+    # processed. Estimators that count messages then see all of them.
+    OVERFLOW_POLICIES = ("drop_oldest", "merge")
+
+    def __init__(self, monitors, workers=4, max_pending=100, overflow="drop_oldest"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+
+        self.monitors = monitors
+        self.workers = workers
+        self.max_pending = max_pending
+        self.overflow = overflow
+
+        # channel_id -> deque of timestamps, and the latest channel object seen
+        self.pending = {}
+        self.channels = {}
+
+        # channel_id -> [first, last, count] of the timestamps merged away
+        self.folded = {}
+
+        # Channels being processed right now are never handed to a second worker
+        self.active = set()
+        self.ready = asyncio.Queue()
+        self.tasks = []
+
+        self.overflowed = 0
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [
+                asyncio.create_task(self.worker()) for _ in range(self.workers)
+            ]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def queue_depth(self):
+        return sum(len(p) for p in self.pending.values())
+
+    def submit(self, channel, timestamp):
+        pending = self.pending.get(channel.id)
+
+        if pending is None:
+            pending = self.pending[channel.id] = deque()
+            if channel.id not in self.active:
+                self.ready.put_nowait(channel.id)
+
+        self.channels[channel.id] = channel
+
+        if len(pending) >= self.max_pending:
+            self.overflowed += 1
+            oldest = pending.popleft()
+
+            if self.overflow == "merge":
+                folded = self.folded.get(channel.id)
+                if folded is None:
+                    self.folded[channel.id] = [oldest, oldest, 1]
+                else:
+                    folded[1] = oldest
+                    folded[2] += 1
+
+        pending.append(timestamp)
+
+    async def worker(self):
+        while True:
+            channel_id = await self.ready.get()
+
+            timestamps = self.pending.pop(channel_id, None)
+            channel = self.channels.pop(channel_id, None)
+            folded = self.folded.pop(channel_id, None)
+
+            if not timestamps:
+                continue
+
+            if folded:
+                timestamps = spread(*folded) + list(timestamps)
+
+            self.active.add(channel_id)
+            try:
+                await self.monitors.process_messages(channel, timestamps)
+            except Exception as e:
+                log.error("Processing messages failed", exc_info=e)
+            finally:
+                self.active.discard(channel_id)
+
+            # Anything that arrived while we were busy goes to the back of the line
+            if channel_id in self.pending:
+                self.ready.put_nowait(channel_id)
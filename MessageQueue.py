@@ -1,14 +1,38 @@
+import math
+
 from ChannelConfigObject import ChannelConfigObject
+from RateEstimators import ESTIMATORS
 
 
 class MessageQueue:
-    def __init__(self, slowmode_min, slowmode_max, cache_size, sensitivity):
+    __slots__ = (
+        "slowmode_min",
+        "slowmode_max",
+        "cache_size",
+        "sensitivity",
+        "edit_interval",
+        "hysteresis",
+        "estimator",
+    )
+
+    def __init__(
+        self,
+        slowmode_min,
+        slowmode_max,
+        cache_size,
+        sensitivity,
+        edit_interval=5,
+        hysteresis=1,
+        estimator="count",
+    ):
         self.slowmode_min = slowmode_min
         self.slowmode_max = slowmode_max
         self.cache_size = cache_size
         self.sensitivity = sensitivity
+        self.edit_interval = edit_interval
+        self.hysteresis = hysteresis
 
-        self.message_timestamp_queue = []
+        self.estimator = ESTIMATORS[estimator](cache_size, sensitivity * 10)
 
     @classmethod
     def from_config(cls, config):
@@ -17,6 +41,9 @@ class MessageQueue:
             config.slowmode_max,
             config.cache_size,
             config.sensitivity,
+            config.edit_interval,
+            config.hysteresis,
+            config.estimator,
         )
 
     def to_config(self, channel, monitoring):
@@ -28,6 +55,9 @@ class MessageQueue:
             self.cache_size,
             self.sensitivity,
             monitoring,
+            self.edit_interval,
+            self.hysteresis,
+            self.estimator.name,
         )
 
     def set_bounds(self, slowmode_min, slowmode_max):
@@ -36,38 +66,66 @@ class MessageQueue:
 
     def set_cache_size(self, cache_size):
         self.cache_size = cache_size
+        self.estimator.configure(cache_size, self.sensitivity * 10)
 
     def set_sensitivity(self, sensitivity):
         self.sensitivity = sensitivity
+        self.estimator.configure(self.cache_size, sensitivity * 10)
+
+    def set_edit_settings(self, edit_interval, hysteresis):
+        self.edit_interval = edit_interval
+        self.hysteresis = hysteresis
+
+    def set_estimator(self, estimator):
+        if estimator == self.estimator.name:
+            return
+
+        # Carry over whatever history the old estimator can give us
+        new_estimator = ESTIMATORS[estimator](self.cache_size, self.sensitivity * 10)
+        for timestamp in self.estimator.get_timestamps():
+            new_estimator.add(timestamp)
+
+        self.estimator = new_estimator
+
+    def get_timestamps(self):
+        return self.estimator.get_timestamps()
+
+    def prefill(self, timestamps, live=None):
+        # Rebuilds the estimator from older history followed by the messages
+        # seen live, which history overlapping them can't be added under
+        live = self.get_timestamps() if live is None else live
+        oldest = live[0] if live else math.inf
+
+        estimator = ESTIMATORS[self.estimator.name](
+            self.cache_size, self.sensitivity * 10
+        )
+        for timestamp in sorted(t for t in timestamps if t < oldest)[
+            -self.cache_size :
+        ]:
+            estimator.add(timestamp)
+        for timestamp in live:
+            estimator.add(timestamp)
+
+        self.estimator = estimator
 
     def add_message(self, timestamp):
-        # Add new message timestamp to the queue, pruning if over cache size
+        # Add new message timestamp to the rate estimator
         # Exempt checks are done outside current scope before this is called
-        self.message_timestamp_queue.append(timestamp)
+        self.estimator.add(timestamp)
 
-        while len(self.message_timestamp_queue) > self.cache_size:
-            self.message_timestamp_queue.pop(0)
-
-    def calculate_optimal_slowmode(self):
+    def calculate_optimal_slowmode(self, now=None):
         target_spm = self.sensitivity * 10
 
-        delays = []
-
         optimal_slowmode = None
 
-        if len(self.message_timestamp_queue) > 1:
-            # Get list of delays between messages
-            for i in range(len(self.message_timestamp_queue) - 1):
-                delays.append(
-                    (
-                        self.message_timestamp_queue[i + 1]
-                        - self.message_timestamp_queue[i]
-                    ).total_seconds()
-                )
-
-            # Get average seconds per message
-            average_spm = sum(delays) / len(delays)
+        # Get average seconds per message, counting the silence since the
+        # last message when asked for the slowmode as of now
+        if now is None:
+            average_spm = self.estimator.seconds_per_message()
+        else:
+            average_spm = self.estimator.idle_seconds_per_message(now)
 
+        if average_spm is not None:
             # Panic if we get a zero somehow
             if average_spm == 0:
                 return None
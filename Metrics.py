@@ -0,0 +1,222 @@
+import asyncio
+import bisect
+import functools
+import time
+
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+)
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+
+    def header(self):
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, description):
+        super().__init__(name, description)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        return self.header() + [
+            f"{self.name}{format_labels(k)} {v}" for k, v in self.values.items()
+        ]
+
+
+class Gauge(Metric):
+    # Gauges read their value from a callback at scrape time, so the hot path
+    # never has to keep them up to date
+    kind = "gauge"
+
+    def __init__(self, name, description, func, kind=None):
+        super().__init__(name, description)
+        self.func = func
+        if kind:
+            self.kind = kind
+
+    def render(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+
+        return self.header() + [f"{self.name} {value}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        data = self.values.get(key)
+
+        if data is None:
+            # Per-bucket counts, then the running sum and total count
+            data = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    def time(self, **labels):
+        return HistogramTimer(self, labels)
+
+    def render(self):
+        lines = self.header()
+
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"{self.name}_bucket{format_labels(key, (('le', bound),))} {cumulative}"
+                )
+
+            lines.append(
+                f"{self.name}_bucket{format_labels(key, (('le', '+Inf'),))} {count}"
+            )
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+
+        return lines
+
+
+class HistogramTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        # Registering the same name twice hands back the existing metric
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description):
+        return self.register(Counter(name, description))
+
+    def gauge(self, name, description, func, kind=None):
+        metric = Gauge(name, description, func, kind)
+        self.metrics[name] = metric
+        return metric
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+db_latency = registry.histogram(
+    "slowmode_db_seconds", "Time spent in DBInterface methods"
+)
+process_latency = registry.histogram(
+    "slowmode_process_seconds", "Time spent in ChannelMonitors.process_messages"
+)
+on_message_latency = registry.histogram(
+    "slowmode_on_message_seconds", "Time spent in the on_message filters by outcome"
+)
+on_message_results = registry.counter(
+    "slowmode_on_message_total",
+    "Messages seen by on_message by the stage they stopped at",
+)
+edit_latency = registry.histogram(
+    "slowmode_edit_seconds", "Time spent in channel.edit calls"
+)
+edit_results = registry.counter("slowmode_edits_total", "channel.edit calls by result")
+edit_retries = registry.counter(
+    "slowmode_edit_retries_total", "channel.edit calls retried after a 429"
+)
+
+
+def timed(histogram, **labels):
+    # Decorator for coroutine methods, observing how long each call takes
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+async def start_metrics_server(port, host="127.0.0.1", metrics=registry):
+    # Minimal HTTP endpoint serving the registry in Prometheus text format
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+
+        body = metrics.render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n".encode()
+            + b"Connection: close\r\n\r\n"
+            + body
+        )
+
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
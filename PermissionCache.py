@@ -0,0 +1,80 @@
+class PermissionCache:
+    # Caches the two permission checks on_message needs. The bot's own result
+    # is cached per channel and authors are cached per channel and role set,
+    # since that is all the overwrite resolution depends on for most members.
+    def __init__(self, max_entries_per_channel=256):
+        self.max_entries_per_channel = max_entries_per_channel
+
+        # channel_id -> {key: bool}, and guild_id -> set of cached channel_ids
+        self.channels = {}
+        self.guilds = {}
+
+    def get_entries(self, channel):
+        entries = self.channels.get(channel.id)
+
+        if entries is None:
+            entries = self.channels[channel.id] = {}
+            self.guilds.setdefault(channel.guild.id, set()).add(channel.id)
+
+            # Members with their own overwrite can't share a role-set entry.
+            # _overwrites is the raw list permissions_for resolves against.
+            entries["member_overwrites"] = frozenset(
+                o.id for o in channel._overwrites if o.is_member()
+            )
+
+        return entries
+
+    def lookup(self, entries, key, compute):
+        try:
+            return entries[key]
+        except KeyError:
+            pass
+
+        if len(entries) >= self.max_entries_per_channel:
+            member_overwrites = entries["member_overwrites"]
+            entries.clear()
+            entries["member_overwrites"] = member_overwrites
+
+        value = entries[key] = compute()
+        return value
+
+    def can_manage_channel(self, channel):
+        entries = self.get_entries(channel)
+
+        return self.lookup(
+            entries,
+            "me",
+            lambda: channel.permissions_for(channel.guild.me).manage_channels,
+        )
+
+    def bypasses_slowmode(self, channel, member):
+        entries = self.get_entries(channel)
+        roles = getattr(member, "_roles", None)
+
+        # Non-members and timed out members resolve differently, so they bypass it too
+        if (
+            roles is None
+            or member.id == channel.guild.owner_id
+            or member.id in entries["member_overwrites"]
+            or member.current_timeout
+        ):
+            return channel.permissions_for(member).manage_messages
+
+        # _roles is disnake's sorted snowflake array, so it makes a stable key
+        # without building Role objects
+        return self.lookup(
+            entries,
+            tuple(roles),
+            lambda: channel.permissions_for(member).manage_messages,
+        )
+
+    def invalidate_channel(self, channel):
+        self.channels.pop(channel.id, None)
+
+        guild_channels = self.guilds.get(channel.guild.id)
+        if guild_channels is not None:
+            guild_channels.discard(channel.id)
+
+    def invalidate_guild(self, guild_id):
+        for channel_id in self.guilds.pop(guild_id, ()):
+            self.channels.pop(channel_id, None)
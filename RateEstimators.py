@@ -0,0 +1,264 @@
+from array import array
+from collections import deque
+
+
+class RateEstimator:
+    # Estimates a channel's average seconds per message from its timestamps,
+    # which are epoch seconds as floats. cache_size and target_spm
+    # (sensitivity * 10) come from the channel config.
+    __slots__ = ("cache_size", "target_spm")
+
+    name = None
+
+    def __init__(self, cache_size, target_spm):
+        self.cache_size = cache_size
+        self.target_spm = target_spm
+
+    def configure(self, cache_size, target_spm):
+        self.cache_size = cache_size
+        self.target_spm = target_spm
+
+    def add(self, timestamp):
+        raise NotImplementedError
+
+    def seconds_per_message(self):
+        raise NotImplementedError
+
+    def idle_seconds_per_message(self, now):
+        # The estimate as of now rather than the last message, so that it
+        # keeps rising while a channel is quiet
+        return self.seconds_per_message()
+
+    def get_timestamps(self):
+        # Timestamps worth carrying over when the estimator is swapped
+        return []
+
+    def dump(self):
+        # State as a flat list of floats, for the warm-start snapshot
+        return self.get_timestamps()
+
+    def load(self, values, cutoff):
+        # Restore dump() output, skipping timestamps older than cutoff
+        for value in values:
+            if value >= cutoff:
+                self.add(value)
+
+
+class CountWindowEstimator(RateEstimator):
+    # Average gap over the last cache_size messages, however old they are
+    __slots__ = ("timestamps", "head", "count")
+
+    name = "count"
+
+    def __init__(self, cache_size, target_spm):
+        super().__init__(cache_size, target_spm)
+
+        # Fixed-size ring buffer of timestamps, oldest entry at self.head
+        self.timestamps = array("d", bytes(8 * cache_size))
+        self.head = 0
+        self.count = 0
+
+    def configure(self, cache_size, target_spm):
+        # Keep the newest timestamps that still fit and rebuild the buffer around them
+        timestamps = self.get_timestamps()[-cache_size:] if cache_size > 0 else []
+
+        super().configure(cache_size, target_spm)
+
+        self.timestamps = array("d", bytes(8 * cache_size))
+        self.timestamps[: len(timestamps)] = array("d", timestamps)
+        self.head = 0
+        self.count = len(timestamps)
+
+    def get_timestamps(self):
+        # Queued timestamps from oldest to newest
+        return [
+            self.timestamps[(self.head + i) % self.cache_size]
+            for i in range(self.count)
+        ]
+
+    def add(self, timestamp):
+        if self.cache_size < 1:
+            return
+
+        if self.count == self.cache_size:
+            self.timestamps[self.head] = timestamp
+            self.head = (self.head + 1) % self.cache_size
+        else:
+            self.timestamps[(self.head + self.count) % self.cache_size] = timestamp
+            self.count += 1
+
+    def seconds_per_message(self):
+        if self.count < 2:
+            return None
+
+        # The gaps between consecutive timestamps telescope, so their sum is
+        # just the span of the buffer
+        newest = self.timestamps[(self.head + self.count - 1) % self.cache_size]
+        oldest = self.timestamps[self.head]
+
+        return (newest - oldest) / (self.count - 1)
+
+    def idle_seconds_per_message(self, now):
+        if not self.count:
+            return None
+
+        # As if a message arrived now, which only ever lengthens the average
+        average = self.seconds_per_message() or 0.0
+        return max(average, (now - self.timestamps[self.head]) / self.count)
+
+
+class EWMAEstimator(RateEstimator):
+    # Exponentially weighted average gap in constant memory. The smoothing
+    # matches a cache_size-message window, and gaps shorter than the average
+    # are weighted twice as heavily so bursts register within a few messages.
+    __slots__ = ("last_timestamp", "average")
+
+    name = "ewma"
+
+    def __init__(self, cache_size, target_spm):
+        super().__init__(cache_size, target_spm)
+
+        self.last_timestamp = None
+        self.average = None
+
+    def alpha(self, gap):
+        alpha = 2 / (self.cache_size + 1)
+
+        if gap < self.average:
+            alpha = min(1.0, alpha * 2)
+
+        return alpha
+
+    def add(self, timestamp):
+        if self.last_timestamp is not None:
+            gap = timestamp - self.last_timestamp
+
+            if self.average is None:
+                self.average = gap
+            else:
+                self.average += self.alpha(gap) * (gap - self.average)
+
+        self.last_timestamp = timestamp
+
+    def seconds_per_message(self):
+        return self.average
+
+    def idle_seconds_per_message(self, now):
+        if self.last_timestamp is None:
+            return None
+
+        gap = now - self.last_timestamp
+        if self.average is None:
+            return gap
+
+        # The update the current silence would make, if it is longer than usual
+        if gap <= self.average:
+            return self.average
+
+        return self.average + self.alpha(gap) * (gap - self.average)
+
+    def get_timestamps(self):
+        return [self.last_timestamp] if self.last_timestamp is not None else []
+
+    def dump(self):
+        if self.last_timestamp is None:
+            return []
+
+        return [self.last_timestamp, self.average or 0.0]
+
+    def load(self, values, cutoff):
+        if len(values) != 2 or values[0] < cutoff:
+            return
+
+        self.last_timestamp = values[0]
+        self.average = values[1] or None
+
+
+class SlidingTimeWindowEstimator(RateEstimator):
+    # Message rate over a fixed span of time rather than a fixed number of
+    # messages. The window is the time cache_size messages take at the target
+    # rate, so stale messages stop counting after a quiet spell.
+    __slots__ = ("timestamps", "first_timestamp")
+
+    name = "window"
+
+    # Hard cap on retained timestamps so a raid can't grow the window unbounded
+    MAX_MESSAGES = 1000
+
+    def __init__(self, cache_size, target_spm):
+        super().__init__(cache_size, target_spm)
+
+        self.timestamps = deque(maxlen=self.MAX_MESSAGES)
+        self.first_timestamp = None
+
+    def window(self):
+        return self.cache_size * self.target_spm
+
+    def get_timestamps(self):
+        return list(self.timestamps)
+
+    def dump(self):
+        if self.first_timestamp is None:
+            return []
+
+        return [self.first_timestamp] + self.get_timestamps()
+
+    def load(self, values, cutoff):
+        if len(values) < 2:
+            return
+
+        # first_timestamp only matters while less than one window has passed
+        self.first_timestamp = values[0]
+        super().load(values[1:], cutoff)
+
+    def add(self, timestamp):
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+
+        self.timestamps.append(timestamp)
+
+        cutoff = timestamp - self.window()
+        while self.timestamps and self.timestamps[0] <= cutoff:
+            self.timestamps.popleft()
+
+    def seconds_per_message(self):
+        count = len(self.timestamps)
+        if not count:
+            return None
+
+        newest = self.timestamps[-1]
+        window = self.window()
+
+        # Until a full window has been observed, or once the cap is hit, the
+        # retained span is the best measure we have
+        if newest - self.first_timestamp < window or count == self.MAX_MESSAGES:
+            if count < 2:
+                return None
+
+            return (newest - self.timestamps[0]) / (count - 1)
+
+        return window / count
+
+    def idle_seconds_per_message(self, now):
+        if self.first_timestamp is None:
+            return None
+
+        window = self.window()
+        live = [timestamp for timestamp in self.timestamps if timestamp > now - window]
+
+        # Nothing left in the window counts as one message per window
+        if not live:
+            return window
+
+        if now - self.first_timestamp < window:
+            idle_average = (now - live[0]) / len(live)
+        else:
+            idle_average = window / len(live)
+
+        return max(self.seconds_per_message() or 0.0, idle_average)
+
+
+ESTIMATORS = {
+    estimator.name: estimator
+    for estimator in (CountWindowEstimator, EWMAEstimator, SlidingTimeWindowEstimator)
+}
@@ -0,0 +1,445 @@
+import asyncio
+import logging
+import math
+import mmap
+import os
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+# channel_id, timestamp, seconds per message (NaN when unknown),
+# slowmode (-1 when none) and whether an edit was made, padded to 32 bytes
+SAMPLE = struct.Struct("<qddiB3x")
+
+# Rollup name -> bucket width in seconds
+ROLLUPS = {"1m": 60, "1h": 3600}
+
+# Rollup name -> seconds of buckets kept together in one file, and how many
+# days of files are kept by default
+ROLLUP_SPANS = {"1m": 3600, "1h": 86400}
+KEEP_ROLLUP_DAYS = {"1m": 7, "1h": 365}
+
+# Holds the newest raw segment already merged into the rollup files
+ROLLUP_STATE = "rollups.state"
+
+if np is not None:
+    SAMPLE_DTYPE = np.dtype(
+        {
+            "names": ["channel_id", "timestamp", "rate", "slowmode", "edited"],
+            "formats": ["<i8", "<f8", "<f8", "<i4", "u1"],
+            "offsets": [0, 8, 16, 24, 28],
+            "itemsize": SAMPLE.size,
+        }
+    )
+
+    # rate_sum / rate_count is the bucket's mean seconds per message; keeping
+    # the two apart lets partial buckets from neighbouring segments be merged
+    ROLLUP_DTYPE = np.dtype(
+        [
+            ("channel_id", "<i8"),
+            ("start", "<f8"),
+            ("samples", "<u4"),
+            ("edits", "<u4"),
+            ("rate_sum", "<f8"),
+            ("rate_count", "<u4"),
+            ("rate_min", "<f8"),
+            ("rate_max", "<f8"),
+            ("slowmode_max", "<i4"),
+            ("slowmode_last", "<i4"),
+        ]
+    )
+
+
+class Recorder:
+    # Append-only history of every slowmode decision. Samples are packed into
+    # fixed-width records in a memory-mapped segment file, so recording one is
+    # a single struct.pack_into. Segments are closed once full or every
+    # rollup_interval, whichever comes first, and rolled up in a background
+    # thread into 1 minute and 1 hour buckets. Those are merged into one file
+    # per hour and per day respectively, of which keep_rollup_days are kept;
+    # only the newest keep_segments raw segments are kept once rolled up.
+    # Creating, flushing and trimming segment files happens in worker threads
+    # too, with the next segment opened ahead of time.
+    def __init__(
+        self,
+        path,
+        segment_records=65536,
+        rollup_interval=300,
+        keep_segments=48,
+        keep_rollup_days=None,
+    ):
+        self.path = path
+        self.segment_records = segment_records
+        self.rollup_interval = rollup_interval
+        self.keep_segments = keep_segments
+        self.keep_rollup_days = {**KEEP_ROLLUP_DAYS, **(keep_rollup_days or {})}
+
+        os.makedirs(path, exist_ok=True)
+
+        # Raw segments can all be gone, rolled up and pruned
+        segments = list_segments(path, "raw")
+        self.seq = max(segments[-1] if segments else 0, read_rollup_state(path))
+
+        self.file = None
+        self.mm = None
+        self.offset = 0
+        self.task = None
+
+        # (seq, file, mm) of the segment opened ahead of time, and the seq
+        # being opened in a worker thread right now
+        self.spare = None
+        self.preparing = None
+
+        # Segments being flushed and trimmed in worker threads
+        self.closing = set()
+
+    def start(self):
+        if np is None:
+            log.warning("numpy isn't installed, recorder rollups are disabled")
+            return
+
+        if self.rollup_interval and not self.task:
+            self.task = asyncio.create_task(self.run_rollups())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+        self.retire_segment()
+        if self.spare is not None:
+            seq, file, mm = self.spare
+            self.spare = None
+            await asyncio.to_thread(discard_segment, self.path, seq, file, mm)
+
+        await asyncio.gather(*self.closing)
+
+    def next_segment(self):
+        # The current segment is full or there is none yet. The spare is
+        # normally ready; opening one here blocks the event loop.
+        self.retire_segment()
+
+        if self.spare is not None:
+            self.seq, self.file, self.mm = self.spare
+            self.spare = None
+        else:
+            # Skips the seq a worker thread may be opening right now
+            self.seq = max(self.seq, self.preparing or 0) + 1
+            self.file, self.mm = open_segment(self.path, self.seq, self.segment_records)
+
+        self.offset = 0
+
+    def retire_segment(self):
+        # Hands the current segment to a worker thread to flush and trim
+        if self.mm is None:
+            return
+
+        future = asyncio.get_running_loop().run_in_executor(
+            None, close_segment, self.file, self.mm, self.offset
+        )
+        self.closing.add(future)
+        future.add_done_callback(self.closing.discard)
+
+        self.mm = None
+        self.file = None
+
+    async def prepare_spare(self):
+        if self.spare is not None or self.preparing is not None:
+            return
+
+        seq = self.preparing = self.seq + 1
+        try:
+            file, mm = await asyncio.to_thread(
+                open_segment, self.path, seq, self.segment_records
+            )
+        finally:
+            self.preparing = None
+
+        if seq > self.seq:
+            self.spare = (seq, file, mm)
+        else:
+            # record couldn't wait and opened one itself
+            await asyncio.to_thread(discard_segment, self.path, seq, file, mm)
+
+    def record(self, channel_id, timestamp, rate, slowmode, edited):
+        if self.mm is None or self.offset >= len(self.mm):
+            self.next_segment()
+
+        SAMPLE.pack_into(
+            self.mm,
+            self.offset,
+            channel_id,
+            timestamp,
+            math.nan if rate is None else rate,
+            -1 if slowmode is None else slowmode,
+            bool(edited),
+        )
+        self.offset += SAMPLE.size
+
+    async def run_rollups(self):
+        while True:
+            await asyncio.sleep(self.rollup_interval)
+
+            try:
+                # A quiet bot could take days to fill a segment, so the one
+                # being written is closed each time to keep the rollups current
+                if self.mm is not None and self.offset:
+                    self.retire_segment()
+
+                await self.prepare_spare()
+                await asyncio.gather(*self.closing)
+                await asyncio.to_thread(self.rollup_segments, self.active_segment())
+            except Exception as e:
+                log.error("Recorder rollup failed", exc_info=e)
+
+    def active_segment(self):
+        # The segment records are going into, or would open next
+        return self.seq if self.mm is not None else self.seq + 1
+
+    def rollup_segments(self, active=None):
+        # Runs off the event loop. The segment being written and the spare are
+        # never touched; one closed after this started is picked up next time.
+        if active is None:
+            active = self.active_segment()
+
+        segments = [seq for seq in list_segments(self.path, "raw") if seq < active]
+        done = read_rollup_state(self.path)
+
+        for seq in segments:
+            if seq <= done:
+                continue
+
+            samples = read_segment(segment_path(self.path, "raw", seq))
+            for name, seconds in ROLLUPS.items():
+                merge_into_files(self.path, name, rollup(samples, seconds))
+
+            # Only recorded once merged; a crash in between would count this
+            # segment twice, not lose it
+            write_rollup_state(self.path, seq)
+
+        for name, days in self.keep_rollup_days.items():
+            prune_rollups(self.path, name, days)
+
+        for seq in segments[: max(0, len(segments) - self.keep_segments)]:
+            os.remove(segment_path(self.path, "raw", seq))
+
+
+def segment_path(path, kind, seq):
+    return os.path.join(path, f"{kind}-{seq:010d}.seg")
+
+
+def open_segment(path, seq, records):
+    size = records * SAMPLE.size
+    fp = segment_path(path, "raw", seq)
+
+    with open(fp, "wb") as o:
+        o.truncate(size)
+
+    file = open(fp, "r+b")
+    return file, mmap.mmap(file.fileno(), size)
+
+
+def close_segment(file, mm, offset):
+    mm.flush()
+    mm.close()
+
+    # Segments closed early only take up what was written
+    file.truncate(offset)
+    file.close()
+
+
+def discard_segment(path, seq, file, mm):
+    close_segment(file, mm, 0)
+    os.remove(segment_path(path, "raw", seq))
+
+
+def read_rollup_state(path):
+    try:
+        with open(os.path.join(path, ROLLUP_STATE)) as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return 0
+
+
+def write_rollup_state(path, seq):
+    fp = os.path.join(path, ROLLUP_STATE)
+    with open(fp + ".tmp", "w") as o:
+        o.write(str(seq))
+    os.replace(fp + ".tmp", fp)
+
+
+def list_segments(path, kind):
+    seqs = []
+
+    for name in os.listdir(path):
+        prefix, _, rest = name.partition("-")
+        if prefix == kind and rest.endswith(".seg"):
+            seqs.append(int(rest[:-4]))
+
+    return sorted(seqs)
+
+
+def read_segment(fp):
+    # Unwritten records at the end of a segment are all zeroes
+    samples = np.fromfile(fp, SAMPLE_DTYPE)
+    return samples[samples["timestamp"] > 0]
+
+
+def write_rollup(fp, rows):
+    tmp = fp + ".tmp"
+    rows.tofile(tmp)
+    os.replace(tmp, fp)
+
+
+def merge_into_files(path, name, rows):
+    # Rollup files are numbered by bucket start // ROLLUP_SPANS[name]; new rows
+    # are merged into the file covering them, after its existing rows
+    files = np.floor(rows["start"] / ROLLUP_SPANS[name]).astype(np.int64)
+
+    for index in np.unique(files):
+        fp = segment_path(path, name, int(index))
+        new = rows[files == index]
+
+        if os.path.exists(fp):
+            new = np.concatenate((np.fromfile(fp, ROLLUP_DTYPE), new))
+
+        write_rollup(fp, merge_rollups(new))
+
+
+def prune_rollups(path, name, days):
+    # Keeps the files covering the newest days of recorded time
+    files = list_segments(path, name)
+    if not files:
+        return
+
+    keep = math.ceil(days * 86400 / ROLLUP_SPANS[name])
+    for index in files:
+        if index <= files[-1] - keep:
+            os.remove(segment_path(path, name, index))
+
+
+def group_starts(channel_ids, starts):
+    # Index of the first row of each (channel_id, start) run in sorted rows
+    if not len(channel_ids):
+        return np.zeros(0, dtype=np.intp)
+
+    changed = (np.diff(channel_ids) != 0) | (np.diff(starts) != 0)
+    return np.concatenate(([0], np.flatnonzero(changed) + 1))
+
+
+def rollup(samples, seconds):
+    starts = np.floor(samples["timestamp"] / seconds) * seconds
+
+    order = np.lexsort((samples["timestamp"], starts, samples["channel_id"]))
+    samples, starts = samples[order], starts[order]
+
+    index = group_starts(samples["channel_id"], starts)
+    rows = np.zeros(len(index), ROLLUP_DTYPE)
+    if not len(index):
+        return rows
+
+    rate = samples["rate"]
+    known = ~np.isnan(rate)
+
+    rows["channel_id"] = samples["channel_id"][index]
+    rows["start"] = starts[index]
+    rows["samples"] = np.diff(np.append(index, len(samples)))
+    rows["edits"] = np.add.reduceat(samples["edited"].astype(np.uint32), index)
+    rows["rate_sum"] = np.add.reduceat(np.where(known, rate, 0.0), index)
+    rows["rate_count"] = np.add.reduceat(known.astype(np.uint32), index)
+    rows["rate_min"] = np.minimum.reduceat(np.where(known, rate, np.inf), index)
+    rows["rate_max"] = np.maximum.reduceat(np.where(known, rate, -np.inf), index)
+    rows["slowmode_max"] = np.maximum.reduceat(samples["slowmode"], index)
+    rows["slowmode_last"] = samples["slowmode"][np.append(index[1:], len(samples)) - 1]
+
+    return rows
+
+
+def merge_rollups(rows):
+    # Buckets split across segments are combined; lexsort is stable, so the
+    # last row of each group still comes from the newest segment
+    order = np.lexsort((rows["start"], rows["channel_id"]))
+    rows = rows[order]
+
+    index = group_starts(rows["channel_id"], rows["start"])
+    merged = np.zeros(len(index), ROLLUP_DTYPE)
+    if not len(index):
+        return merged
+
+    merged["channel_id"] = rows["channel_id"][index]
+    merged["start"] = rows["start"][index]
+    for name in ("samples", "edits", "rate_sum", "rate_count"):
+        merged[name] = np.add.reduceat(rows[name], index)
+    merged["rate_min"] = np.minimum.reduceat(rows["rate_min"], index)
+    merged["rate_max"] = np.maximum.reduceat(rows["rate_max"], index)
+    merged["slowmode_max"] = np.maximum.reduceat(rows["slowmode_max"], index)
+    merged["slowmode_last"] = rows["slowmode_last"][np.append(index[1:], len(rows)) - 1]
+
+    return merged
+
+
+def select(rows, time_field, channel_id, start, end):
+    mask = np.ones(len(rows), dtype=bool)
+
+    if channel_id is not None:
+        mask &= rows["channel_id"] == channel_id
+    if start is not None:
+        mask &= rows[time_field] >= start
+    if end is not None:
+        mask &= rows[time_field] < end
+
+    return rows[mask]
+
+
+def read_samples(path, channel_id=None, start=None, end=None):
+    # Raw samples still on disk as a structured array of SAMPLE_DTYPE
+    samples = [
+        select(
+            read_segment(segment_path(path, "raw", seq)),
+            "timestamp",
+            channel_id,
+            start,
+            end,
+        )
+        for seq in list_segments(path, "raw")
+    ]
+
+    if not samples:
+        return np.zeros(0, SAMPLE_DTYPE)
+
+    return np.concatenate(samples)
+
+
+def read_rollups(path, resolution="1m", channel_id=None, start=None, end=None):
+    # Rolled up buckets as a structured array of ROLLUP_DTYPE, sorted by
+    # channel then bucket start
+    if resolution not in ROLLUPS:
+        raise ValueError(f"Unknown rollup resolution: {resolution}")
+
+    # Files entirely outside start to end aren't opened
+    span = ROLLUP_SPANS[resolution]
+    first = -math.inf if start is None else start // span
+    last = math.inf if end is None else end // span
+
+    rows = [
+        select(
+            np.fromfile(segment_path(path, resolution, index), ROLLUP_DTYPE),
+            "start",
+            channel_id,
+            start,
+            end,
+        )
+        for index in list_segments(path, resolution)
+        if first <= index <= last
+    ]
+
+    if not rows:
+        return np.zeros(0, ROLLUP_DTYPE)
+
+    return merge_rollups(np.concatenate(rows))
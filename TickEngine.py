@@ -0,0 +1,167 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class TickEngine:
+    # Batch alternative to per-message recalculation. Every channel's message
+    # timestamps live in one set of NumPy arrays indexed by a slot, and all
+    # targets are recomputed together once per tick. Only count-window
+    # statistics are kept, matching the "count" estimator.
+    MAX_CACHE_SIZE = 50
+
+    def __init__(self, capacity=1024):
+        if np is None:
+            raise RuntimeError("The tick engine requires numpy to be installed.")
+
+        self.capacity = 0
+        self.slots = {}
+        self.free_slots = []
+
+        self.timestamps = np.zeros((0, self.MAX_CACHE_SIZE), dtype=np.float64)
+        self.head = np.zeros(0, dtype=np.int32)
+        self.count = np.zeros(0, dtype=np.int32)
+        self.cache_size = np.zeros(0, dtype=np.int32)
+        self.target_spm = np.zeros(0, dtype=np.float64)
+        self.slowmode_min = np.zeros(0, dtype=np.int64)
+        self.slowmode_max = np.zeros(0, dtype=np.int64)
+        self.last_target = np.zeros(0, dtype=np.int64)
+        self.channel_ids = np.zeros(0, dtype=np.int64)
+        self.in_use = np.zeros(0, dtype=bool)
+
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        extra = capacity - self.capacity
+
+        self.timestamps = np.vstack(
+            (self.timestamps, np.zeros((extra, self.MAX_CACHE_SIZE)))
+        )
+        for name in (
+            "head",
+            "count",
+            "cache_size",
+            "target_spm",
+            "slowmode_min",
+            "slowmode_max",
+            "last_target",
+            "channel_ids",
+            "in_use",
+        ):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate((array, np.zeros(extra, array.dtype))))
+
+        self.free_slots.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def has_channel(self, channel_id):
+        return channel_id in self.slots
+
+    def add_channel(self, channel_id, q):
+        if channel_id in self.slots:
+            return
+
+        if not self.free_slots:
+            self.grow(self.capacity * 2)
+
+        slot = self.free_slots.pop()
+        self.slots[channel_id] = slot
+
+        self.channel_ids[slot] = channel_id
+        self.in_use[slot] = True
+        self.head[slot] = 0
+        self.count[slot] = 0
+        self.last_target[slot] = -1
+        self.configure(channel_id, q)
+
+    def remove_channel(self, channel_id):
+        slot = self.slots.pop(channel_id, None)
+
+        if slot is not None:
+            self.in_use[slot] = False
+            self.count[slot] = 0
+            self.free_slots.append(slot)
+
+    def configure(self, channel_id, q):
+        slot = self.slots[channel_id]
+        cache_size = max(1, min(q.cache_size, self.MAX_CACHE_SIZE))
+
+        if cache_size != self.cache_size[slot]:
+            # Re-pack the ring keeping the newest timestamps that still fit
+            kept = self.get_timestamps(channel_id)[-cache_size:]
+            self.timestamps[slot, : len(kept)] = kept
+            self.head[slot] = 0
+            self.count[slot] = len(kept)
+            self.cache_size[slot] = cache_size
+
+        self.target_spm[slot] = q.sensitivity * 10
+        self.slowmode_min[slot] = q.slowmode_min or 0
+        self.slowmode_max[slot] = q.slowmode_max or 0
+
+    def get_timestamps(self, channel_id):
+        slot = self.slots[channel_id]
+        head, count, cache_size = (
+            self.head[slot],
+            self.count[slot],
+            self.cache_size[slot],
+        )
+
+        if not cache_size:
+            return []
+
+        return [
+            float(self.timestamps[slot, (head + i) % cache_size]) for i in range(count)
+        ]
+
+    def add_message(self, channel_id, timestamp):
+        slot = self.slots[channel_id]
+        head, count, cache_size = (
+            self.head[slot],
+            self.count[slot],
+            self.cache_size[slot],
+        )
+
+        if count == cache_size:
+            self.timestamps[slot, head] = timestamp
+            self.head[slot] = (head + 1) % cache_size
+        else:
+            self.timestamps[slot, (head + count) % cache_size] = timestamp
+            self.count[slot] = count + 1
+
+    def compute(self, now=None, idle_after=0):
+        # One vectorized pass over every slot, returning (channel_id, slowmode)
+        # for the channels whose target changed since the last tick. Given now,
+        # channels quiet for idle_after seconds also count the silence since
+        # their last message, so they decay towards their minimum.
+        slots = np.arange(self.capacity)
+        cache_size = np.maximum(self.cache_size, 1)
+
+        oldest = self.timestamps[slots, self.head]
+        newest = self.timestamps[slots, (self.head + self.count - 1) % cache_size]
+
+        active = self.in_use & (self.count > 1)
+        gaps = np.where(active, self.count - 1, 1)
+        average_spm = np.where(active, (newest - oldest) / gaps, 0.0)
+
+        if now is not None:
+            # Same as CountWindowEstimator.idle_seconds_per_message
+            idle = self.in_use & (self.count > 0) & (now - newest >= idle_after)
+            idle_spm = (now - oldest) / np.maximum(self.count, 1)
+            average_spm = np.where(idle, np.maximum(average_spm, idle_spm), average_spm)
+            active |= idle
+
+        # Matches MessageQueue: no decision until there is a non-zero average
+        active &= average_spm > 0
+        safe_spm = np.where(active, average_spm, 1.0)
+
+        target = np.rint(self.target_spm / safe_spm).astype(np.int64)
+        target = np.where(
+            self.slowmode_max > 0, np.minimum(target, self.slowmode_max), target
+        )
+        target = np.maximum(target, self.slowmode_min)
+
+        changed = active & (target != self.last_target)
+        self.last_target[changed] = target[changed]
+
+        return list(zip(self.channel_ids[changed].tolist(), target[changed].tolist()))
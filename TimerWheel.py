@@ -0,0 +1,96 @@
+import math
+
+
+class TimerWheel:
+    # Hierarchical timer wheel keyed by an arbitrary hashable. Scheduling and
+    # cancelling are O(1) whatever the number of pending timers, and advance()
+    # only touches the slots that come due. Level n slots each span
+    # slots ** n ticks of resolution seconds; timers cascade down a level as
+    # their slot comes round.
+    def __init__(self, start=0.0, resolution=1.0, slots=64, levels=4):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.tick = self.to_tick(start)
+
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+
+        # key -> (deadline tick, level, slot)
+        self.timers = {}
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def to_tick(self, timestamp):
+        return math.ceil(timestamp / self.resolution)
+
+    def schedule(self, key, deadline):
+        # Replaces any timer already pending for key
+        self.cancel(key)
+        self.place(key, self.to_tick(deadline))
+
+    def cancel(self, key):
+        timer = self.timers.pop(key, None)
+
+        if timer:
+            _, level, slot = timer
+            del self.wheels[level][slot][key]
+
+    def place(self, key, deadline):
+        # Anything already due fires on the next tick
+        delta = max(1, deadline - self.tick)
+
+        level = 0
+        while level < self.levels - 1 and delta >= self.slots ** (level + 1):
+            level += 1
+
+        # Timers beyond the top level's range are parked as far out as it
+        # reaches and re-placed when that slot cascades
+        position = self.tick + min(delta, self.slots**self.levels - 1)
+        slot = (position // self.slots**level) % self.slots
+
+        self.wheels[level][slot][key] = deadline
+        self.timers[key] = (deadline, level, slot)
+
+    def advance(self, now):
+        # Move the wheel up to now and return the keys of every timer that expired
+        target = self.to_tick(now)
+        expired = []
+
+        if not self.timers:
+            self.tick = max(self.tick, target)
+            return expired
+
+        while self.tick < target:
+            self.tick += 1
+
+            # Higher level slots that have come round are pushed down a level
+            for level in range(self.levels - 1, 0, -1):
+                span = self.slots**level
+                if self.tick % span:
+                    continue
+
+                bucket = self.wheels[level][(self.tick // span) % self.slots]
+                self.wheels[level][(self.tick // span) % self.slots] = {}
+
+                for key, deadline in bucket.items():
+                    del self.timers[key]
+                    if deadline <= self.tick:
+                        expired.append(key)
+                    else:
+                        self.place(key, deadline)
+
+            bucket = self.wheels[0][self.tick % self.slots]
+            for key in bucket:
+                del self.timers[key]
+            expired += bucket
+            bucket.clear()
+
+            if not self.timers:
+                self.tick = target
+                break
+
+        return expired
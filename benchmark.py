@@ -0,0 +1,424 @@
+"""Offline replay benchmark for the slowmode engine.
+
+Replays synthetic or recorded message timestamp streams through
+ChannelMonitors using fake channels, so the estimator and edit behaviour
+can be measured without a Discord connection:
+
+    python benchmark.py
+    python benchmark.py --stream raid --messages 50000
+    python benchmark.py --replay timestamps.txt
+    python benchmark.py --edit-storm
+
+Recorded streams are text files with one epoch timestamp per line. The edit
+storm fires a burst of edits across many guilds at a fake API that answers
+with 429s and Retry-After once its rate limits are exceeded, with and without
+the EditDispatcher in front of it. The dispatcher runs once with buckets
+under the API's limits and once over them, where it has to learn the real
+limits from the 429s it gets back.
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import time
+import tracemalloc
+
+from ChannelMonitors import ChannelMonitors
+from EditCoalescer import EditCoalescer
+from EditDispatcher import EditDispatcher, TokenBucket
+from MessageQueue import MessageQueue
+from RateEstimators import ESTIMATORS
+
+# Edit settings each estimator is replayed with: (edit_interval, hysteresis)
+EDIT_POLICIES = {
+    "immediate": (0, 0),
+    "coalesced": (5, 1),
+}
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.name = f"channel-{channel_id}"
+        self.slowmode_delay = 0
+        self.edits = []
+
+    async def edit(self, slowmode_delay):
+        self.edits.append(slowmode_delay)
+        self.slowmode_delay = slowmode_delay
+
+
+class FakeResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class FakeRateLimited(Exception):
+    # Shaped like disnake's HTTPException for a 429
+    status = 429
+
+    def __init__(self, retry_after, is_global):
+        super().__init__("429 Too Many Requests")
+        self.response = FakeResponse(
+            {
+                "Retry-After": f"{retry_after:.3f}",
+                "X-RateLimit-Global": "true" if is_global else "false",
+            }
+        )
+
+
+class FakeRateLimiter:
+    # Stands in for the API's rate limits, per guild and global
+    def __init__(self, guild_rate, guild_burst, global_rate, global_burst):
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.guild_buckets = {}
+        self.rejected = 0
+
+    def check(self, guild_id):
+        guild_bucket = self.guild_buckets.setdefault(
+            guild_id, TokenBucket(self.guild_rate, self.guild_burst)
+        )
+
+        for bucket, is_global in ((self.global_bucket, True), (guild_bucket, False)):
+            delay = bucket.delay()
+            if delay > 0:
+                self.rejected += 1
+                raise FakeRateLimited(delay, is_global)
+
+        self.global_bucket.take()
+        guild_bucket.take()
+
+
+class RateLimitedChannel(FakeChannel):
+    def __init__(self, channel_id, guild, limiter, latency=0.005):
+        super().__init__(channel_id, guild)
+        self.limiter = limiter
+        self.latency = latency
+        self.applied_at = None
+
+    async def edit(self, slowmode_delay):
+        await asyncio.sleep(self.latency)
+        self.limiter.check(self.guild.id)
+        await super().edit(slowmode_delay)
+        self.applied_at = time.perf_counter()
+
+
+class ReplayClock:
+    # Lets the edit coalescers measure intervals in stream time, not wall time
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def exponential_gaps(rng, mean, count):
+    return [rng.expovariate(1 / mean) for _ in range(count)]
+
+
+def steady_stream(rng, messages):
+    return exponential_gaps(rng, 2.0, messages)
+
+
+def bursty_stream(rng, messages):
+    gaps = []
+    while len(gaps) < messages:
+        gaps += exponential_gaps(rng, 0.3, 200)
+        gaps += exponential_gaps(rng, 5.0, 25)
+
+    return gaps[:messages]
+
+
+def raid_stream(rng, messages):
+    calm = messages // 4
+    raid = messages - 2 * calm
+
+    return (
+        exponential_gaps(rng, 3.0, calm)
+        + exponential_gaps(rng, 0.05, raid)
+        + exponential_gaps(rng, 3.0, calm)
+    )
+
+
+def idle_decay_stream(rng, messages):
+    burst = messages // 2
+
+    return exponential_gaps(rng, 0.2, burst) + [
+        rng.uniform(30, 300) for _ in range(messages - burst)
+    ]
+
+
+STREAMS = {
+    "steady": steady_stream,
+    "bursty": bursty_stream,
+    "raid": raid_stream,
+    "idle_decay": idle_decay_stream,
+}
+
+
+def gaps_to_timestamps(gaps, start=1_600_000_000.0):
+    timestamps = []
+    t = start
+    for gap in gaps:
+        t += gap
+        timestamps.append(t)
+
+    return timestamps
+
+
+def load_timestamps(fp):
+    with open(fp, "r") as o:
+        return sorted(float(line) for line in o if line.strip())
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+
+    index = min(
+        len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1)))
+    )
+    return sorted_values[index]
+
+
+async def replay(timestamps, estimator, edit_interval, hysteresis, decay_interval):
+    clock = ReplayClock()
+    clock.now = timestamps[0] if timestamps else 0.0
+    channel = FakeChannel(1, FakeGuild(1))
+
+    monitors = ChannelMonitors(
+        ":memory:",
+        {channel.id: channel}.get,
+        clock=clock,
+        decay_interval=decay_interval,
+        wall_clock=clock,
+    )
+
+    monitors.add_channel(
+        channel.id, 0, 30, 15, 1.0, edit_interval, hysteresis, estimator
+    )
+    coalescer = monitors.coalescers[channel.id]
+
+    latencies = []
+    started = time.perf_counter()
+
+    for timestamp in timestamps:
+        clock.now = timestamp
+
+        # Delayed flushes sleep in wall time, so run them here once they're due
+        if coalescer.flush_task and coalescer.time_until_next_edit() <= 0:
+            coalescer.flush_task.cancel()
+            coalescer.flush_task = None
+            await coalescer.flush()
+
+        # Likewise for decay checks that came due during the gap
+        await monitors.check_decay()
+
+        before = time.perf_counter()
+        await monitors.process_message(channel, timestamp)
+        latencies.append(time.perf_counter() - before)
+
+    elapsed = time.perf_counter() - started
+
+    # Whatever is still pending would have been flushed eventually
+    if coalescer.pending is not None:
+        await coalescer.flush()
+    coalescer.cancel()
+
+    latencies.sort()
+
+    return {
+        "messages_per_second": len(timestamps) / elapsed if elapsed else 0.0,
+        "p50_us": percentile(latencies, 50) * 1e6,
+        "p99_us": percentile(latencies, 99) * 1e6,
+        "max_us": (latencies[-1] if latencies else 0.0) * 1e6,
+        "edits": len(channel.edits),
+    }
+
+
+# The fake API's limits for the edit storm: (guild_rate, guild_burst,
+# global_rate, global_burst), and the EditDispatcher buckets run against it
+STORM_LIMITS = (50, 10, 500, 50)
+STORM_EDITORS = {
+    "direct": None,
+    "dispatcher": (40, 10, 400, 50),
+    "overshoot": (60, 15, 600, 60),
+}
+
+
+async def edit_storm(guilds, channels_per_guild, dispatcher_limits=None):
+    # Every channel wants an edit at once: most are harmless decreases queued
+    # first, and one in four is an urgent increase
+    limiter = FakeRateLimiter(*STORM_LIMITS)
+    editor = EditDispatcher(*dispatcher_limits) if dispatcher_limits else None
+    if editor:
+        editor.start()
+
+    requests = []
+    for guild_id in range(guilds):
+        guild = FakeGuild(guild_id)
+        for i in range(channels_per_guild):
+            channel = RateLimitedChannel(
+                guild_id * channels_per_guild + i, guild, limiter
+            )
+            urgent = i % 4 == 0
+            channel.slowmode_delay = 0 if urgent else 10
+
+            coalescer = EditCoalescer(MessageQueue(0, 30, 15, 1.0, 0, 0), editor=editor)
+            requests.append((urgent, channel, coalescer))
+
+    requests.sort(key=lambda request: request[0])
+
+    started = time.perf_counter()
+    for urgent, channel, coalescer in requests:
+        await coalescer.submit(channel, 30 if urgent else 0)
+
+    while any(not channel.edits for _, channel, _ in requests):
+        await asyncio.sleep(0.01)
+
+    urgent_done = max(channel.applied_at for urgent, channel, _ in requests if urgent)
+    all_done = max(channel.applied_at for _, channel, _ in requests)
+
+    if editor:
+        await editor.stop()
+
+    return {
+        "rejected": limiter.rejected,
+        "urgent_ms": (urgent_done - started) * 1e3,
+        "all_ms": (all_done - started) * 1e3,
+    }
+
+
+async def run_edit_storm(args):
+    print(f"{'editor':<12} {'429s':>6} {'increases ms':>13} {'all ms':>8}")
+
+    for name, dispatcher_limits in STORM_EDITORS.items():
+        result = await edit_storm(args.guilds, args.guild_channels, dispatcher_limits)
+
+        print(
+            f"{name:<12} {result['rejected']:>6} {result['urgent_ms']:>13.0f} {result['all_ms']:>8.0f}"
+        )
+
+
+class DatetimeQueue:
+    # The original MessageQueue's storage, a list of datetimes on an object
+    # without __slots__, kept as the baseline for measure_channel_memory
+    def __init__(self, slowmode_min, slowmode_max, cache_size, sensitivity):
+        self.slowmode_min = slowmode_min
+        self.slowmode_max = slowmode_max
+        self.cache_size = cache_size
+        self.sensitivity = sensitivity
+
+        self.message_timestamp_queue = []
+
+    def add_message(self, timestamp):
+        self.message_timestamp_queue.append(timestamp)
+
+        while len(self.message_timestamp_queue) > self.cache_size:
+            self.message_timestamp_queue.pop(0)
+
+
+def measure_channel_memory(channels, cache_size=15, datetime_queues=False):
+    # Bytes held per monitored channel once its queue is full. With
+    # datetime_queues, for a dict of DatetimeQueues as ChannelMonitors first
+    # kept them, rather than everything ChannelMonitors keeps now.
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+
+    start = 1_600_000_000.0
+
+    if datetime_queues:
+        queues = {}
+        for channel_id in range(channels):
+            q = queues[channel_id] = DatetimeQueue(0, 30, cache_size, 1.0)
+            for i in range(cache_size):
+                q.add_message(
+                    datetime.datetime.fromtimestamp(start + i, datetime.timezone.utc)
+                )
+    else:
+        monitors = ChannelMonitors(":memory:", lambda channel_id: None)
+        for channel_id in range(channels):
+            monitors.add_channel(channel_id, 0, 30, cache_size, 1.0)
+            q = monitors.channels[channel_id]
+            for i in range(cache_size):
+                q.add_message(start + i)
+
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    allocated = sum(
+        stat.size_diff for stat in snapshot.compare_to(baseline, "filename")
+    )
+
+    return allocated / channels
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+
+    if args.replay:
+        streams = {os.path.basename(args.replay): load_timestamps(args.replay)}
+    else:
+        names = [args.stream] if args.stream else list(STREAMS)
+        streams = {
+            name: gaps_to_timestamps(STREAMS[name](rng, args.messages))
+            for name in names
+        }
+
+    print(
+        f"{'stream':<12} {'estimator':<10} {'policy':<10} {'msg/s':>10} {'p50 us':>8} {'p99 us':>8} {'max us':>9} {'edits':>6}"
+    )
+
+    for name, timestamps in streams.items():
+        for estimator, (policy, (edit_interval, hysteresis)) in (
+            (e, p) for e in ESTIMATORS for p in EDIT_POLICIES.items()
+        ):
+            result = await replay(
+                timestamps, estimator, edit_interval, hysteresis, args.decay
+            )
+
+            print(
+                f"{name:<12} {estimator:<10} {policy:<10} {result['messages_per_second']:>10.0f} "
+                f"{result['p50_us']:>8.1f} {result['p99_us']:>8.1f} "
+                f"{result['max_us']:>9.1f} {result['edits']:>6}"
+            )
+
+    before = measure_channel_memory(args.channels, datetime_queues=True)
+    per_channel = measure_channel_memory(args.channels)
+    print(
+        f"\nMemory per monitored channel: {before:.0f} bytes with datetime list "
+        f"queues, {per_channel:.0f} bytes now"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stream", choices=sorted(STREAMS))
+    parser.add_argument("--replay", help="File with one epoch timestamp per line")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--channels", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--decay", type=float, default=30, help="Decay interval, 0 disables"
+    )
+    parser.add_argument("--edit-storm", action="store_true")
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--guild-channels", type=int, default=20)
+
+    args = parser.parse_args()
+    asyncio.run(run_edit_storm(args) if args.edit_storm else run(args))
+
+
+if __name__ == "__main__":
+    main()
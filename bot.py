@@ -1,12 +1,31 @@
+import asyncio
 import datetime
-import traceback
-import sys
+import io
+import logging
+import os
+import signal
+import time
 
 import disnake
 
 from disnake.ext import commands
 
 from ChannelMonitors import ChannelMonitors
+from EditDispatcher import EditDispatcher
+from HistoryPrefill import HistoryPrefill
+from LogSetup import setup_logging
+from LoopMonitor import LagMonitor, SamplingProfiler
+from MessageDispatcher import MessageDispatcher
+from Metrics import (
+    on_message_latency,
+    on_message_results,
+    registry,
+    start_metrics_server,
+)
+from PermissionCache import PermissionCache
+from Recorder import Recorder
+from RateEstimators import ESTIMATORS
+from TickEngine import TickEngine
 
 from yaml import load
 
@@ -15,52 +34,294 @@ try:
 except ImportError:
     from yaml import Loader
 
-with open("config.yaml", "r") as o:
+# soak.py points this at a config of its own
+with open(os.environ.get("SLOWMODE_CONFIG", "config.yaml"), "r") as o:
     config = load(o.read(), Loader=Loader)
 
-
-bot = commands.Bot(
-    intents=disnake.Intents(members=True, guilds=True, guild_messages=True)
+log_listener = setup_logging(
+    level=config.get("LOG_LEVEL", "INFO"),
+    json_output=config.get("LOG_JSON", False),
+    change_interval=config.get("LOG_CHANGE_INTERVAL", 10),
+)
+log = logging.getLogger("bot")
+
+# Set by launcher.py when running as one of several worker processes
+shard_ids = [int(i) for i in os.environ.get("SHARD_IDS", "").split(",") if i]
+shard_count = int(os.environ.get("SHARD_COUNT", 0)) or None
+shard_workers = int(os.environ.get("SHARD_WORKERS", 1))
+metrics_port = int(os.environ.get("METRICS_PORT", config.get("METRICS_PORT") or 0))
+
+
+def owns_guild(guild_id):
+    return (guild_id >> 22) % shard_count in shard_ids
+
+
+class SlowmodeBot(commands.AutoShardedBot if shard_ids else commands.Bot):
+    async def close(self):
+        await super().close()
+        if self.metrics_server:
+            self.metrics_server.close()
+        await self.dispatcher.stop()
+        await self.monitors.close()
+        await self.editor.stop()
+        if self.prefill:
+            await self.prefill.stop()
+        if self.recorder:
+            await self.recorder.close()
+        await self.lag_monitor.stop()
+        log_listener.stop()
+
+
+bot = SlowmodeBot(
+    intents=disnake.Intents(members=True, guilds=True, guild_messages=True),
+    **({"shard_ids": shard_ids, "shard_count": shard_count} if shard_ids else {}),
 )
 
 bot.timestamp = None
 
-bot.monitors = ChannelMonitors(config["DATABASE_FILEPATH"], bot.get_channel)
+bot.editor = EditDispatcher(
+    guild_rate=config.get("EDIT_GUILD_RATE", 1.0),
+    guild_burst=config.get("EDIT_GUILD_BURST", 5),
+    # The global budget is split between the worker processes
+    global_rate=config.get("EDIT_GLOBAL_RATE", 40.0) / shard_workers,
+    global_burst=max(1, config.get("EDIT_GLOBAL_BURST", 40) // shard_workers),
+)
+bot.recorder = (
+    Recorder(
+        # Each worker process writes its own segments
+        os.path.join(config["RECORDER_PATH"], f"shard-{shard_ids[0]}")
+        if shard_ids
+        else config["RECORDER_PATH"],
+        segment_records=config.get("RECORDER_SEGMENT_RECORDS", 65536),
+        rollup_interval=config.get("RECORDER_ROLLUP_INTERVAL", 300),
+        keep_segments=config.get("RECORDER_KEEP_SEGMENTS", 48),
+        keep_rollup_days=config.get("RECORDER_KEEP_ROLLUP_DAYS"),
+    )
+    if config.get("RECORDER_PATH")
+    else None
+)
+bot.monitors = ChannelMonitors(
+    config["DATABASE_FILEPATH"],
+    bot.get_channel,
+    engine=TickEngine() if config.get("ENGINE_MODE") == "tick" else None,
+    tick_interval=config.get("TICK_INTERVAL", 1.0),
+    snapshot_interval=config.get("SNAPSHOT_INTERVAL", 60),
+    snapshot_max_age=config.get("SNAPSHOT_MAX_AGE", 600),
+    max_hot_queues=config.get("HOT_QUEUE_LIMIT", 0),
+    idle_timeout=config.get("IDLE_EVICT_AFTER", 1800),
+    decay_interval=config.get("DECAY_INTERVAL", 30),
+    editor=bot.editor,
+    recorder=bot.recorder,
+    guild_filter=owns_guild if shard_ids else None,
+    flush_interval=config.get("DB_FLUSH_INTERVAL", 1.0),
+    flush_threshold=config.get("DB_FLUSH_THRESHOLD", 100),
+    purge_departed=config.get("PURGE_DEPARTED_GUILDS", False),
+    get_guild=bot.get_guild,
+)
+bot.prefill = (
+    HistoryPrefill(
+        bot.monitors,
+        concurrency=config.get("PREFILL_CONCURRENCY", 4),
+        # History requests share the API budget with the other worker processes
+        rate=config.get("PREFILL_RATE", 5.0) / shard_workers,
+        burst=max(1, config.get("PREFILL_BURST", 5) // shard_workers),
+        max_age=config.get("PREFILL_MAX_AGE", 3600),
+    )
+    if config.get("PREFILL", False)
+    else None
+)
+bot.permission_cache = PermissionCache()
+bot.dispatcher = MessageDispatcher(
+    bot.monitors,
+    workers=config.get("DISPATCH_WORKERS", 4),
+    max_pending=config.get("DISPATCH_QUEUE_SIZE", 100),
+    overflow=config.get("DISPATCH_OVERFLOW", "drop_oldest"),
+)
+bot.metrics_server = None
+bot.lag_monitor = LagMonitor(
+    interval=config.get("LOOP_LAG_INTERVAL", 0.5),
+    warn_after=config.get("LOOP_LAG_WARN", 0.25),
+    slow_callback=config.get("SLOW_CALLBACK_THRESHOLD", 0),
+)
+bot.profiler = SamplingProfiler()
+bot.profile_task = None
+
+registry.gauge(
+    "slowmode_monitored_channels",
+    "Channels currently being monitored",
+    lambda: len(bot.monitors.monitored),
+)
+registry.gauge(
+    "slowmode_message_queues",
+    "Monitored channels with a MessageQueue built",
+    lambda: len(bot.monitors.channels),
+)
+registry.gauge(
+    "slowmode_dispatch_queue_depth",
+    "Timestamps waiting in the per-channel dispatch queues",
+    bot.dispatcher.queue_depth,
+)
+registry.gauge(
+    "slowmode_dispatch_overflow_total",
+    "Timestamps dropped or merged because a channel queue was full",
+    lambda: bot.dispatcher.overflowed,
+    kind="counter",
+)
+registry.gauge(
+    "slowmode_edit_queue_depth",
+    "Slowmode edits waiting on the rate limit buckets",
+    bot.editor.queue_depth,
+)
+registry.gauge(
+    "slowmode_loop_lag_max_seconds",
+    "Longest event loop lag seen since startup",
+    lambda: bot.lag_monitor.max_lag,
+)
+registry.gauge(
+    "slowmode_db_pending_writes",
+    "Channel config writes waiting for the next flush",
+    lambda: len(bot.monitors.db.pending),
+)
+registry.gauge(
+    "slowmode_config_cache_hits_total",
+    "Channel config lookups served from memory",
+    lambda: bot.monitors.db.cache.hits,
+    kind="counter",
+)
+registry.gauge(
+    "slowmode_config_cache_misses_total",
+    "Channel config lookups that went to the database",
+    lambda: bot.monitors.db.cache.misses,
+    kind="counter",
+)
+
+
+def profile_on_signal():
+    # kill -USR1 <pid> writes a profile to PROFILE_DIR
+    async def run():
+        try:
+            await bot.profiler.profile_to_file(
+                config.get("PROFILE_SECONDS", 10), config.get("PROFILE_DIR", "profiles")
+            )
+        except RuntimeError as e:
+            log.warning("Profile not taken: %s", e)
+
+    bot.profile_task = asyncio.create_task(run())
 
 
 @bot.event
 async def on_ready():
-    print(f"Running on {bot.user.name}#{bot.user.discriminator} ({bot.user.id})")
+    log.info(
+        "Running on %s#%s (%s)", bot.user.name, bot.user.discriminator, bot.user.id
+    )
     if not bot.timestamp:
-        await bot.monitors.initialize()
+        await bot.monitors.initialize(bot.guilds)
+        if bot.prefill:
+            bot.prefill.start(
+                channel
+                for guild in bot.guilds
+                for channel in guild.text_channels
+                if bot.monitors.is_monitored(channel.id)
+            )
+        bot.dispatcher.start()
+        bot.editor.start()
+        if bot.recorder:
+            bot.recorder.start()
+        bot.lag_monitor.start()
+
+        if hasattr(signal, "SIGUSR1"):
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGUSR1, profile_on_signal
+            )
+
+        if metrics_port:
+            bot.metrics_server = await start_metrics_server(metrics_port)
 
         bot.timestamp = (
             datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).timestamp()
         )
+    else:
+        # Reconnected, pick up anything that changed while we were away
+        await bot.monitors.resync(bot.guilds)
 
 
-@bot.event
-async def on_message(message):
+def filter_message(message):
+    # Returns the name of the stage that rejected the message, or "accepted"
+
     # Wait for bot initialization to complete before accepting inputs
     if not bot.timestamp:
-        return
+        return "not_ready"
+
+    # Most traffic is in channels we don't monitor, so drop it before anything else
+    if not bot.monitors.is_monitored(message.channel.id):
+        return "unmonitored"
 
     # Ignore DMs
     if not isinstance(message.channel, disnake.abc.GuildChannel):
-        return
+        return "not_guild"
 
     # Ignore bot accounts
     if message.author.bot:
-        return
+        return "bot_author"
 
     # Ignore if we cannot affect slowmode
-    if not message.channel.permissions_for(message.guild.me).manage_channels:
-        return
+    if not bot.permission_cache.can_manage_channel(message.channel):
+        return "no_permission"
     # Ignore if user is bypassing slowmode
-    if message.channel.permissions_for(message.author).manage_messages:
-        return
+    if bot.permission_cache.bypasses_slowmode(message.channel, message.author):
+        return "bypass"
+
+    return "accepted"
+
+
+@bot.event
+async def on_message(message):
+    started = time.perf_counter()
+    stage = filter_message(message)
+
+    if stage == "accepted":
+        bot.dispatcher.submit(message.channel, message.created_at.timestamp())
+
+    on_message_results.inc(stage=stage)
+    on_message_latency.observe(time.perf_counter() - started, stage=stage)
+
+
+# Anything that can change the outcome of a cached permission check drops it
+@bot.event
+async def on_guild_channel_update(before, after):
+    bot.permission_cache.invalidate_channel(after)
+
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    bot.permission_cache.invalidate_channel(channel)
+
 
-    await bot.monitors.process_message(message.channel, message.created_at)
+@bot.event
+async def on_guild_role_update(before, after):
+    bot.permission_cache.invalidate_guild(after.guild.id)
+
+
+@bot.event
+async def on_guild_role_delete(role):
+    bot.permission_cache.invalidate_guild(role.guild.id)
+
+
+@bot.event
+async def on_member_update(before, after):
+    # Other members are keyed by their role set, only our own roles matter here
+    if after.id == bot.user.id:
+        bot.permission_cache.invalidate_guild(after.guild.id)
+
+
+@bot.event
+async def on_guild_update(before, after):
+    bot.permission_cache.invalidate_guild(after.id)
+
+
+@bot.event
+async def on_guild_remove(guild):
+    bot.permission_cache.invalidate_guild(guild.id)
 
 
 def has_manage_guild(ctx):
@@ -82,11 +343,17 @@ def generate_channel_settings_display(config, show_monitoring):
     ret = """**Min/Max**: {}/{}
 **Cache Size**: {}
 **Sensitivity**: {:.3f}
+**Edit Interval**: {}
+**Hysteresis**: {}
+**Estimator**: {}
 """.format(
         config.slowmode_min,
         config.slowmode_max,
         config.cache_size,
         config.sensitivity,
+        config.edit_interval,
+        config.hysteresis,
+        config.estimator,
     )
 
     if show_monitoring:
@@ -159,6 +426,9 @@ async def monitor_remove_channel(
 @monitor.sub_command(name="view", description="View currently monitored channels")
 @commands.check(has_manage_guild)
 async def monitor_view(ctx):
+    # Add protections for guild leave/join/disconnect desync shenanigans
+    await bot.monitors.resync([ctx.guild])
+
     channel_ids = await bot.monitors.get_guild_monitors(ctx.guild.id)
     resp = "__**Currently Monitoring**__\n"
 
@@ -166,13 +436,6 @@ async def monitor_view(ctx):
         ctx.guild.get_channel(c) for c in channel_ids if ctx.guild.get_channel(c)
     ]
 
-    for c in channels:
-        # Add protections for guild leave/join/disconnect desync shenanigans
-        try:
-            await bot.monitors.start_monitoring(c)
-        except ValueError:
-            pass
-
     if not channels:
         resp += "*No channels are currently being monitored*"
     else:
@@ -182,6 +445,41 @@ async def monitor_view(ctx):
     await ctx.response.send_message(resp)
 
 
+@monitor.sub_command(
+    name="addall",
+    description="Start monitoring every channel in a category or the whole server",
+)
+@commands.check(has_manage_guild)
+async def monitor_add_channels(
+    ctx,
+    category: disnake.CategoryChannel = commands.Param(
+        default=None,
+        description="Only channels in this category, every channel in the server if left out",
+    ),
+):
+    added, skipped = await bot.monitors.start_monitoring_many(
+        bulk_channels(ctx, category)
+    )
+
+    resp = f"Now monitoring **{len(added)}** channels in {bulk_scope(category)}."
+    if skipped:
+        resp += f" {len(skipped)} were already being monitored."
+
+    unmanageable = [
+        channel
+        for channel in added
+        if not channel.permissions_for(channel.guild.me).manage_channels
+    ]
+    if unmanageable:
+        resp += f"\n\n**WARNING:** I do not have permissions to modify {len(unmanageable)} of them: "
+        resp += " ".join(f"<#{channel.id}>" for channel in unmanageable[:20])
+        if len(unmanageable) > 20:
+            resp += " ..."
+        resp += "\nPlease grant `MANAGE_CHANNELS` for monitoring to work there."
+
+    await ctx.response.send_message(resp)
+
+
 @bot.slash_command(name="settings", description="View the settings for a channel")
 @commands.check(has_manage_guild)
 async def get_channel_settings(
@@ -306,6 +604,187 @@ async def set_channel_sensitivity(
     await ctx.response.send_message(resp)
 
 
+@settings.sub_command(
+    name="edits", description="Set how often and how eagerly slowmode is edited"
+)
+@commands.check(has_manage_guild)
+async def set_channel_edit_settings(
+    ctx,
+    channel: disnake.TextChannel = commands.Param(
+        description="Select a channel to configure"
+    ),
+    interval: int = commands.Param(
+        description="The minimum number of seconds between slowmode edits"
+    ),
+    hysteresis: int = commands.Param(
+        description="Ignore changes of this many seconds or fewer"
+    ),
+):
+    if interval < 0 or interval > 3600:
+        await ctx.response.send_message(
+            "Error: Interval must be between 0 and 3600 seconds."
+        )
+        return
+    if hysteresis < 0 or hysteresis > 21600:
+        await ctx.response.send_message(
+            "Error: Hysteresis must be between 0 and 21600 seconds."
+        )
+        return
+
+    success = await bot.monitors.update_channel(
+        channel, edit_interval=interval, hysteresis=hysteresis
+    )
+
+    resp = "An unknown error occured"
+
+    if success:
+        resp = f"Slowmode edits for <#{channel.id}> will now be at least **{interval}** seconds apart and ignore changes of **{hysteresis}** seconds or fewer."
+
+    await ctx.response.send_message(resp)
+
+
+@settings.sub_command(
+    name="estimator", description="Set how message rate is measured for a channel"
+)
+@commands.check(has_manage_guild)
+async def set_channel_estimator(
+    ctx,
+    channel: disnake.TextChannel = commands.Param(
+        description="Select a channel to configure"
+    ),
+    estimator: str = commands.Param(
+        description="count: last N messages, ewma: weighted average, window: recent time span",
+        choices=list(ESTIMATORS),
+    ),
+):
+    success = await bot.monitors.update_channel(channel, estimator=estimator)
+
+    resp = "An unknown error occured"
+
+    if success:
+        resp = f"The estimator for <#{channel.id}> has been set to **{estimator}**."
+
+    await ctx.response.send_message(resp)
+
+
+def bulk_channels(ctx, category):
+    return category.text_channels if category else ctx.guild.text_channels
+
+
+def bulk_scope(category):
+    return f"**{category.name}**" if category else "this server"
+
+
+def bulk_summary(updated, skipped, category, setting):
+    resp = f"The {setting} for **{len(updated)}** monitored channels in {bulk_scope(category)}."
+    if skipped:
+        resp += f"\n{len(skipped)} channels there aren't monitored and were left as they are."
+
+    return resp
+
+
+@bot.slash_command(name="setall")
+async def settings_all(inter):
+    pass
+
+
+@settings_all.sub_command(
+    name="bounds",
+    description="Set the minimum and maximum bounds for every channel in a category or the server",
+)
+@commands.check(has_manage_guild)
+async def set_channels_bounds(
+    ctx,
+    minimum: int = commands.Param(
+        name="min", description="The minimum number of seconds"
+    ),
+    maximum: int = commands.Param(
+        name="max", description="The maxinum number of seconds"
+    ),
+    category: disnake.CategoryChannel = commands.Param(
+        default=None,
+        description="Only channels in this category, every channel in the server if left out",
+    ),
+):
+    if maximum < minimum:
+        await ctx.response.send_message("Error: Maximum must be greater than minimum.")
+        return
+    if maximum > 21600:
+        await ctx.response.send_message(
+            "Error: Maximum cannot exceed 21600 seconds (6 hours)."
+        )
+        return
+
+    updated, skipped = await bot.monitors.update_channels(
+        bulk_channels(ctx, category), slowmode_min=minimum, slowmode_max=maximum
+    )
+
+    await ctx.response.send_message(
+        bulk_summary(
+            updated,
+            skipped,
+            category,
+            f"bounds have been set to **{minimum}**/**{maximum}**",
+        )
+    )
+
+
+@settings_all.sub_command(
+    name="cachesize",
+    description="Set the cache size for every channel in a category or the server",
+)
+@commands.check(has_manage_guild)
+async def set_channels_cache_size(
+    ctx,
+    size: int = commands.Param(
+        description="The number messages to be cached for these channels"
+    ),
+    category: disnake.CategoryChannel = commands.Param(
+        default=None,
+        description="Only channels in this category, every channel in the server if left out",
+    ),
+):
+    if size < 5 or size > 50:
+        await ctx.response.send_message("Error: Cache size must be between 5 and 50.")
+        return
+
+    updated, skipped = await bot.monitors.update_channels(
+        bulk_channels(ctx, category), cache_size=size
+    )
+
+    await ctx.response.send_message(
+        bulk_summary(
+            updated, skipped, category, f"cache size has been set to **{size}**"
+        )
+    )
+
+
+@settings_all.sub_command(
+    name="sensitivity",
+    description="Set the sensitivity for every channel in a category or the server",
+)
+@commands.check(has_manage_guild)
+async def set_channels_sensitivity(
+    ctx,
+    sensitivity: float = commands.Param(
+        description="The sensitivity for these channels (higher is more sensitive)",
+    ),
+    category: disnake.CategoryChannel = commands.Param(
+        default=None,
+        description="Only channels in this category, every channel in the server if left out",
+    ),
+):
+    updated, skipped = await bot.monitors.update_channels(
+        bulk_channels(ctx, category), sensitivity=sensitivity
+    )
+
+    await ctx.response.send_message(
+        bulk_summary(
+            updated, skipped, category, f"sensitivity has been set to **{sensitivity}**"
+        )
+    )
+
+
 @bot.slash_command(name="about", description="Get info about this bot")
 @commands.check(has_manage_guild)
 async def about_message(
@@ -333,37 +812,88 @@ async def commands_message(
 
 `/monitor add` - Start monitoring a channel
 `/monitor remove` - Stop monitoring a channel
+`/monitor addall` - Start monitoring every channel in a category or the server
 `/monitor view` - View all currently-monitored channels
 
 `/settings` - View settings for a specific channel
 
 `/set bounds` - Set the minimum/maximum slowmode for a channel
 `/set cache` - Set the message cache size for a channel
-`/set sensitivity` - Set the sensitivity for a channel"""
+`/set sensitivity` - Set the sensitivity for a channel
+`/set edits` - Set the minimum edit interval and hysteresis for a channel
+`/set estimator` - Set how message rate is measured for a channel
+
+`/setall bounds`, `/setall cachesize`, `/setall sensitivity` - The same for every monitored channel in a category or the server"""
+    )
+
+
+@bot.slash_command(
+    name="profile", description="Sample what the bot spends its time on (owner only)"
+)
+@commands.is_owner()
+async def profile_bot(
+    ctx,
+    seconds: int = commands.Param(
+        default=10, ge=1, le=120, description="How long to sample for"
+    ),
+):
+    await ctx.response.defer()
+
+    try:
+        report = await bot.profiler.profile(seconds)
+    except RuntimeError as e:
+        await ctx.followup.send(f"Error: {e}")
+        return
+
+    await ctx.followup.send(
+        f"Event loop lag: {bot.lag_monitor.last_lag:.3f}s now, {bot.lag_monitor.max_lag:.3f}s at worst",
+        file=disnake.File(io.BytesIO(report.encode()), filename="profile.txt"),
     )
 
 
+async def respond(ctx, message):
+    # Commands that deferred have already used up their response
+    if ctx.response.is_done():
+        await ctx.followup.send(message)
+    else:
+        await ctx.response.send_message(message)
+
+
 @about_message.error
 @commands_message.error
 @monitor_add_channel.error
+@monitor_add_channels.error
 @monitor_remove_channel.error
 @monitor_view.error
 @get_channel_settings.error
 @set_channel_bounds.error
 @set_channel_cache_size.error
 @set_channel_sensitivity.error
+@set_channel_edit_settings.error
+@set_channel_estimator.error
+@set_channels_bounds.error
+@set_channels_cache_size.error
+@set_channels_sensitivity.error
+@profile_bot.error
 async def process_error(ctx, error):
+    if isinstance(error, commands.errors.NotOwner):
+        await respond(ctx, "Error: Only the bot's owner can use this command.")
+        return
+
     if isinstance(error, commands.errors.CheckFailure):
-        await ctx.response.send_message(
-            f"Error: You require `MANAGE_GUILD` to use this bot."
-        )
+        await respond(ctx, f"Error: You require `MANAGE_GUILD` to use this bot.")
         return
 
-    print(
-        "".join(traceback.TracebackException.from_exception(error).format()),
-        file=sys.stderr,
+    log.error(
+        "Command failed",
+        exc_info=error,
+        extra={
+            "guild": ctx.guild.id if ctx.guild else None,
+            "channel": ctx.channel.id if ctx.channel else None,
+        },
     )
-    await ctx.response.send_message("An error occured. Please alert the maintainer.")
+    await respond(ctx, "An error occured. Please alert the maintainer.")
 
 
-bot.run(config["TOKEN"])
+if __name__ == "__main__":
+    bot.run(config["TOKEN"])
@@ -0,0 +1,305 @@
+"""Runs the bot as several worker processes sharing one database.
+
+Each worker is a `python bot.py` process owning a contiguous range of the
+gateway shards, and so only the guilds on those shards:
+
+    python launcher.py --workers 4
+    python launcher.py --workers 4 --shards 16 --metrics-port 9100
+
+Crashed workers are restarted with a backoff. When --metrics-port is given,
+/metrics serves every worker's metrics with a shard label added and /health
+reports the state of each worker as JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+
+from LogSetup import setup_logging
+
+log = logging.getLogger("launcher")
+
+# Workers run bot.py from here, where config.yaml and the database are found
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# A worker that stayed up this long has its restart backoff reset
+STABLE_AFTER = 60
+MAX_BACKOFF = 60
+
+
+class Worker:
+    def __init__(self, index, shard_ids, shard_count, workers, metrics_port=None):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.workers = workers
+        self.metrics_port = metrics_port
+
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        self.last_exit = None
+
+    def environment(self):
+        env = dict(os.environ)
+        env["SHARD_IDS"] = ",".join(str(i) for i in self.shard_ids)
+        env["SHARD_COUNT"] = str(self.shard_count)
+        env["SHARD_WORKERS"] = str(self.workers)
+
+        # Workers run from DIRECTORY, a config path given relative to here wouldn't resolve
+        if env.get("SLOWMODE_CONFIG"):
+            env["SLOWMODE_CONFIG"] = os.path.abspath(env["SLOWMODE_CONFIG"])
+
+        # Workers only serve metrics for the launcher to aggregate, never on
+        # the single port from config.yaml they would all be fighting over
+        env["METRICS_PORT"] = str(self.metrics_port or 0)
+
+        return env
+
+    async def run(self, stopping):
+        backoff = 1
+
+        while not stopping.is_set():
+            self.started_at = time.time()
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable,
+                os.path.join(DIRECTORY, "bot.py"),
+                env=self.environment(),
+                cwd=DIRECTORY,
+            )
+            log.info(
+                "Started worker %d (pid %d) for shards %s",
+                self.index,
+                self.process.pid,
+                self.shard_ids,
+            )
+
+            self.last_exit = await self.process.wait()
+            if stopping.is_set():
+                break
+
+            if time.time() - self.started_at >= STABLE_AFTER:
+                backoff = 1
+
+            log.warning(
+                "Worker %d exited with %s, restarting in %ds",
+                self.index,
+                self.last_exit,
+                backoff,
+            )
+            self.restarts += 1
+
+            try:
+                await asyncio.wait_for(stopping.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def stop(self):
+        if self.process and self.process.returncode is None:
+            self.process.send_signal(signal.SIGTERM)
+
+    def health(self):
+        alive = self.process is not None and self.process.returncode is None
+
+        return {
+            "worker": self.index,
+            "shards": self.shard_ids,
+            "pid": self.process.pid if self.process else None,
+            "alive": alive,
+            "uptime": time.time() - self.started_at if alive else 0,
+            "restarts": self.restarts,
+            "last_exit": self.last_exit,
+        }
+
+
+def partition_shards(shard_count, workers):
+    # Contiguous ranges, the first shard_count % workers getting one extra
+    size, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+
+    return ranges
+
+
+def add_label(line, name, value):
+    # Adds name="value" to one sample line of Prometheus text output
+    if not line or line.startswith("#"):
+        return line
+
+    metric, _, sample = line.partition(" ")
+    label = f'{name}="{value}"'
+
+    if metric.endswith("}"):
+        return f"{metric[:-1]},{label}}} {sample}"
+
+    return f"{metric}{{{label}}} {sample}"
+
+
+async def scrape(port):
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection("127.0.0.1", port), 2
+    )
+
+    try:
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 5)
+    finally:
+        writer.close()
+
+    _, _, body = response.partition(b"\r\n\r\n")
+    return body.decode()
+
+
+async def aggregate_metrics(workers):
+    # Every worker's samples with a shard label, kept grouped under their
+    # metric's HELP and TYPE lines
+    bodies = await asyncio.gather(
+        *(scrape(worker.metrics_port) for worker in workers), return_exceptions=True
+    )
+
+    families = {
+        "slowmode_worker_up": (
+            [
+                "# HELP slowmode_worker_up Whether the worker answered the last scrape",
+                "# TYPE slowmode_worker_up gauge",
+            ],
+            [
+                f'slowmode_worker_up{{shard="{worker.shard_ids[0]}"}} {int(not isinstance(body, Exception))}'
+                for worker, body in zip(workers, bodies)
+            ],
+        )
+    }
+
+    for worker, body in zip(workers, bodies):
+        if isinstance(body, Exception):
+            continue
+
+        family = None
+        for line in body.splitlines():
+            if line.startswith("#"):
+                family = line.split(" ", 3)[2]
+                headers, _ = families.setdefault(family, ([], []))
+                if line not in headers:
+                    headers.append(line)
+            elif line:
+                families.setdefault(family, ([], []))[1].append(
+                    add_label(line, "shard", worker.shard_ids[0])
+                )
+
+    lines = []
+    for headers, samples in families.values():
+        lines += headers + samples
+
+    return "\n".join(lines) + "\n"
+
+
+async def start_launcher_server(port, workers, host="127.0.0.1"):
+    async def handle(reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+
+        path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b"/"
+
+        if path == b"/health":
+            body = json.dumps([worker.health() for worker in workers]).encode()
+            content_type = b"application/json"
+        else:
+            body = (await aggregate_metrics(workers)).encode()
+            content_type = b"text/plain; version=0.0.4"
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: "
+            + content_type
+            + b"\r\n"
+            + f"Content-Length: {len(body)}\r\n".encode()
+            + b"Connection: close\r\n\r\n"
+            + body
+        )
+
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def run(args):
+    shard_count = args.shards or args.workers
+    if args.workers > shard_count:
+        raise SystemExit("Need at least as many shards as workers.")
+
+    workers = [
+        Worker(
+            i,
+            shard_ids,
+            shard_count,
+            args.workers,
+            args.worker_metrics_port + i if args.metrics_port else None,
+        )
+        for i, shard_ids in enumerate(partition_shards(shard_count, args.workers))
+    ]
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    server = None
+    if args.metrics_port:
+        server = await start_launcher_server(args.metrics_port, workers)
+
+    tasks = [asyncio.create_task(worker.run(stopping)) for worker in workers]
+
+    await stopping.wait()
+    log.info("Stopping %d workers", len(workers))
+
+    for worker in workers:
+        worker.stop()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    if server:
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--shards", type=int, help="Total gateway shards, defaults to --workers"
+    )
+    parser.add_argument("--metrics-port", type=int)
+    parser.add_argument(
+        "--worker-metrics-port",
+        type=int,
+        default=9200,
+        help="Port of the first worker's metrics, the rest follow on",
+    )
+
+    listener = setup_logging()
+    try:
+        asyncio.run(run(parser.parse_args()))
+    finally:
+        listener.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,560 @@
+"""Soak test driving bot.py's whole event path against a local fake gateway.
+
+bot.py is imported as is, with its Discord connection swapped for a stand-in.
+Guilds, roles, channels and members are created from gateway payloads, and
+MESSAGE_CREATE events are fed to the real ConnectionState. Each one goes
+through on_message's filters, the MessageDispatcher and
+ChannelMonitors.process_messages as it would live. Channel edits land on a
+fake HTTP client that records them and echoes the CHANNEL_UPDATE back:
+
+    python soak.py
+    python soak.py --guilds 2000 --channels 5 --rate 5000 --duration 600
+    python soak.py --rate 0 --duration 120
+
+A --rate of 0 sends events as fast as the bot keeps up with them. Every
+--report seconds it prints the sustained events per second, event loop lag,
+RSS and how much it has grown, and DB latency, so hosts can be sized and
+leaks caught. The database is a fresh one in a temporary directory.
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import disnake
+import yaml
+
+from HistoryPrefill import DISCORD_EPOCH, HistoryPrefill, last_activity
+from Metrics import db_latency, on_message_results, process_latency
+
+VIEW_AND_SEND = (1 << 10) | (1 << 11)
+MANAGE_CHANNELS = 1 << 4
+MANAGE_MESSAGES = 1 << 13
+
+
+class Snowflakes:
+    # Ids that decode to the current time, as message ids need to be since
+    # created_at is read back out of them
+    def __init__(self):
+        self.last = 0
+
+    def next(self):
+        self.last = max(self.at(time.time()), self.last + 1)
+        return self.last
+
+    def at(self, timestamp):
+        return (int(timestamp * 1000) - DISCORD_EPOCH) << 22
+
+
+class FakeHTTP:
+    # Takes the place of disnake's HTTPClient. Edits are recorded and the
+    # updated channel is sent back as a CHANNEL_UPDATE, as Discord would.
+    def __init__(self, state, latency=0.0):
+        self.state = state
+        self.latency = latency
+
+        self.channels = {}
+        self.edits = 0
+        self.edits_by_channel = {}
+
+    def add_channel(self, payload):
+        self.channels[int(payload["id"])] = payload
+
+    async def edit_channel(self, channel_id, *, reason=None, **options):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        payload = self.channels[int(channel_id)]
+        payload.update(options)
+
+        self.edits += 1
+        self.edits_by_channel[channel_id] = self.edits_by_channel.get(channel_id, 0) + 1
+
+        asyncio.get_running_loop().call_soon(
+            self.state.parse_channel_update, dict(payload)
+        )
+        return dict(payload)
+
+    async def close(self):
+        pass
+
+
+class FakeHistory:
+    # Stands in for channel.history as a HistoryPrefill provider, with
+    # exponential gaps back from the channel's last message
+    def __init__(self, latency=0.0, gap=5.0, seed=0):
+        self.latency = latency
+        self.gap = gap
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    async def __call__(self, channel, limit):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.requests += 1
+
+        timestamp = last_activity(channel)
+        timestamps = []
+        for _ in range(limit):
+            timestamps.append(timestamp)
+            timestamp -= self.random.expovariate(1 / self.gap)
+
+        return timestamps
+
+
+class FakeGateway:
+    # Builds the simulated guilds and turns them into events
+    def __init__(self, args, state, http):
+        self.args = args
+        self.state = state
+        self.http = http
+        self.random = random.Random(args.seed)
+        self.ids = Snowflakes()
+
+        self.bot_user = {
+            "id": str(self.ids.next()),
+            "username": "slowmode",
+            "discriminator": "0",
+            "avatar": None,
+            "bot": True,
+        }
+
+        # Every channel messages can land in and the authors for each guild,
+        # as (guild_id, channel_id) and (user payload, role ids)
+        self.channels = []
+        self.monitored = []
+        self.authors = {}
+        self.weights = None
+
+    def role(self, role_id, name, permissions, position):
+        return {
+            "id": str(role_id),
+            "name": name,
+            "permissions": str(permissions),
+            "position": position,
+            "color": 0,
+            "colors": {
+                "primary_color": 0,
+                "secondary_color": None,
+                "tertiary_color": None,
+            },
+            "hoist": False,
+            "managed": False,
+            "mentionable": False,
+        }
+
+    def member(self, user, roles):
+        return {
+            "user": user,
+            "roles": [str(r) for r in roles],
+            "joined_at": "2020-01-01T00:00:00+00:00",
+            "deaf": False,
+            "mute": False,
+        }
+
+    def guild(self):
+        args = self.args
+        guild_id = self.ids.next()
+        bot_role, mod_role = self.ids.next(), self.ids.next()
+
+        channels = []
+        for i in range(args.channels + args.unmonitored):
+            channel_id = self.ids.next()
+
+            # Channels the bot has been locked out of managing
+            overwrites = []
+            if self.random.random() < args.no_permission:
+                overwrites.append(
+                    {
+                        "id": str(bot_role),
+                        "type": 0,
+                        "allow": "0",
+                        "deny": str(MANAGE_CHANNELS),
+                    }
+                )
+
+            channel = {
+                "id": str(channel_id),
+                "type": 0,
+                "guild_id": str(guild_id),
+                "name": f"channel-{i}",
+                "position": i,
+                "permission_overwrites": overwrites,
+                "rate_limit_per_user": 0,
+                "nsfw": False,
+                "parent_id": None,
+                "topic": None,
+                # Recent activity, for the history prefill to order channels by
+                "last_message_id": str(
+                    self.ids.at(time.time() - self.random.uniform(0, args.last_active))
+                ),
+            }
+            channels.append(channel)
+            self.http.add_channel(channel)
+
+            self.channels.append((guild_id, channel_id))
+            if i < args.channels:
+                self.monitored.append((guild_id, channel_id))
+
+        # Moderators bypass slowmode, plain members don't
+        authors = []
+        for i in range(args.members):
+            user = {
+                "id": str(self.ids.next()),
+                "username": f"user-{i}",
+                "discriminator": "0",
+                "avatar": None,
+                "bot": self.random.random() < args.bot_authors,
+            }
+            roles = [mod_role] if self.random.random() < args.moderators else []
+            authors.append((user, roles))
+        self.authors[guild_id] = authors
+
+        return {
+            "id": str(guild_id),
+            "name": f"guild-{guild_id}",
+            "owner_id": authors[0][0]["id"],
+            "roles": [
+                self.role(guild_id, "@everyone", VIEW_AND_SEND, 0),
+                self.role(bot_role, "slowmode", MANAGE_CHANNELS, 1),
+                self.role(mod_role, "moderator", MANAGE_MESSAGES, 2),
+            ],
+            "channels": channels,
+            "members": [self.member(self.bot_user, [bot_role])],
+            "member_count": args.members + 1,
+            "features": [],
+            "emojis": [],
+            "stickers": [],
+            "large": False,
+            "unavailable": False,
+        }
+
+    def connect(self):
+        self.state.user = disnake.ClientUser(state=self.state, data=self.bot_user)
+
+        # No member chunking, every member the bot needs is in the payloads
+        self.state._chunk_guilds = False
+
+        for _ in range(self.args.guilds):
+            self.state.parse_guild_create(self.guild())
+
+        # Busier channels get more of the traffic, Zipf-style
+        self.weights = []
+        total = 0.0
+        for rank in range(len(self.channels)):
+            total += 1 / (rank + 1) ** self.args.skew
+            self.weights.append(total)
+        self.random.shuffle(self.channels)
+
+    def message(self):
+        guild_id, channel_id = self.random.choices(
+            self.channels, cum_weights=self.weights
+        )[0]
+        user, roles = self.random.choice(self.authors[guild_id])
+        message_id = self.ids.next()
+
+        return {
+            "id": str(message_id),
+            "channel_id": str(channel_id),
+            "guild_id": str(guild_id),
+            "author": user,
+            "member": {
+                "roles": [str(r) for r in roles],
+                "joined_at": "2020-01-01T00:00:00+00:00",
+                "deaf": False,
+                "mute": False,
+            },
+            "content": "soak",
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0,
+        }
+
+    def send(self, count):
+        for _ in range(count):
+            self.state.parse_message_create(self.message())
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as o:
+            return int(o.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Only the peak is available elsewhere, in KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def histogram_sum(histogram):
+    # (seconds, calls) summed over every label set
+    total = count = 0
+    for data in histogram.values.values():
+        total += data[1]
+        count += data[2]
+
+    return total, count
+
+
+def counter_total(counter, **labels):
+    wanted = set(labels.items())
+    return sum(v for k, v in counter.values.items() if wanted <= set(k))
+
+
+class Stats:
+    def __init__(self, http):
+        self.http = http
+        self.started = time.perf_counter()
+        self.rss_start = rss_bytes()
+
+        self.lag_max = 0.0
+        self.lag_all = 0.0
+        self.last = self.snapshot()
+
+    def snapshot(self):
+        return {
+            "time": time.perf_counter(),
+            "events": counter_total(on_message_results),
+            "accepted": counter_total(on_message_results, stage="accepted"),
+            "db": histogram_sum(db_latency),
+            "process": histogram_sum(process_latency),
+            "edits": self.http.edits,
+        }
+
+    async def measure_lag(self, interval=0.05):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = time.perf_counter() - started - interval
+            self.lag_max = max(self.lag_max, lag)
+            self.lag_all = max(self.lag_all, lag)
+
+    def report(self):
+        now = self.snapshot()
+        last, self.last = self.last, now
+        elapsed = now["time"] - last["time"]
+
+        db_seconds = now["db"][0] - last["db"][0]
+        db_calls = now["db"][1] - last["db"][1]
+        rss = rss_bytes()
+
+        line = (
+            f"[{now['time'] - self.started:7.0f}s] "
+            f"{(now['events'] - last['events']) / elapsed:8.0f} events/s "
+            f"({(now['accepted'] - last['accepted']) / elapsed:.0f} accepted)  "
+            f"lag max {self.lag_max * 1000:6.1f}ms  "
+            f"rss {rss / 2**20:7.1f}MiB ({(rss - self.rss_start) / 2**20:+.1f})  "
+            f"db {db_calls} calls {1000 * db_seconds / max(db_calls, 1):.2f}ms avg  "
+            f"edits {now['edits'] - last['edits']}"
+        )
+        self.lag_max = 0.0
+
+        return line
+
+
+async def drive(args, bot, gateway, stats):
+    # Sends events at the given rate, or as fast as on_message keeps up
+    step = 0.01
+    sent = 0
+    started = time.perf_counter()
+    next_report = started + args.report
+
+    while time.perf_counter() - started < args.duration:
+        if args.rate:
+            due = int((time.perf_counter() - started) * args.rate) - sent
+            gateway.send(due)
+            sent += due
+            await asyncio.sleep(step)
+        else:
+            # Keep a bounded number of events waiting on the loop
+            backlog = sent - counter_total(on_message_results)
+            if backlog < args.batch:
+                gateway.send(args.batch)
+                sent += args.batch
+            await asyncio.sleep(0)
+
+        if time.perf_counter() >= next_report:
+            print(stats.report(), flush=True)
+            next_report += args.report
+
+    return sent
+
+
+async def run(args, bot):
+    state = bot._connection
+    http = FakeHTTP(state, latency=args.edit_latency)
+    bot.http = state.http = http
+
+    gateway = FakeGateway(args, state, http)
+
+    started = time.perf_counter()
+    gateway.connect()
+    await bot.on_ready()
+    print(
+        f"Connected {args.guilds} guilds, {len(gateway.channels)} channels "
+        f"in {time.perf_counter() - started:.1f}s",
+        flush=True,
+    )
+
+    # Set the channels up the way admins would, one /monitor add at a time
+    started = time.perf_counter()
+    # Client.get_channel searches every guild in turn, so go through the guild
+    for guild_id, channel_id in gateway.monitored:
+        channel = bot.get_guild(guild_id).get_channel(channel_id)
+        await bot.monitors.start_monitoring(channel)
+    print(
+        f"Monitoring {len(gateway.monitored)} channels "
+        f"after {time.perf_counter() - started:.1f}s",
+        flush=True,
+    )
+
+    stats = Stats(http)
+    lag_task = asyncio.create_task(stats.measure_lag())
+
+    # Runs alongside the traffic, as it would after on_ready
+    prefill = None
+    if args.prefill:
+        history = FakeHistory(args.history_latency, seed=args.seed)
+        prefill = HistoryPrefill(
+            bot.monitors,
+            provider=history,
+            concurrency=args.prefill_concurrency,
+            rate=args.prefill_rate,
+            burst=args.prefill_rate,
+        )
+        prefill.start(
+            bot.get_guild(guild_id).get_channel(channel_id)
+            for guild_id, channel_id in gateway.monitored
+        )
+        prefill.task.add_done_callback(
+            lambda _: print(
+                f"Prefill done after {time.perf_counter() - stats.started:.1f}s, "
+                f"{history.requests} history requests",
+                flush=True,
+            )
+        )
+
+    try:
+        sent = await drive(args, bot, gateway, stats)
+    finally:
+        lag_task.cancel()
+        if prefill:
+            await prefill.stop()
+
+    elapsed = time.perf_counter() - stats.started
+    processed = counter_total(on_message_results)
+    print(
+        f"Sent {sent} events, {processed} handled in {elapsed:.0f}s "
+        f"({processed / elapsed:.0f}/s), worst lag {stats.lag_all * 1000:.1f}ms, "
+        f"rss grew {(rss_bytes() - stats.rss_start) / 2**20:+.1f}MiB, "
+        f"{http.edits} edits over {len(http.edits_by_channel)} channels",
+        flush=True,
+    )
+
+    await bot.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=500)
+    parser.add_argument(
+        "--channels", type=int, default=4, help="Monitored channels per guild"
+    )
+    parser.add_argument(
+        "--unmonitored", type=int, default=4, help="Unmonitored channels per guild"
+    )
+    parser.add_argument("--members", type=int, default=50, help="Authors per guild")
+    parser.add_argument(
+        "--moderators",
+        type=float,
+        default=0.05,
+        help="Share of authors whose role bypasses slowmode",
+    )
+    parser.add_argument(
+        "--bot-authors", type=float, default=0.02, help="Share of authors that are bots"
+    )
+    parser.add_argument(
+        "--no-permission",
+        type=float,
+        default=0.05,
+        help="Share of channels the bot is denied MANAGE_CHANNELS in",
+    )
+    parser.add_argument(
+        "--skew", type=float, default=1.1, help="Zipf exponent of channel activity"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=2000, help="Events per second, 0 for flat out"
+    )
+    parser.add_argument(
+        "--batch", type=int, default=100, help="Events in flight at once with --rate 0"
+    )
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--report", type=float, default=10)
+    parser.add_argument(
+        "--edit-latency", type=float, default=0.05, help="Seconds each fake edit takes"
+    )
+    parser.add_argument(
+        "--last-active",
+        type=float,
+        default=7200,
+        help="Channels' last messages are spread over this many seconds before startup",
+    )
+    parser.add_argument(
+        "--prefill", action="store_true", help="Prefill queues from a fake history"
+    )
+    parser.add_argument("--prefill-concurrency", type=int, default=4)
+    parser.add_argument(
+        "--prefill-rate", type=float, default=50, help="History requests per second"
+    )
+    parser.add_argument(
+        "--history-latency",
+        type=float,
+        default=0.1,
+        help="Seconds each fake history request takes",
+    )
+    parser.add_argument(
+        "--config",
+        default="config.sample.yaml",
+        help="Config to take the bot's settings from",
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.config) as o:
+        config = yaml.safe_load(o) or {}
+
+    directory = tempfile.mkdtemp(prefix="slowmode-soak-")
+    config["DATABASE_FILEPATH"] = os.path.join(directory, "slowmode.db")
+    config["LOG_LEVEL"] = args.log_level
+    if config.get("RECORDER_PATH"):
+        config["RECORDER_PATH"] = os.path.join(directory, "history")
+
+    config_fp = os.path.join(directory, "config.yaml")
+    with open(config_fp, "w") as o:
+        yaml.safe_dump(config, o)
+
+    os.environ["SLOWMODE_CONFIG"] = config_fp
+    os.environ.setdefault("METRICS_PORT", "0")
+
+    # Only importable once the config above is in place
+    import bot
+
+    print(f"Database and config in {directory}", flush=True)
+    asyncio.run(run(args, bot.bot))
+
+
+if __name__ == "__main__":
+    main()
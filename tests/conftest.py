@@ -0,0 +1,82 @@
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+# The bot's modules sit at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ChannelMonitors import ChannelMonitors
+from DBInterface import DBInterface
+from HistoryPrefill import DISCORD_EPOCH
+
+
+class FakeChannel:
+    # Just enough of a disnake TextChannel for ChannelMonitors and the
+    # EditCoalescer; edits are applied straight away and remembered
+    def __init__(self, channel_id, slowmode_delay=0, last_message_at=None, guild_id=10):
+        self.id = channel_id
+        self.name = str(channel_id)
+        self.guild = SimpleNamespace(id=guild_id, name="guild")
+        self.slowmode_delay = slowmode_delay
+        self.last_message_id = (
+            int((last_message_at or time.time()) * 1000 - DISCORD_EPOCH) << 22
+        )
+        self.edits = []
+
+    async def edit(self, slowmode_delay):
+        self.slowmode_delay = slowmode_delay
+        self.edits.append(slowmode_delay)
+
+
+@pytest.fixture
+def make_channel():
+    return FakeChannel
+
+
+@pytest.fixture
+def db_fp(tmp_path):
+    return str(tmp_path / "slowmode.db")
+
+
+@pytest.fixture
+def run_db(db_fp):
+    # Runs step(db) against a DBInterface initialized on the database and
+    # closed afterwards, as one run of the bot; calling it again is a restart.
+    # Without a step, returns what initialize_database did. options are
+    # passed to DBInterface, everything else to initialize_database.
+    def run(step=None, fp=None, options=None, **kwargs):
+        async def go():
+            db = DBInterface(fp or db_fp, **(options or {}))
+            try:
+                configs = await db.initialize_database(**kwargs)
+                return await step(db) if step else configs
+            finally:
+                await db.close()
+
+        return asyncio.run(go())
+
+    return run
+
+
+@pytest.fixture
+def run_monitors(db_fp):
+    # The same for ChannelMonitors. Only the channels given exist as far as
+    # it can tell, and guilds is passed on to initialize.
+    def run(step, channels=(), guilds=None, **kwargs):
+        by_id = {channel.id: channel for channel in channels}
+
+        async def go():
+            monitors = ChannelMonitors(db_fp, by_id.get, **kwargs)
+            try:
+                await monitors.initialize(guilds)
+                return await step(monitors)
+            finally:
+                await monitors.close()
+
+        return asyncio.run(go())
+
+    return run
@@ -0,0 +1,71 @@
+from ChannelConfigObject import ChannelConfigObject
+
+MONITORED = (1, 10, 0, 30, 15, 1.0, 1, 5, 1, "count")
+UNMONITORED = (2, 10, 0, 30, 15, 1.0, 0, 5, 1, "count")
+
+
+async def insert_rows(db):
+    await db.insert_channel_monitor(MONITORED)
+    await db.insert_channel_monitor(UNMONITORED)
+
+
+def test_config_update_on_uncached_unmonitored_row(run_db):
+    # After a restart only monitored rows are cached
+    run_db(insert_rows)
+
+    async def update(db):
+        config = ChannelConfigObject.from_db(UNMONITORED)
+        config.slowmode_max = 60
+        await db.update_channel_config(config)
+
+    run_db(update)
+    row = run_db(lambda db: db.get_channel_monitor(2))
+
+    # The stored monitoring flag is kept
+    assert row[3] == 60
+    assert row[6] == 0
+
+
+def test_monitoring_update_on_uncached_row(run_db):
+    run_db(insert_rows)
+
+    async def monitor(db):
+        await db.update_channel_monitoring(2, True)
+        await db.update_channel_monitoring(3, True)
+
+    run_db(monitor)
+
+    # Channels without a row are left alone
+    assert sorted(run_db(lambda db: db.get_guild_monitors(10))) == [1, 2]
+    assert run_db(lambda db: db.get_channel_monitor(3)) is None
+
+
+def test_start_monitoring_many_fetches_misses_together(
+    run_db, run_monitors, make_channel
+):
+    # 2 has an unmonitored row that isn't cached after a restart, 3 and 4 have
+    # none, and 1 is already monitored
+    run_db(insert_rows)
+    channels = [make_channel(channel_id) for channel_id in (1, 2, 3, 4)]
+
+    async def start(monitors):
+        selects = []
+        execute = monitors.db.db.execute
+
+        def counted(sql, *args):
+            if sql.startswith("SELECT"):
+                selects.append(sql)
+            return execute(sql, *args)
+
+        monitors.db.db.execute = counted
+        added, skipped = await monitors.start_monitoring_many(channels)
+        monitors.db.db.execute = execute
+        return [c.id for c in added], [c.id for c in skipped], len(selects)
+
+    added, skipped, selects = run_monitors(start, channels)
+
+    assert (added, skipped, selects) == ([2, 3, 4], [1], 1)
+    assert sorted(run_db(lambda db: db.get_guild_monitors(10))) == [1, 2, 3, 4]
+
+    # The stored settings of 2 are kept
+    assert run_db(lambda db: db.get_channel_monitor(2))[1:6] == UNMONITORED[1:6]
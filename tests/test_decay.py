@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+import pytest
+
+from TickEngine import TickEngine, np
+
+
+def restart(run_monitors, channels, **kwargs):
+    # Monitors channels, restarts without any messages and lets the decay
+    # timers come due. Returns the slowmode each ends at.
+    clock = [time.time()]
+
+    async def monitor(monitors):
+        for channel in channels:
+            await monitors.start_monitoring(channel)
+
+    async def decay(monitors):
+        for _ in range(3):
+            clock[0] += 30
+            await monitors.check_decay()
+            if monitors.engine:
+                await monitors.tick()
+            await asyncio.sleep(0)
+
+    run_monitors(monitor)
+    run_monitors(
+        decay,
+        channels,
+        decay_interval=30,
+        wall_clock=lambda: clock[0],
+        **kwargs,
+    )
+
+    return [channel.slowmode_delay for channel in channels]
+
+
+def test_raised_slowmode_decays_after_restart(run_monitors, make_channel):
+    an_hour_ago = time.time() - 3600
+    channels = [make_channel(1, 30, an_hour_ago), make_channel(2, 0, an_hour_ago)]
+
+    assert restart(run_monitors, channels) == [0, 0]
+
+
+@pytest.mark.skipif(np is None, reason="the tick engine requires numpy")
+def test_raised_slowmode_decays_after_restart_in_tick_mode(run_monitors, make_channel):
+    channels = [make_channel(1, 30, time.time() - 3600)]
+
+    assert restart(run_monitors, channels, engine=TickEngine()) == [0]
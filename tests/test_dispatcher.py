@@ -0,0 +1,64 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from MessageDispatcher import MessageDispatcher
+
+
+class Monitors:
+    def __init__(self):
+        self.batches = []
+
+    async def process_messages(self, channel, timestamps):
+        self.batches.append(list(timestamps))
+
+
+def dispatch(overflow, timestamps, max_pending=100):
+    async def go():
+        monitors = Monitors()
+        dispatcher = MessageDispatcher(
+            monitors, workers=1, max_pending=max_pending, overflow=overflow
+        )
+        channel = SimpleNamespace(id=1)
+
+        # Everything is queued before the worker gets to run
+        for timestamp in timestamps:
+            dispatcher.submit(channel, timestamp)
+
+        dispatcher.start()
+        await asyncio.sleep(0)
+        await dispatcher.stop()
+
+        return dispatcher, monitors.batches
+
+    return asyncio.run(go())
+
+
+def test_drop_oldest_keeps_the_newest():
+    timestamps = [float(i) for i in range(250)]
+    dispatcher, batches = dispatch("drop_oldest", timestamps)
+
+    assert batches == [timestamps[-100:]]
+    assert dispatcher.overflowed == 150
+
+
+def test_merge_keeps_count_and_span():
+    timestamps = [i * 0.5 for i in range(250)]
+    dispatcher, batches = dispatch("merge", timestamps)
+
+    (batch,) = batches
+    assert len(batch) == len(timestamps)
+    assert batch[0] == timestamps[0]
+    assert batch[-100:] == timestamps[-100:]
+    assert batch == sorted(batch)
+    assert batch[149] == pytest.approx(timestamps[149])
+    assert dispatcher.overflowed == 150
+    assert not dispatcher.folded
+
+
+def test_merge_under_capacity_is_exact():
+    timestamps = [float(i) for i in range(50)]
+    _, batches = dispatch("merge", timestamps)
+
+    assert batches == [timestamps]
@@ -0,0 +1,168 @@
+import asyncio
+import time
+
+from benchmark import FakeGuild, FakeRateLimiter, RateLimitedChannel
+from EditDispatcher import EditDispatcher
+
+
+class LoggedChannel(RateLimitedChannel):
+    # Records every edit the fake API accepted, in order, across channels
+    def __init__(self, channel_id, guild, limiter, log):
+        super().__init__(channel_id, guild, limiter, latency=0)
+        self.log = log
+
+    async def edit(self, slowmode_delay):
+        await super().edit(slowmode_delay)
+        self.log.append((self.id, slowmode_delay, time.monotonic()))
+
+
+def run_dispatcher(step, limits=(1000, 1000, 1000, 1000), **kwargs):
+    # Runs step(dispatcher, limiter) with the dispatcher started and stopped
+    # around it; kwargs set the dispatcher's buckets
+    async def go():
+        limiter = FakeRateLimiter(*limits)
+        dispatcher = EditDispatcher(**kwargs)
+        dispatcher.start()
+        try:
+            return await step(dispatcher, limiter)
+        finally:
+            await dispatcher.stop()
+
+    return asyncio.run(go())
+
+
+async def settle(log, count, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while len(log) < count and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+
+def test_increases_go_before_decreases():
+    async def step(dispatcher, limiter):
+        log = []
+        guild = FakeGuild(1)
+        channels = [LoggedChannel(i, guild, limiter, log) for i in range(4)]
+        for channel in channels:
+            channel.slowmode_delay = 10
+
+        # Everything is queued before the dispatcher gets to run
+        dispatcher.submit(channels[0], 0)
+        dispatcher.submit(channels[1], 0)
+        dispatcher.submit(channels[2], 20)
+        dispatcher.submit(channels[3], 60)
+
+        await settle(log, 4)
+        return [channel_id for channel_id, _, _ in log]
+
+    order = run_dispatcher(step, guild_rate=20, guild_burst=1)
+
+    # Largest increase first, decreases in the order they came in
+    assert order == [3, 2, 0, 1]
+
+
+def test_newer_request_replaces_older():
+    async def step(dispatcher, limiter):
+        log = []
+        guild = FakeGuild(1)
+        blocker = LoggedChannel(0, guild, limiter, log)
+        channel = LoggedChannel(1, guild, limiter, log)
+
+        dispatcher.submit(blocker, 5)
+        for desired in (10, 20, 30):
+            dispatcher.submit(channel, desired)
+
+        await settle(log, 2)
+        await asyncio.sleep(0.1)
+        return channel.edits, dispatcher.queue_depth()
+
+    edits, depth = run_dispatcher(step, guild_rate=20, guild_burst=1)
+
+    assert edits == [30]
+    assert depth == 0
+
+
+def test_guild_429_blocks_bucket_and_retries():
+    # The dispatcher thinks it may send 10 edits at once, the API allows one
+    # every 0.2s per guild
+    async def step(dispatcher, limiter):
+        log = []
+        guild = FakeGuild(1)
+        channels = [LoggedChannel(i, guild, limiter, log) for i in range(2)]
+
+        started = time.monotonic()
+        for channel in channels:
+            dispatcher.submit(channel, 10)
+
+        await settle(log, 1)
+        await asyncio.sleep(0.05)
+        blocked = dispatcher.guild_bucket(1).blocked_until - started
+        global_blocked = dispatcher.global_bucket.blocked_until
+
+        await settle(log, 2)
+        return log, started, blocked, global_blocked, limiter.rejected
+
+    log, started, blocked, global_blocked, rejected = run_dispatcher(
+        step, limits=(5, 1, 1000, 1000), guild_rate=100, guild_burst=10
+    )
+
+    assert rejected == 1
+    assert 0.1 < blocked <= 0.3
+    assert global_blocked == 0
+    assert sorted(channel_id for channel_id, _, _ in log) == [0, 1]
+    assert log[1][2] - started >= blocked
+
+
+def test_global_429_blocks_global_bucket():
+    # Two guilds with room to spare, but the API's global limit is one edit
+    # every 0.2s
+    async def step(dispatcher, limiter):
+        log = []
+        channels = [LoggedChannel(i, FakeGuild(i), limiter, log) for i in range(2)]
+
+        started = time.monotonic()
+        for channel in channels:
+            dispatcher.submit(channel, 10)
+
+        await settle(log, 1)
+        await asyncio.sleep(0.05)
+        blocked = dispatcher.global_bucket.blocked_until - started
+        guild_blocked = [dispatcher.guild_bucket(i).blocked_until for i in range(2)]
+
+        await settle(log, 2)
+        return log, blocked, guild_blocked
+
+    log, blocked, guild_blocked = run_dispatcher(
+        step,
+        limits=(1000, 1000, 5, 1),
+        global_rate=100,
+        global_burst=10,
+    )
+
+    assert 0.1 < blocked <= 0.3
+    assert guild_blocked == [0, 0]
+    assert len(log) == 2
+
+
+def test_retry_defers_to_newer_request():
+    # A request submitted while the rate limited edit was on the wire wins
+    async def step(dispatcher, limiter):
+        log = []
+        guild = FakeGuild(1)
+        first = LoggedChannel(0, guild, limiter, log)
+        channel = LoggedChannel(1, guild, limiter, log)
+        channel.latency = 0.05
+
+        dispatcher.submit(first, 10)
+        await settle(log, 1)
+        dispatcher.submit(channel, 10)
+        await asyncio.sleep(0.01)
+        dispatcher.submit(channel, 20)
+
+        await settle(log, 2)
+        await asyncio.sleep(0.3)
+        return channel.edits, limiter.rejected
+
+    edits, rejected = run_dispatcher(step, limits=(5, 1, 1000, 1000), guild_rate=100)
+
+    assert rejected == 1
+    assert edits == [20]
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+from benchmark import FakeRateLimited
+from HistoryPrefill import HistoryPrefill, last_activity
+
+
+class FakeProvider:
+    # History one second apart back from the channel's last message. Channels
+    # in rate_limited get a 429 the first time they're asked for.
+    def __init__(self, rate_limited=(), retry_after=0.2):
+        self.rate_limited = set(rate_limited)
+        self.retry_after = retry_after
+        self.calls = []
+
+    async def __call__(self, channel, limit):
+        self.calls.append(channel.id)
+
+        if channel.id in self.rate_limited:
+            self.rate_limited.discard(channel.id)
+            raise FakeRateLimited(self.retry_after, False)
+
+        end = last_activity(channel)
+        return [end - i for i in range(limit)]
+
+
+def prefill(
+    run_monitors,
+    make_channel,
+    ages,
+    step=None,
+    monitored=None,
+    max_hot_queues=0,
+    provider=None,
+    **kwargs,
+):
+    # One channel per age in seconds since its last message, all monitored
+    # unless monitored says otherwise, prefilled one at a time. Returns the
+    # provider and whatever step(monitors, channels, prefill) does after.
+    now = time.time()
+    channels = [
+        make_channel(channel_id, last_message_at=now - age)
+        for channel_id, age in enumerate(ages, 1)
+    ]
+    monitored = [channel.id for channel in channels] if monitored is None else monitored
+    provider = provider or FakeProvider()
+
+    async def go(monitors):
+        for channel in channels:
+            if channel.id in monitored:
+                await monitors.start_monitoring(channel)
+
+        history = HistoryPrefill(
+            monitors, provider, concurrency=1, rate=1000, burst=1000, **kwargs
+        )
+        history.start(channels)
+        result = await step(monitors, channels, history) if step else None
+        await history.task
+        return result
+
+    return provider, run_monitors(go, channels, max_hot_queues=max_hot_queues)
+
+
+def test_busiest_channels_go_first(run_monitors, make_channel):
+    provider, _ = prefill(run_monitors, make_channel, [300, 10, 1200, 60])
+
+    assert provider.calls == [2, 4, 1, 3]
+
+
+def test_quiet_unmonitored_and_overflowing_channels_are_skipped(
+    run_monitors, make_channel
+):
+    # 3 is older than max_age, 4 isn't monitored and only two fit as hot queues
+    provider, _ = prefill(
+        run_monitors,
+        make_channel,
+        [10, 20, 7200, 5, 30],
+        monitored=[1, 2, 3, 5],
+        max_age=3600,
+        max_hot_queues=2,
+    )
+
+    assert provider.calls == [1, 2]
+
+
+def test_rate_limited_channel_is_requeued(run_monitors, make_channel):
+    async def step(monitors, channels, history):
+        await asyncio.sleep(0.05)
+        blocked = history.bucket.blocked_until - time.monotonic()
+
+        await history.task
+        return blocked, [monitors.needs_prefill(channel.id) for channel in channels]
+
+    provider, (blocked, needs_prefill) = prefill(
+        run_monitors, make_channel, [10, 20, 30], step, provider=FakeProvider([1])
+    )
+
+    # The 429 holds everything back for Retry-After, then 1 goes last
+    assert 0.1 < blocked <= 0.2
+    assert provider.calls == [1, 2, 3, 1]
+    assert needs_prefill == [False, False, False]
+
+
+def test_live_messages_stay_above_history(run_monitors, make_channel):
+    # Messages that came in before the history did are kept as the newest;
+    # history overlapping them is left out
+    now = time.time()
+    live = [now - 2, now - 1, now]
+
+    async def go(monitors):
+        channel = make_channel(1, last_message_at=now)
+        await monitors.start_monitoring(channel)
+        await monitors.process_messages(channel, live)
+
+        q = monitors.get_queue(1)
+        history = [now - 1.5 - i for i in range(20)]
+        filled = monitors.prefill_channel(1, history)
+        timestamps = list(monitors.live_timestamps(1, q))
+
+        return filled, timestamps, monitors.prefill_channel(1, history)
+
+    filled, timestamps, refilled = run_monitors(go)
+
+    assert filled
+    assert timestamps[-3:] == live
+    assert timestamps[:-3] == [now - 2.5 - i for i in range(11, -1, -1)]
+    assert not refilled
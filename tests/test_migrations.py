@@ -0,0 +1,180 @@
+import os
+import shutil
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from DBInterface import MIGRATIONS
+
+# Checked in as it was before the schema was versioned: the original seven
+# columns, no queue_snapshots table and user_version 0
+OLD_DB = os.path.join(os.path.dirname(os.path.dirname(__file__)), "slowmode.db")
+
+
+@pytest.fixture
+def db_fp(tmp_path):
+    # Every test upgrades a copy of the old database
+    fp = str(tmp_path / "slowmode.db")
+    shutil.copy(OLD_DB, fp)
+    return fp
+
+
+def schema(db_fp):
+    with sqlite3.connect(db_fp) as conn:
+        return {
+            "version": conn.execute("PRAGMA user_version;").fetchone()[0],
+            "columns": [
+                row[1] for row in conn.execute("PRAGMA table_info(channel_monitors);")
+            ],
+            "objects": sorted(
+                conn.execute("SELECT type, name, sql FROM sqlite_master;").fetchall(),
+                key=lambda row: row[1],
+            ),
+            "rows": conn.execute(
+                "SELECT * FROM channel_monitors ORDER BY channel_id;"
+            ).fetchall(),
+        }
+
+
+def test_old_database_is_old():
+    before = schema(OLD_DB)
+
+    assert before["version"] == 0
+    assert "edit_interval" not in before["columns"]
+
+
+def test_upgrades_old_database_in_place(db_fp, run_db):
+    before = schema(db_fp)
+    configs = run_db()
+    after = schema(db_fp)
+
+    assert after["version"] == len(MIGRATIONS)
+    assert after["columns"] == before["columns"] + [
+        "edit_interval",
+        "hysteresis",
+        "estimator",
+    ]
+
+    names = {name for _, name, _ in after["objects"]}
+    assert {
+        "queue_snapshots",
+        "channel_monitors_guild",
+        "channel_monitors_monitored",
+    } <= names
+
+    # Existing rows are kept and get the new columns' defaults
+    assert [row[:7] for row in after["rows"]] == before["rows"]
+    assert all(row[7:] == (5, 1, "count") for row in after["rows"])
+    assert len(configs) == sum(row[6] == 1 for row in before["rows"])
+
+
+def test_indexes_are_used(db_fp, run_db):
+    run_db()
+
+    with sqlite3.connect(db_fp) as conn:
+
+        def plan(query):
+            return " ".join(
+                row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query)
+            )
+
+        assert "channel_monitors_monitored" in plan(
+            "SELECT * FROM channel_monitors WHERE monitoring = 1;"
+        )
+        assert "channel_monitors_guild" in plan(
+            "SELECT * FROM channel_monitors WHERE guild_id = 1 AND monitoring = 1;"
+        )
+
+
+def test_second_run_changes_nothing(db_fp, run_db):
+    run_db()
+    first = schema(db_fp)
+    run_db()
+
+    assert schema(db_fp) == first
+
+
+def test_fresh_database_matches_upgraded(db_fp, run_db, tmp_path):
+    fresh_fp = str(tmp_path / "fresh.db")
+    run_db()
+    run_db(fp=fresh_fp)
+
+    upgraded, fresh = schema(db_fp), schema(fresh_fp)
+    assert fresh["version"] == upgraded["version"]
+    assert fresh["columns"] == upgraded["columns"]
+    assert [row[:2] for row in fresh["objects"]] == [
+        row[:2] for row in upgraded["objects"]
+    ]
+
+
+def test_newer_database_is_refused(db_fp, run_db):
+    with sqlite3.connect(db_fp) as conn:
+        conn.execute(f"PRAGMA user_version = {len(MIGRATIONS) + 1};")
+    before = schema(db_fp)
+
+    with pytest.raises(RuntimeError):
+        run_db()
+
+    assert schema(db_fp) == before
+
+
+def guild_ids(db_fp):
+    with sqlite3.connect(db_fp) as conn:
+        return {
+            row[0]
+            for row in conn.execute("SELECT DISTINCT guild_id FROM channel_monitors;")
+        }
+
+
+def test_purges_departed_guilds(db_fp, run_db):
+    guilds = sorted(guild_ids(db_fp))
+    with sqlite3.connect(db_fp) as conn:
+        channel_id = conn.execute(
+            "SELECT channel_id FROM channel_monitors WHERE guild_id = ?;",
+            (guilds[0],),
+        ).fetchone()[0]
+
+    run_db()
+    with sqlite3.connect(db_fp) as conn:
+        conn.execute(
+            "INSERT INTO queue_snapshots VALUES (?, 'count', 0, x'');", (channel_id,)
+        )
+
+    # The last guild belongs to another worker process and is left alone
+    configs = run_db(
+        guild_ids=guilds[1:-2],
+        guild_filter=lambda guild_id: guild_id != guilds[-1],
+    )
+
+    assert guild_ids(db_fp) == set(guilds[1:-2]) | {guilds[-1]}
+    assert all(config.guild_id in guild_ids(db_fp) for config in configs)
+    with sqlite3.connect(db_fp) as conn:
+        assert not conn.execute("SELECT * FROM queue_snapshots;").fetchall()
+
+
+def test_empty_guild_list_purges_nothing(db_fp, run_db):
+    before = guild_ids(db_fp)
+    run_db(guild_ids=[])
+
+    assert guild_ids(db_fp) == before
+
+
+def test_unavailable_guilds_skip_the_purge(db_fp, run_monitors):
+    guilds = sorted(guild_ids(db_fp))
+    present = [
+        SimpleNamespace(id=guild_id, unavailable=False, get_channel=lambda _: None)
+        for guild_id in guilds[:-1]
+    ]
+    unavailable = SimpleNamespace(
+        id=guilds[-1], unavailable=True, get_channel=lambda _: None
+    )
+
+    async def nothing(monitors):
+        pass
+
+    run_monitors(nothing, guilds=present + [unavailable], purge_departed=True)
+    assert guild_ids(db_fp) == set(guilds)
+
+    run_monitors(nothing, guilds=present, purge_departed=True)
+    assert guild_ids(db_fp) == set(guilds[:-1])
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from Recorder import Recorder, list_segments, np, read_rollups, read_samples
+
+pytestmark = pytest.mark.skipif(np is None, reason="the recorder requires numpy")
+
+
+def test_rollups_stay_current_without_full_segments(tmp_path):
+    path = str(tmp_path)
+
+    async def go():
+        recorder = Recorder(path, rollup_interval=0.05)
+        recorder.start()
+        try:
+            for i in range(10):
+                recorder.record(1, 1_600_000_000.0 + i, 2.0, 5, i == 0)
+            await asyncio.sleep(0.2)
+
+            return read_rollups(path, "1m"), read_rollups(path, "1h")
+        finally:
+            await recorder.close()
+
+    minutes, hours = asyncio.run(go())
+
+    for rows in (minutes, hours):
+        assert rows["samples"].sum() == 10
+        assert rows["edits"].sum() == 1
+        assert rows["slowmode_last"][-1] == 5
+
+
+def test_closed_segments_are_trimmed_and_readable(tmp_path):
+    path = str(tmp_path)
+
+    async def go():
+        recorder = Recorder(path, rollup_interval=0)
+        for i in range(3):
+            recorder.record(1, 1_600_000_000.0 + i, None, None, False)
+        await recorder.close()
+
+        # Picks up in a new segment, and the previous one can be rolled up
+        recorder = Recorder(path, rollup_interval=0)
+        recorder.record(2, 1_600_000_010.0, 1.0, 0, False)
+        recorder.rollup_segments()
+        await recorder.close()
+
+    asyncio.run(go())
+
+    (first, _) = list_segments(path, "raw")
+    assert (tmp_path / f"raw-{first:010d}.seg").stat().st_size == 3 * 32
+    assert len(read_samples(path)) == 4
+    assert read_rollups(path, "1m")["samples"].sum() == 3
+
+
+def test_rollups_merge_into_bounded_files(tmp_path):
+    # Five hours of samples in small segments, rolled up as they close
+    path = str(tmp_path)
+    start = 1_600_000_000.0 // 86400 * 86400
+
+    async def go():
+        recorder = Recorder(
+            path,
+            segment_records=100,
+            rollup_interval=0,
+            keep_rollup_days={"1m": 2 / 24},
+        )
+        try:
+            for i in range(5 * 60):
+                recorder.record(1, start + i * 60, 2.0, 5, False)
+                if i % 50 == 49:
+                    await asyncio.gather(*recorder.closing)
+                    await asyncio.to_thread(
+                        recorder.rollup_segments, recorder.active_segment()
+                    )
+        finally:
+            await recorder.close()
+
+        # Nothing new to roll up, so nothing is counted twice
+        recorder.rollup_segments()
+
+    asyncio.run(go())
+
+    assert len(list_segments(path, "1m")) == 2
+    assert len(list_segments(path, "1h")) == 1
+    assert read_rollups(path, "1h")["samples"].sum() == 300
+
+    minutes = read_rollups(path, "1m")
+    assert len(minutes) == 120
+    assert minutes["start"][0] == start + 3 * 3600
+    assert (minutes["samples"] == 1).all()
+
+
+def test_next_segment_is_opened_ahead(tmp_path):
+    path = str(tmp_path)
+
+    async def go():
+        recorder = Recorder(path, segment_records=4, rollup_interval=0.05)
+        recorder.start()
+        try:
+            recorder.record(1, 1_600_000_000.0, 1.0, 0, False)
+            await asyncio.sleep(0.1)
+            spare = recorder.spare
+
+            for i in range(1, 8):
+                recorder.record(1, 1_600_000_000.0 + i, 1.0, 0, False)
+            return spare, recorder.seq
+        finally:
+            await recorder.close()
+
+    spare, seq = asyncio.run(go())
+
+    assert spare is not None
+    assert seq >= spare[0]
+    assert len(read_samples(path)) == 8
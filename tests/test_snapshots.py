@@ -0,0 +1,82 @@
+import sqlite3
+import time
+from array import array
+
+import pytest
+
+from TickEngine import TickEngine, np
+
+CHANNELS = range(1, 21)
+
+
+def restore(run_monitors, make_channel, **kwargs):
+    # Saves a snapshot of ten messages for each of 20 monitored channels,
+    # restarts and returns how many were restored, how many queues that
+    # built and then every channel's timestamps
+    now = time.time()
+    timestamps = [now - 10 + i for i in range(10)]
+
+    async def save(monitors):
+        for channel_id in CHANNELS:
+            await monitors.db.insert_channel_monitor(
+                (channel_id, 10, 0, 30, 15, 1.0, 1, 5, 1, "count")
+            )
+        await monitors.db.save_snapshots(
+            [
+                (channel_id, "count", now, array("d", timestamps).tobytes())
+                for channel_id in CHANNELS
+            ],
+            0,
+        )
+
+    async def read(monitors):
+        restored, built = len(monitors.restored), len(monitors.channels)
+        queues = [
+            list(monitors.live_timestamps(channel_id, monitors.get_queue(channel_id)))
+            for channel_id in CHANNELS
+        ]
+        return restored, built, queues
+
+    run_monitors(save)
+    channels = [make_channel(channel_id) for channel_id in CHANNELS]
+    return timestamps, *run_monitors(read, channels, **kwargs)
+
+
+def test_restore_is_lazy_under_hot_limit(run_monitors, make_channel):
+    timestamps, restored, built, queues = restore(
+        run_monitors, make_channel, max_hot_queues=5
+    )
+
+    assert restored == len(CHANNELS)
+    assert built == 0
+    assert all(queue == timestamps for queue in queues)
+
+
+@pytest.mark.skipif(np is None, reason="the tick engine requires numpy")
+def test_restore_into_tick_engine(run_monitors, make_channel):
+    timestamps, _, _, queues = restore(
+        run_monitors, make_channel, max_hot_queues=5, engine=TickEngine()
+    )
+
+    assert all(queue == timestamps for queue in queues)
+
+
+def test_snapshots_follow_wall_clock(run_monitors, make_channel, db_fp):
+    # Saved with a wall clock an hour behind: the snapshot carries its time,
+    # and the cutoff doesn't prune one saved just before by the same clock
+    now = time.time() - 3600
+    channel = make_channel(1)
+
+    async def save(monitors):
+        await monitors.start_monitoring(channel)
+        await monitors.process_messages(channel, [now - 1, now])
+        await monitors.save_snapshots()
+        await monitors.process_messages(channel, [now + 1])
+        await monitors.save_snapshots()
+
+    run_monitors(save, [channel], wall_clock=lambda: now, snapshot_max_age=60)
+
+    with sqlite3.connect(db_fp) as conn:
+        assert conn.execute("SELECT saved_at FROM queue_snapshots;").fetchall() == [
+            (now,)
+        ]
@@ -0,0 +1,47 @@
+import time
+
+import pytest
+
+from TickEngine import TickEngine, np
+
+pytestmark = pytest.mark.skipif(np is None, reason="the tick engine requires numpy")
+
+
+def update(run_monitors, make_channel, *updates):
+    # Ten messages in tick mode, then each update in turn. Returns the
+    # queue's timestamps as the channel's estimator sees them.
+    now = time.time()
+    channel = make_channel(1, 0, now)
+    timestamps = [now - 10 + i for i in range(10)]
+
+    async def process(monitors):
+        await monitors.start_monitoring(channel)
+        await monitors.process_messages(channel, timestamps)
+        for settings in updates:
+            await monitors.update_channel(channel, **settings)
+
+        return list(
+            monitors.live_timestamps(channel.id, monitors.get_queue(channel.id))
+        )
+
+    return timestamps, run_monitors(process, [channel], engine=TickEngine())
+
+
+def test_estimator_switch_keeps_engine_history(run_monitors, make_channel):
+    timestamps, live = update(run_monitors, make_channel, {"estimator": "window"})
+
+    assert live == timestamps
+
+
+def test_switching_back_to_count_keeps_history(run_monitors, make_channel):
+    timestamps, live = update(
+        run_monitors, make_channel, {"estimator": "window"}, {"estimator": "count"}
+    )
+
+    assert live == timestamps
+
+
+def test_cache_size_change_keeps_engine_history(run_monitors, make_channel):
+    timestamps, live = update(run_monitors, make_channel, {"cache_size": 5})
+
+    assert live == timestamps[-5:]
@@ -0,0 +1,170 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import DBInterface
+from ChannelConfigObject import ChannelConfigObject
+
+
+def row(channel_id, slowmode_max=30, monitoring=1):
+    return (channel_id, 10, 0, slowmode_max, 15, 1.0, monitoring, 5, 1, "count")
+
+
+def stored(db_fp):
+    with sqlite3.connect(db_fp) as conn:
+        return {
+            row[0]: row
+            for row in conn.execute("SELECT * FROM channel_monitors;").fetchall()
+        }
+
+
+def count_writes(db):
+    # Wraps write_rows to record how many rows each transaction wrote
+    writes = []
+    write_rows = db.write_rows
+
+    async def counted(rows):
+        writes.append(len(rows))
+        await write_rows(rows)
+
+    db.write_rows = counted
+    return writes
+
+
+def test_repeated_writes_are_merged(run_db, db_fp):
+    async def write(db):
+        writes = count_writes(db)
+        await db.insert_channel_monitor(row(1))
+        for slowmode_max in (40, 50, 60):
+            await db.update_channel_config(
+                ChannelConfigObject.from_db(row(1, slowmode_max))
+            )
+        await db.update_channel_monitoring(1, False)
+
+        pending = len(db.pending)
+        await db.flush()
+        return pending, writes
+
+    pending, writes = run_db(write, options={"flush_interval": 60})
+
+    assert pending == 1
+    assert writes == [1]
+    assert stored(db_fp)[1] == row(1, 60, 0)
+
+
+def test_threshold_flushes_early(run_db, db_fp):
+    async def write(db):
+        for channel_id in range(1, 4):
+            await db.insert_channel_monitor(row(channel_id))
+            if channel_id < 3:
+                assert not stored(db_fp)
+
+        return len(db.pending)
+
+    pending = run_db(write, options={"flush_interval": 60, "flush_threshold": 3})
+
+    assert pending == 0
+    assert set(stored(db_fp)) == {1, 2, 3}
+
+
+def test_interval_flush(run_db, db_fp):
+    async def write(db):
+        await db.insert_channel_monitor(row(1))
+        before = stored(db_fp)
+        await asyncio.sleep(0.1)
+        return before, stored(db_fp)
+
+    before, after = run_db(write, options={"flush_interval": 0.05})
+
+    assert before == {}
+    assert after == {1: row(1)}
+
+
+def test_close_flushes_what_is_pending(run_db, db_fp):
+    async def write(db):
+        await db.insert_channel_monitor(row(1))
+        return stored(db_fp)
+
+    assert run_db(write, options={"flush_interval": 60}) == {}
+    assert stored(db_fp) == {1: row(1)}
+
+
+@pytest.mark.parametrize("flush_interval", [0.05, 0])
+def test_failed_flush_is_requeued(run_db, db_fp, monkeypatch, flush_interval):
+    # Writing through, the retry waits FLUSH_RETRY_DELAY instead
+    monkeypatch.setattr(DBInterface, "FLUSH_RETRY_DELAY", 0.05)
+
+    async def write(db):
+        write_rows = db.write_rows
+        failures = [RuntimeError("disk on fire")]
+
+        async def failing(rows):
+            if failures:
+                raise failures.pop()
+            await write_rows(rows)
+
+        db.write_rows = failing
+
+        # The threshold flushes inline, where the failure surfaces
+        with pytest.raises(RuntimeError):
+            await db.insert_channel_monitor(row(1))
+
+        requeued = list(db.pending), db.flush_task is not None
+        await asyncio.sleep(0.1)
+        return requeued, list(db.pending)
+
+    (pending, retrying), after = run_db(
+        write, options={"flush_interval": flush_interval, "flush_threshold": 1}
+    )
+
+    assert pending == [1]
+    assert retrying
+    assert after == []
+    assert stored(db_fp) == {1: row(1)}
+
+
+def test_busy_rollback_keeps_other_writes(run_db, db_fp):
+    # A snapshot save fails as locked while a flush is waiting to write; its
+    # rollback must not take the flushed rows along. Without serialized
+    # writes the flush would get in between the failing statement and the
+    # rollback.
+    async def write(db):
+        conn = db.db
+        execute, executemany = conn.execute, conn.executemany
+        flushing = asyncio.Event()
+        failures = []
+
+        async def failing_execute(sql, *args):
+            if sql.startswith("DELETE FROM queue_snapshots") and not failures:
+                failures.append(sql)
+                try:
+                    await asyncio.wait_for(flushing.wait(), 0.2)
+                except asyncio.TimeoutError:
+                    pass
+                raise sqlite3.OperationalError("database is locked")
+            return await execute(sql, *args)
+
+        async def slow_executemany(sql, *args):
+            result = await executemany(sql, *args)
+            if "channel_monitors" in sql:
+                flushing.set()
+                await asyncio.sleep(0.05)
+            return result
+
+        conn.execute, conn.executemany = failing_execute, slow_executemany
+        db.queue_write(ChannelConfigObject.from_db(row(1)))
+        save = asyncio.create_task(db.save_snapshots([(1, "count", 100.0, b"")], 0))
+        await asyncio.sleep(0.01)
+        await asyncio.gather(save, db.flush())
+        conn.execute, conn.executemany = execute, executemany
+        return failures
+
+    failures = run_db(write, options={"flush_interval": 60})
+
+    assert len(failures) == 1
+    assert stored(db_fp)[1] == row(1)
+    with sqlite3.connect(db_fp) as conn:
+        assert conn.execute("SELECT channel_id FROM queue_snapshots;").fetchall() == [
+            (1,)
+        ]